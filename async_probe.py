@@ -0,0 +1,219 @@
+description = """Asyncio probe engine.
+
+Runs probes as coroutines on a single event loop using aiohttp, so thousands
+of requests can be in flight from one process without a thread for each. It is
+optional: check-solr.py and check-fedora.py use it for their concurrent and
+open-loop requests with --engine async, and everything else goes through
+http_client. Responses carry the same 'timings' dictionary as
+http_client.get(), and timeouts, retries and cancellation are handled here for
+every probe:
+
+connect -- seconds spent opening connections, including TLS (aiohttp doesn't
+    time the handshake separately, so tls is always 0)
+tls -- 0, see connect
+timeToFirstByte -- seconds from sending the request to receiving the headers
+serverTime -- timeToFirstByte minus connect time
+total -- seconds until the whole body was read
+reusedConnection -- True if no new connection had to be opened
+
+Needs aiohttp:
+$ pip3 install aiohttp
+"""
+import json
+import time
+import asyncio
+import logging
+from datetime import timedelta
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from open_loop import arrivalOffsets
+
+# Upper limit on probes (and connections) in flight at once
+MAX_IN_FLIGHT = 1000
+
+# Seconds to wait for a connection, or for the next bytes of a response
+TIMEOUT = 60
+
+# Times to retry a request after a connection error, timeout or one of the
+# RETRY_STATUSES, waiting RETRY_BACKOFF seconds the first time and doubling
+RETRIES = 2
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = {502, 503, 504}
+
+CHUNK_SIZE = 1024 * 1024
+
+def requireAiohttp():
+    """Raise RuntimeError with install instructions if aiohttp is missing, so
+    scripts can check before they start.
+    """
+    if aiohttp is None:
+        raise RuntimeError("The async engine needs aiohttp. Install it with: pip3 install aiohttp")
+
+class AsyncResponse:
+    """The parts of a requests.Response the probes use: status_code, url,
+    headers, content, elapsed (time to the headers), json() and timings.
+    content is None if the body was handed to an onChunk callback instead.
+    """
+    def __init__(self, url, status, headers, content, timings, attempts):
+        self.url = url
+        self.status_code = status
+        self.headers = headers
+        self.content = content
+        self.timings = timings
+        self.attempts = attempts
+        self.elapsed = timedelta(seconds=timings['timeToFirstByte'])
+
+    def json(self):
+        return json.loads(self.content)
+
+class _RetryableStatus(Exception):
+    pass
+
+class AsyncProbeEngine:
+    """Run probe coroutines with one shared aiohttp session.
+
+    A probe is a coroutine function probe(engine, item) that makes its
+    requests with `await engine.get(url)` and returns a report, e.g.
+
+    async def checkPage(engine, url):
+        response = await engine.get(url)
+        return {'url': url, 'seconds': response.timings['total']}
+
+    reports = AsyncProbeEngine(maxInFlight=100).run(checkPage, urls)
+    """
+
+    def __init__(self, maxInFlight=MAX_IN_FLIGHT, timeout=TIMEOUT, retries=RETRIES):
+        requireAiohttp()
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout
+        self.retries = retries
+        self.elapsed = 0
+        self.cancelled = 0
+        self._session = None
+
+    def _traceConfig(self):
+        """Time new connections for each request through the context passed
+        to session.get().
+        """
+        traceConfig = aiohttp.TraceConfig()
+
+        async def onConnectionCreateStart(session, context, params):
+            context.trace_request_ctx['connectStart'] = time.perf_counter()
+
+        async def onConnectionCreateEnd(session, context, params):
+            timings = context.trace_request_ctx
+            timings['connect'] += time.perf_counter() - timings['connectStart']
+            timings['newConnections'] += 1
+
+        traceConfig.on_connection_create_start.append(onConnectionCreateStart)
+        traceConfig.on_connection_create_end.append(onConnectionCreateEnd)
+        return traceConfig
+
+    async def get(self, url, onChunk=None, chunkSize=CHUNK_SIZE, allowRedirects=True):
+        """GET url and return an AsyncResponse. If onChunk is given the body
+        is passed to it chunkSize bytes at a time and not kept. Connection
+        errors, timeouts and RETRY_STATUSES are retried up to `retries` times,
+        but only while none of the body has been passed to onChunk: after that
+        a retry would hand it the same bytes again, so the error is raised.
+        """
+        delivered = {'chunks': 0}
+
+        def deliver(chunk):
+            delivered['chunks'] += 1
+            onChunk(chunk)
+
+        attempt = 0
+        while True:
+            attempt = attempt + 1
+            try:
+                return await self._get(url, deliver if onChunk is not None else None, chunkSize, allowRedirects, attempt)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError, _RetryableStatus) as e:
+                if delivered['chunks']:
+                    raise
+                if attempt > self.retries:
+                    if isinstance(e, _RetryableStatus):
+                        return e.args[0]
+                    raise
+                logging.debug("Retrying %s after %s" % (url, repr(e)))
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+    async def _get(self, url, onChunk, chunkSize, allowRedirects, attempt):
+        traceContext = {'connect': 0.0, 'newConnections': 0}
+        start = time.perf_counter()
+        async with self._session.get(url, allow_redirects=allowRedirects, trace_request_ctx=traceContext) as response:
+            headersReceived = time.perf_counter()
+            timings = {
+                'connect': traceContext['connect'],
+                'tls': 0.0,
+                'timeToFirstByte': headersReceived - start,
+                'serverTime': max(headersReceived - start - traceContext['connect'], 0.0),
+                'reusedConnection': traceContext['newConnections'] == 0,
+            }
+            if response.status in RETRY_STATUSES:
+                timings['total'] = time.perf_counter() - start
+                raise _RetryableStatus(AsyncResponse(str(response.url), response.status, response.headers, await response.read(), timings, attempt))
+            if onChunk is None:
+                content = await response.read()
+            else:
+                content = None
+                async for chunk in response.content.iter_chunked(chunkSize):
+                    onChunk(chunk)
+            timings['total'] = time.perf_counter() - start
+            return AsyncResponse(str(response.url), response.status, response.headers, content, timings, attempt)
+
+    def run(self, probe, workItems, rate=None, arrival='fixed', deadline=None):
+        """Run probe(engine, item) for every work item, at most maxInFlight at
+        a time, and return the reports in the same order.
+
+        With a rate (per second) probes are started on an open-loop schedule
+        as with open_loop.OpenLoopScheduler, and intendedStartTime, sendLag
+        and latency are added to each report. If deadline (seconds) passes,
+        unfinished probes are cancelled and their report is None.
+        """
+        return asyncio.run(self._run(probe, list(workItems), rate, arrival, deadline))
+
+    async def _run(self, probe, workItems, rate, arrival, deadline):
+        connector = aiohttp.TCPConnector(limit=self.maxInFlight)
+        timeout = aiohttp.ClientTimeout(total=None, connect=self.timeout, sock_read=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[self._traceConfig()]) as session:
+            self._session = session
+            inFlight = asyncio.Semaphore(self.maxInFlight)
+            offsets = arrivalOffsets(rate, len(workItems), arrival) if rate else None
+            if rate:
+                logging.info("Sending %s probes open-loop at %.2f/s (%s arrivals)" % (len(workItems), rate, arrival))
+            runStart = time.perf_counter()
+
+            async def runProbe(i, item):
+                if offsets is not None:
+                    delay = runStart + offsets[i] - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                async with inFlight:
+                    actualStart = time.perf_counter()
+                    report = await probe(self, item)
+                if offsets is not None:
+                    intendedStart = runStart + offsets[i]
+                    report['intendedStartTime'] = offsets[i]
+                    report['sendLag'] = actualStart - intendedStart
+                    report['latency'] = time.perf_counter() - intendedStart
+                return report
+
+            tasks = [asyncio.ensure_future(runProbe(i, item)) for i, item in enumerate(workItems)]
+            try:
+                done, pending = await asyncio.wait(tasks, timeout=deadline)
+            finally:
+                # Also reached on KeyboardInterrupt, so nothing is left running
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self.elapsed = time.perf_counter() - runStart
+            self._session = None
+        self.cancelled = len([task for task in tasks if task.cancelled()])
+        if self.cancelled:
+            logging.warning("Cancelled %s unfinished probes at the %s second deadline" % (self.cancelled, deadline))
+        return [None if task.cancelled() else task.result() for task in tasks]
@@ -2,73 +2,135 @@ description = """Measure Fedora object retreval response times.
 Keeps track of previous requests to avoid repeats. Minimum time elapsed before
 accessing the same url can be set with MIN_OBJECT_URL_STALENESS below.
 """
-import requests
-import random
+import http_client
 from datetime import datetime
 from datetime import timedelta
+from datetime import timezone
 import statistics
+import hashlib
+import time
 import pickle
+import os
 import json
+import urllib.parse
 import logging
 import argparse
-import configparser
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from open_loop import OpenLoopScheduler, parseRate, MAX_IN_FLIGHT
+from latency_histogram import LatencyHistogram, histogramsToDict
+from get_fresh_pid import QueryHistory, FreshObjectSampler, ObjectsExhausted, DATESTAMP_FORMAT
+from async_probe import AsyncProbeEngine, requireAiohttp
+from server_config import loadServerConfig, solrEndPoint, drupalEndPoint
+from pid_index import PidIndex, writePidIndex, SIZE_FIELD, CATEGORY_FIELDS
+
+MIMETYPE_FIELD = 'fedora_datastream_latest_OBJ_MIMETYPE_ms'
 
 
 NUM_UNIQUE_CHECKS = 30
 
 MIN_ASSET_SIZE = 10000000 # in bytes
 
+SIZE_UNITS = {
+    'K': 1000,
+    'M': 1000000,
+    'G': 1000000000,
+}
+
+# Number of Solr docs per page when building the large object list
+SOLR_PAGE_SIZE = 1000
+
+# Datastreams are read this many bytes at a time and then thrown away
+CHUNK_SIZE = 1024 * 1024
+
 # Maximum age of large asset list cache
 LIST_CACHE_EXPIRATION = timedelta(days=30)
 # in format timedelta(days=0, seconds=0, microseconds=0, milliseconds=0, minutes=0, hours=0, weeks=0)
 # c.f. https://docs.python.org/3/library/datetime.html#timedelta-objects
 
+# Age after which objects modified since the cache was written are fetched
+# from Solr and merged into the cached list
+LIST_CACHE_REFRESH = timedelta(days=1)
+# Look back this much further than the cache timestamp to allow for clock
+# differences and Solr commit delays
+LIST_CACHE_REFRESH_OVERLAP = timedelta(hours=1)
+
 MIN_OBJECT_URL_STALENESS = timedelta(minutes=30)
 # Format same as LIST_CACHE_EXPIRATION
 
+# Existing json history is imported into fedora-queryhistory.sqlite
+QUERY_HISTORY_FILE = 'fedora-queryhistory.json'
+
 logging.getLogger("requests").setLevel(logging.WARNING)
 
 import pprint
 
-CONFIGFILE = "islandora.cfg"
-
 logging.getLogger("requests").setLevel(logging.WARNING)
 
 argparser = argparse.ArgumentParser(description=description)
 argparser.add_argument("--debug", action='store_true', help="Go into debug mode -- fewer unique queries, more verbosity, write to files labeled with 'DEBUG'")
 argparser.add_argument("--dry-run", action='store_true', help="Do not write out json report file")
+argparser.add_argument("--rate", help="Start downloads open-loop at this rate, e.g. '2/s' or '30/m', whether or not earlier downloads have finished.")
+argparser.add_argument("--arrival", default="fixed", choices=["fixed", "poisson"], help="How to space downloads when --rate is given. Default fixed intervals.")
+argparser.add_argument("--parallel", default=1, type=int, help="Download this many distinct objects at the same time")
+argparser.add_argument("--max-parallel", type=int, help="Measure how throughput scales by repeating the test with 1, 2, 4 ... up to this many downloads at the same time")
+argparser.add_argument("--strata", help="Sample objects by datastream size instead of uniformly, e.g. '10M-50M,50M-250M,250M-', and report throughput for each size range")
+argparser.add_argument("--per-stratum", default=10, type=int, help="Number of objects to download from each size range given with --strata. Default 10.")
+argparser.add_argument("--mime-type", action='append', help="Only download objects with this datastream MIME type, e.g. 'image/tiff'. May be given more than once.")
+argparser.add_argument("--hash", choices=sorted(hashlib.algorithms_guaranteed), help="Hash each downloaded datastream with this algorithm, e.g. 'sha256', instead of just throwing it away")
+argparser.add_argument("--histogram-file", help="Write latency histograms to this json file so they can be merged with other runs using latency_histogram.py")
+argparser.add_argument("--solr-page-size", default=SOLR_PAGE_SIZE, type=int, help="Number of objects to fetch from Solr per page when building the list of large objects. Default %s." % SOLR_PAGE_SIZE)
+argparser.add_argument("--solr-workers", default=1, type=int, help="Split the PID space into this many ranges and page through them in parallel when building the list of large objects")
+argparser.add_argument("--full-refresh", action='store_true', help="Rebuild the cached list of large objects from a full Solr scan instead of just merging in recently modified objects")
+argparser.add_argument("--engine", default="threads", choices=["threads", "async"], help="Run parallel or open-loop (--rate) downloads in a thread each, or as coroutines on the asyncio probe engine (needs aiohttp). Default threads.")
+argparser.add_argument("--pool-size", default=http_client.POOL_SIZE, type=int, help="Number of keep-alive connections to keep open to each server. Default %s." % http_client.POOL_SIZE)
 argparser.add_argument("SERVERCFG", default="PROD", help="Name of the server configuration section e.g. 'PROD' or 'STAGE'. Edit islandora.cfg to add a server configuration section.")
 cliArguments = argparser.parse_args()
 
+if cliArguments.strata:
+    # Strata are downloaded one object at a time
+    ignored = [option for option, given in [
+        ('--rate', cliArguments.rate),
+        ('--parallel', cliArguments.parallel > 1),
+        ('--max-parallel', cliArguments.max_parallel),
+        ('--engine', cliArguments.engine != 'threads'),
+    ] if given]
+    if ignored:
+        argparser.error("--strata can't be combined with %s" % ", ".join(ignored))
+
 if cliArguments.debug:
     NUM_UNIQUE_CHECKS = 3
     logging.basicConfig(level=logging.DEBUG)
 else:
     logging.basicConfig(level=logging.INFO)
 
-section = cliArguments.SERVERCFG
-configData = configparser.ConfigParser()
-largeobjectslistFilename = 'largeobjectslist-%s.cache' % cliArguments.SERVERCFG
+if cliArguments.rate:
+    try:
+        rate = parseRate(cliArguments.rate)
+    except ValueError as e:
+        logging.error(e)
+        exit(1)
+else:
+    rate = None
 
-try:
-    configData.read_file(open(CONFIGFILE), source=CONFIGFILE)
-except FileNotFoundError:
-    logging.error('No configuration file found. Configuration file required. Please make a config file called %s.' % CONFIGFILE)
-    exit(1)
-    
-try:
-    serverConfig = configData[section]
-except KeyError:
-    print("'%s' section not present in configuration file %s" % (section, CONFIGFILE))
-    exit(1)
+if cliArguments.engine == 'async':
+    try:
+        requireAiohttp()
+    except RuntimeError as e:
+        logging.error(e)
+        exit(1)
+
+# Open-loop runs can have up to MAX_IN_FLIGHT downloads out at once; each one
+# past the pool size would pay for a new handshake
+http_client.configurePool(max(cliArguments.pool_size, cliArguments.parallel, cliArguments.max_parallel or 0, cliArguments.solr_workers, MAX_IN_FLIGHT if rate else 0))
 
-drupal_protocol_host_port = serverConfig['drupal_protocol'] + "://" + serverConfig['drupal_hostname']
-drupal_object_path = serverConfig['drupal_object_path']
-drupal_end_point = drupal_protocol_host_port + drupal_object_path
+largeobjectslistFilename = 'largeobjectslist-%s.pidx' % cliArguments.SERVERCFG
+# Pickled list of Solr docs used before the PID index
+oldLargeobjectslistFilename = 'largeobjectslist-%s.cache' % cliArguments.SERVERCFG
 
-solr_protocol_host_port = serverConfig['solr_protocol'] + "://" + serverConfig['solr_hostname'] + ":" + serverConfig['solr_port']
-solr_core_path = serverConfig['solr_core_path']
-solr_end_point = solr_protocol_host_port + solr_core_path
+serverConfig = loadServerConfig(cliArguments.SERVERCFG)
+drupal_end_point = drupalEndPoint(serverConfig)
+solr_end_point = solrEndPoint(serverConfig)
 
 class Forbidden(Exception):
     """Exception for handling restricted objects.
@@ -100,20 +162,9 @@ def checkRequestStatusCodes(request):
         logging.error(str(request.status_code))
         exit(1)
 
-def makeSampleObjectList():
-    """Query Solr for a good size list of objects then filter them by size to
-    produce a list of objects that are greater than MIN_ASSET_SIZE.
+def filterLargeObjects(objectList):
+    """Filter a list of Solr docs for objects that are a decent size.
     """
-    
-    SolrQueryUrl = solr_end_point + "select?q=*%3A*&rows=100000&fl=PID%2Cfedora_datastream_latest_OBJ_SIZE_ms&wt=json&indent=true"
-    logging.debug("Getting a random list of objects")
-    try:
-        request = requests.get(SolrQueryUrl)
-        checkRequestStatusCodes(request)
-    except Forbidden:
-        logging.error("Unable to access: %s" % SolrQueryUrl)
-    objectList = request.json()["response"]["docs"]
-    # Now filter the list for objects that are a decent size.
     # Solr is storing data stream sizes in a string field so a range
     # query doesn't work.
     # c.f. https://groups.google.com/forum/#!topic/islandora/6XsphOdOdjU
@@ -125,69 +176,215 @@ def makeSampleObjectList():
                 bigEnoughObjectsList.append(myObject)
         except KeyError:
             pass
+    return bigEnoughObjectsList
+
+def solrSelect(urlParameters):
+    SolrQueryUrl = solr_end_point + "select?" + urllib.parse.urlencode(urlParameters, doseq=True)
+    try:
+        request = http_client.get(SolrQueryUrl)
+        checkRequestStatusCodes(request)
+    except Forbidden:
+        logging.error("Unable to access: %s" % SolrQueryUrl)
+        exit(1)
+    return request.json()
+
+def pidRangeFilters(partitions, filterQueries):
+    """Split the objects matching filterQueries into ranges of PIDs holding
+    about the same number of objects each, so pages can be fetched in
+    parallel, one cursor per range. PIDs are namespaced (islandora:, smith:,
+    ywca: ...) and unevenly spread, so the boundaries are the PIDs found at
+    evenly spaced positions in PID order rather than fixed letters.
+    """
+    if partitions <= 1:
+        return ["PID:[* TO *]"]
+    numFound = solrSelect({'q': '*:*', 'fq': filterQueries, 'rows': 0, 'wt': 'json'})["response"]["numFound"]
+    boundaries = ['*']
+    for i in range(1, partitions):
+        docs = solrSelect({
+            'q': '*:*',
+            'fq': filterQueries,
+            'sort': 'PID asc',
+            'start': i * numFound // partitions,
+            'rows': 1,
+            'fl': 'PID',
+            'wt': 'json',
+        })["response"]["docs"]
+        boundary = '"%s"' % docs[0]['PID'] if docs else '*'
+        # Few objects can give the same boundary twice, which would be an empty range
+        if boundary != boundaries[-1] and boundary != '*':
+            boundaries.append(boundary)
+    boundaries.append('*')
+    filters = []
+    for i in range(len(boundaries) - 1):
+        upperBracket = ']' if boundaries[i + 1] == '*' else '}'
+        filters.append("PID:[%s TO %s%s" % (boundaries[i], boundaries[i + 1], upperBracket))
+    logging.debug("Fetching %s objects in %s PID ranges: %s" % (numFound, len(filters), filters))
+    return filters
+
+def fetchObjects(filterQueries, largeOnly=True):
+    """Page through every object matching filterQueries with a Solr cursor,
+    SOLR_PAGE_SIZE docs at a time, keeping only the large objects from each
+    page as it arrives (or every object if largeOnly is False).
+    """
+    objectList = []
+    cursorMark = '*'
+    while True:
+        page = solrSelect({
+            'q': '*:*',
+            'fq': filterQueries,
+            'rows': cliArguments.solr_page_size,
+            'fl': ','.join(['PID', SIZE_FIELD] + CATEGORY_FIELDS),
+            'sort': 'PID asc',
+            'cursorMark': cursorMark,
+            'wt': 'json',
+        })
+        if largeOnly:
+            objectList.extend(filterLargeObjects(page["response"]["docs"]))
+        else:
+            objectList.extend(page["response"]["docs"])
+        if page["nextCursorMark"] == cursorMark:
+            return objectList
+        cursorMark = page["nextCursorMark"]
+
+def makeSampleObjectList():
+    """Query Solr for every object with a datastream size then filter them by
+    size to produce a list of objects that are greater than MIN_ASSET_SIZE.
+    """
+    logging.debug("Getting a list of objects in pages of %s" % cliArguments.solr_page_size)
+    # Objects without an OBJ datastream are no use to us
+    hasSize = 'fedora_datastream_latest_OBJ_SIZE_ms:[* TO *]'
+    rangeFilters = pidRangeFilters(cliArguments.solr_workers, [hasSize])
+    bigEnoughObjectsList = []
+    with ThreadPoolExecutor(max_workers=cliArguments.solr_workers) as executor:
+        for objectList in executor.map(fetchObjects, [[hasSize, rangeFilter] for rangeFilter in rangeFilters]):
+            bigEnoughObjectsList.extend(objectList)
     logging.debug("%s objects found" % len(bigEnoughObjectsList))
     return bigEnoughObjectsList
 
-def cacheObjectList(objectList):
-    """Save cache file of list of good sized objects as a Python pickle.
+def refreshSampleObjectList(objectList, since):
+    """Ask Solr only for objects modified since the given (local) time and
+    merge them into objectList. Modified objects replace their old entry, or
+    are dropped if they are no longer large enough. Deleted objects aren't
+    noticed until the next full rebuild.
+    """
+    since = since - LIST_CACHE_REFRESH_OVERLAP
+    sinceSolr = since.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    logging.debug("Getting objects modified since %s" % sinceSolr)
+    modifiedObjectsList = fetchObjects(['fgs_lastModifiedDate_dt:[%s TO *]' % sinceSolr], largeOnly=False)
+    logging.debug("%s objects modified" % len(modifiedObjectsList))
+    modifiedPids = set([myObject['PID'] for myObject in modifiedObjectsList])
+    refreshedObjectsList = [myObject for myObject in objectList if myObject['PID'] not in modifiedPids]
+    refreshedObjectsList.extend(filterLargeObjects(modifiedObjectsList))
+    logging.debug("%s objects found" % len(refreshedObjectsList))
+    return refreshedObjectsList
+
+def cacheObjectList(objectList, dateStamp, fullRebuildDateStamp):
+    """Save cache file of list of good sized objects as a compact PID index
+    (see pid_index.py). dateStamp is when the list was last brought up to date
+    with Solr and fullRebuildDateStamp when it was last built from scratch.
+    Returns the memory-mapped index.
     """
     logging.debug("Writing list of large objects to cache file")
-    objectListCache = {
-        'dateStamp': datetime.now(),
-        'objectList': objectList
-    }
-    with open(largeobjectslistFilename, 'wb') as f:
-        # Pickle the 'data' dictionary using the highest protocol available.
-        pickle.dump(objectListCache, f, pickle.HIGHEST_PROTOCOL)
+    writePidIndex(largeobjectslistFilename, objectList, {
+        'dateStamp': dateStamp.strftime(DATESTAMP_FORMAT),
+        'fullRebuildDateStamp': fullRebuildDateStamp.strftime(DATESTAMP_FORMAT),
+    })
+    return PidIndex(largeobjectslistFilename)
+
+def rebuildObjectList():
+    syncStart = datetime.now()
+    objectList = makeSampleObjectList()
+    logging.debug("Cache-ing it")
+    return cacheObjectList(objectList, syncStart, syncStart)
+
+def convertOldObjectListCache():
+    """Convert a pickled cache from before the PID index.
+    """
+    logging.info("Converting %s to %s" % (oldLargeobjectslistFilename, largeobjectslistFilename))
+    with open(oldLargeobjectslistFilename, 'rb') as f:
+        objectListCache = pickle.load(f)
+    dateStamp = objectListCache['dateStamp']
+    cacheObjectList(objectListCache['objectList'], dateStamp, dateStamp).close()
 
 def loadObjectList():
     """Return a list of Compass objects that are good for testing on. Uses
-    caching to improve speed. If the cache is older than LIST_CACHE_EXPIRATION
-    then it will get a fresh list from Solr and filter for objects that are
-    large enough, and then will save it to the cache file.
+    caching to improve speed. If the cache is older than LIST_CACHE_REFRESH
+    then only the objects modified since are fetched from Solr and merged in.
+    If it was built from scratch longer ago than LIST_CACHE_EXPIRATION (or
+    --full-refresh is given) it will get a fresh list from Solr and filter for
+    objects that are large enough. Either way it is saved to the cache file.
     """
     logging.debug("Loading an object list")
 
+    if os.path.exists(oldLargeobjectslistFilename) and not os.path.exists(largeobjectslistFilename):
+        convertOldObjectListCache()
+
     try:
-        with open(largeobjectslistFilename, 'rb') as f:
-            objectListCache = pickle.load(f)
-        cacheAge = datetime.now() - objectListCache['dateStamp']
-        logging.debug("Cache timestamp: %s" % objectListCache['dateStamp'])
-        logging.debug("Cache age: %s" % cacheAge)
-        logging.debug("LIST_CACHE_EXPIRATION: %s" % LIST_CACHE_EXPIRATION)
-        # If the cache is older than LIST_CACHE_EXPIRATION in days
-        if cacheAge > LIST_CACHE_EXPIRATION:
-            logging.debug("Cache too old, getting a fresh list")
-            objectList = makeSampleObjectList()
-            logging.debug("Cache-ing it")
-            cacheObjectList(objectList)
-            return objectList
-        else:
-            logging.debug("Using cached list")
-            return objectListCache['objectList']
+        objectList = PidIndex(largeobjectslistFilename)
     except FileNotFoundError:
         logging.debug("No cache file, getting a fresh list")
-        objectList = makeSampleObjectList()
+        return rebuildObjectList()
+
+    dateStamp = datetime.strptime(objectList.metadata['dateStamp'], DATESTAMP_FORMAT)
+    fullRebuildDateStamp = datetime.strptime(objectList.metadata['fullRebuildDateStamp'], DATESTAMP_FORMAT)
+    cacheAge = datetime.now() - dateStamp
+    logging.debug("Cache timestamp: %s" % dateStamp)
+    logging.debug("Cache age: %s" % cacheAge)
+    logging.debug("Cache last rebuilt: %s" % fullRebuildDateStamp)
+    logging.debug("LIST_CACHE_EXPIRATION: %s" % LIST_CACHE_EXPIRATION)
+    # If the cache was built longer ago than LIST_CACHE_EXPIRATION in days
+    if cliArguments.full_refresh or datetime.now() - fullRebuildDateStamp > LIST_CACHE_EXPIRATION:
+        logging.debug("Cache too old, getting a fresh list")
+        return rebuildObjectList()
+    elif cacheAge > LIST_CACHE_REFRESH:
+        logging.debug("Cache out of date, merging in modified objects")
+        syncStart = datetime.now()
+        objectList = refreshSampleObjectList(list(objectList), dateStamp)
         logging.debug("Cache-ing it")
-        cacheObjectList(objectList)
+        return cacheObjectList(objectList, syncStart, fullRebuildDateStamp)
+    else:
+        logging.debug("Using cached list")
         return objectList
 
-def downloadObject(downloadUrl):
-    report = {
+class DownloadMeter:
+    """Counts, times and optionally hashes the chunks of one download as they
+    arrive, then throws them away.
+    """
+    def __init__(self, hashAlgorithm=None):
+        self.hashAlgorithm = hashAlgorithm
+        self.digest = hashlib.new(hashAlgorithm) if hashAlgorithm else None
+        self.assetSize = 0
+        self.chunkRates = []
+        self._chunkStart = time.perf_counter()
+
+    def update(self, chunk):
+        chunkEnd = time.perf_counter()
+        if chunkEnd > self._chunkStart:
+            self.chunkRates.append((len(chunk)/1000000)/(chunkEnd - self._chunkStart))
+        self._chunkStart = chunkEnd
+        self.assetSize = self.assetSize + len(chunk)
+        if self.digest:
+            self.digest.update(chunk)
+
+def newDownloadReport(downloadUrl):
+    return {
         'type': '',
         'assetSize': 0,
         'transferElapsedTime': 0,
         'transferMBytesPerS': 0,
         'responseTime': 0,
-        'url': '',
+        'connectTime': 0,
+        'tlsTime': 0,
+        'timeToFirstByte': 0,
+        'chunkMBytesPerS': {},
+        'digest': None,
+        'url': downloadUrl,
         'objectPid': '',
         'timeStamp': datetime.now(),
     }
-    logging.info(downloadUrl)
-    report['url'] = downloadUrl
-    requestStart=datetime.now()
-    request = requests.get(downloadUrl, allow_redirects=True)
-    checkRequestStatusCodes(request)
+
+def finishDownloadReport(report, request, meter, requestStart):
+    report['assetSize'] = meter.assetSize
     report['transferElapsedTime'] = datetime.now()-requestStart
     report['transferElapsedTime'] = float(report['transferElapsedTime'].total_seconds())
     logging.debug('Transfer time: %s' % report['transferElapsedTime'])
@@ -195,74 +392,227 @@ def downloadObject(downloadUrl):
     report['type'] = request.headers.get('content-type')
     logging.debug("Request response time: %s" % request.elapsed.total_seconds())
     report['responseTime'] = request.elapsed.total_seconds()
-    logging.debug("Fedora datastream size: %s" % request.headers.get('content-length', None))
-    open('.last-fedora-download', 'wb').write(request.content)
-    report['assetSize'] = int(request.headers.get('content-length', None))
+    report['connectTime'] = request.timings['connect']
+    report['tlsTime'] = request.timings['tls']
+    report['timeToFirstByte'] = request.timings['timeToFirstByte']
+    logging.debug("Fedora datastream size: %s (content-length: %s)" % (report['assetSize'], request.headers.get('content-length', None)))
     report['transferMBytesPerS'] = (report['assetSize']/1000000)/report['transferElapsedTime']
+    if meter.chunkRates:
+        report['chunkMBytesPerS'] = {
+            'min': min(meter.chunkRates),
+            'median': statistics.median(meter.chunkRates),
+            'max': max(meter.chunkRates),
+        }
+    if meter.digest:
+        report['digest'] = meter.digest.hexdigest()
+        logging.debug("%s: %s" % (meter.hashAlgorithm, report['digest']))
     return report
 
-def loadQueryHistory():
-    try:
-        with open('fedora-queryhistory.json', 'r') as fp:
-            queryHistoryJson = json.load(fp)
-        # Convert all the date strings into real dates... D:
-        queryHistory = {}
-        for key,value in queryHistoryJson.items():
-            value = datetime.strptime(value,'%Y-%m-%d %H:%M:%S.%f')
-            queryHistory[key] = value
-    except FileNotFoundError:
-        logging.info("No query history file, starting a fresh dictionary")
-        queryHistory = {}
-    return queryHistory
+def downloadObject(downloadUrl, hashAlgorithm=None):
+    """Download a datastream in CHUNK_SIZE pieces and throw them away (or just
+    hash them) so memory use stays the same no matter how big the object is.
+    """
+    report = newDownloadReport(downloadUrl)
+    logging.info(downloadUrl)
+    requestStart=datetime.now()
+    # Closed on the way out even if the status check raises, so a refused
+    # object doesn't keep its pooled connection
+    with http_client.get(downloadUrl, allow_redirects=True, stream=True) as request:
+        checkRequestStatusCodes(request)
+        meter = DownloadMeter(hashAlgorithm)
+        for chunk in request.iter_content(chunk_size=CHUNK_SIZE):
+            meter.update(chunk)
+    return finishDownloadReport(report, request, meter, requestStart)
+
+async def downloadObjectAsync(engine, downloadUrl, hashAlgorithm=None):
+    """downloadObject() for the async engine.
+    """
+    report = newDownloadReport(downloadUrl)
+    logging.info(downloadUrl)
+    requestStart=datetime.now()
+    meter = DownloadMeter(hashAlgorithm)
+    request = await engine.get(downloadUrl, onChunk=meter.update, chunkSize=CHUNK_SIZE)
+    checkRequestStatusCodes(request)
+    return finishDownloadReport(report, request, meter, requestStart)
 
 
 transferRates = []
 responseTimes = []
 
-queryHistory = loadQueryHistory()
+queryHistory = QueryHistory(QUERY_HISTORY_FILE)
 
 objectList = loadObjectList()
 logging.debug("Using object list of %s items" % len(objectList))
-def getFreshObjectUrl():
-    objectPid = objectList[random.randint(0,len(objectList) - 1)]['PID']
-    downloadUrl = drupal_end_point + "%s/datastream/OBJ/download" % objectPid
-    try:
-        dateStamp = queryHistory[downloadUrl]
-        logging.debug("URL found in history with datestamp: %s" % dateStamp)
-        objectUrlAge = datetime.now() - dateStamp
-        if objectUrlAge > MIN_OBJECT_URL_STALENESS:
-            logging.debug("Object URL age %s is older than MIN_OBJECT_URL_STALENESS %s" % (objectUrlAge, MIN_OBJECT_URL_STALENESS))
-            return downloadUrl
-        else:
-            logging.debug("Object URL age %s is younger than MIN_OBJECT_URL_STALENESS %s" % (objectUrlAge, MIN_OBJECT_URL_STALENESS))
-            logging.debug("Try again! rerunning getFreshUrl()")
-            return getFreshObjectUrl()
-    except KeyError:
-        # That URL is not even on the list so it's definitely fresh
-        logging.debug("URL not even in history")
-        return downloadUrl
-
-def downloadFreshObject():
-    downloadUrl = getFreshObjectUrl()
+freshObjectSamplerLock = threading.Lock()
+DOWNLOAD_URL_TEMPLATE = drupal_end_point + "%s/datastream/OBJ/download"
+
+def parseSize(sizeString):
+    """Turn '250M' or '1.5G' into bytes. Sizes are decimal (1M = 1000000
+    bytes) to match the MB/s figures.
+    """
+    sizeString = sizeString.strip().upper()
+    multiplier = SIZE_UNITS.get(sizeString[-1:], None)
+    if multiplier is None:
+        return int(sizeString)
+    return int(float(sizeString[:-1]) * multiplier)
+
+def parseStrata(strataString):
+    """Turn '10M-50M,50M-250M,250M-' into a list of (label, minimum size,
+    maximum size or None) tuples.
+    """
+    strata = []
+    for stratum in strataString.split(','):
+        low, _, high = stratum.partition('-')
+        strata.append((stratum.strip(), parseSize(low or '0'), parseSize(high) if high.strip() else None))
+    return strata
+
+def selectObjects(objectList, minSize=0, maxSize=None, mimeTypes=None):
+    """PIDs of the objects in objectList with a datastream size in
+    [minSize, maxSize) and, if mimeTypes is given, one of those MIME types.
+    """
+    if mimeTypes and MIMETYPE_FIELD not in objectList.categoryFields:
+        logging.warning("Cached object list has no MIME types. Run with --full-refresh to add them.")
+    positions = []
+    for i in range(len(objectList)):
+        size = objectList.size(i)
+        if size is None or size < minSize or (maxSize is not None and size >= maxSize):
+            continue
+        if mimeTypes and objectList.category(MIMETYPE_FIELD, i) not in mimeTypes:
+            continue
+        positions.append(i)
+    return objectList.subset(positions)
+
+if cliArguments.mime_type:
+    freshObjectSampler = FreshObjectSampler(queryHistory, selectObjects(objectList, mimeTypes=cliArguments.mime_type), DOWNLOAD_URL_TEMPLATE, MIN_OBJECT_URL_STALENESS)
+else:
+    freshObjectSampler = FreshObjectSampler(queryHistory, objectList.pids, DOWNLOAD_URL_TEMPLATE, MIN_OBJECT_URL_STALENESS)
+
+def reserveFreshObjectUrl(sampler=None):
+    """Pick a fresh object URL and mark it as used straight away, so that
+    downloads running at the same time never pick the same object.
+    """
+    with freshObjectSamplerLock:
+        try:
+            downloadUrl = (sampler or freshObjectSampler).pick()
+        except ObjectsExhausted as e:
+            logging.error("FAIL %s" % e)
+            exit(1)
+    return downloadUrl
+
+def downloadFreshObject(sampler=None):
+    downloadUrl = reserveFreshObjectUrl(sampler)
     try:
-        objectReport = downloadObject(downloadUrl)
+        objectReport = downloadObject(downloadUrl, cliArguments.hash)
         return objectReport
     except Forbidden:
         # If the object was forbidden just try another one (lazy I know)
         logging.debug("%s is forbidden, trying another one." % downloadUrl)
-        return downloadFreshObject()
+        return downloadFreshObject(sampler)
 
-for i in range(NUM_UNIQUE_CHECKS):
+def checkFreshObject(i=None, sampler=None):
     logging.debug("***** START LOOP *****")
-    logging.debug("Save query history for later")
-    objectReport = downloadFreshObject()
-    downloadUrl = objectReport['url']
-    queryHistory[downloadUrl] = datetime.now()
-    with open('fedora-queryhistory.json', 'w') as fp:
-        # Do this on every request in case something happens before we get to
-        # the end of the program
-        json.dump(queryHistory, fp, indent=4, sort_keys=True, default=str)
+    # The URL was already recorded in the query history when it was picked
+    objectReport = downloadFreshObject(sampler)
 #    objectReport['objectPid'] = objectPid
+    return objectReport
+
+async def checkFreshObjectAsync(engine, i=None, sampler=None):
+    """checkFreshObject() for the async engine.
+    """
+    while True:
+        downloadUrl = reserveFreshObjectUrl(sampler)
+        try:
+            objectReport = await downloadObjectAsync(engine, downloadUrl, cliArguments.hash)
+            break
+        except Forbidden:
+            logging.debug("%s is forbidden, trying another one." % downloadUrl)
+    return objectReport
+
+def checkParallelObjects(parallel):
+    """Download distinct fresh objects, `parallel` of them at a time, and
+    measure the aggregate throughput across all streams as well as the
+    throughput of each stream.
+    """
+    numChecks = max(NUM_UNIQUE_CHECKS, parallel)
+    logging.info("Downloading %s objects, %s at a time" % (numChecks, parallel))
+    wallClockStart = time.perf_counter()
+    if cliArguments.engine == 'async':
+        objectReports = AsyncProbeEngine(maxInFlight=parallel).run(checkFreshObjectAsync, range(numChecks))
+    else:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            objectReports = list(executor.map(checkFreshObject, range(numChecks)))
+    wallClockElapsed = time.perf_counter() - wallClockStart
+    for objectReport in objectReports:
+        objectReport['parallel'] = parallel
+    totalMBytes = sum([objectReport['assetSize'] for objectReport in objectReports])/1000000
+    scalingReport = {
+        'parallel': parallel,
+        'objects': numChecks,
+        'totalMBytes': totalMBytes,
+        'wallClockTime': wallClockElapsed,
+        'aggregateMBytesPerS': totalMBytes/wallClockElapsed,
+        'perStreamMBytesPerS': statistics.mean([objectReport['transferMBytesPerS'] for objectReport in objectReports]),
+    }
+    logging.info("%s at a time: aggregate %s MB/s, per stream %s MB/s" % (parallel, scalingReport['aggregateMBytesPerS'], scalingReport['perStreamMBytesPerS']))
+    return objectReports, scalingReport
+
+def parallelLevels(maxParallel):
+    """Levels of parallelism to step through: doubling up to maxParallel.
+
+    >>> parallelLevels(10)
+    [1, 2, 4, 8, 10]
+    """
+    levels = []
+    parallel = 1
+    while parallel < maxParallel:
+        levels.append(parallel)
+        parallel = parallel * 2
+    levels.append(maxParallel)
+    return levels
+
+def checkStrata(strata, perStratum):
+    """Download perStratum fresh objects from each size stratum (narrowed to
+    --mime-type if given) so that transfer rates can be compared by size.
+    """
+    objectReports = []
+    for label, minSize, maxSize in strata:
+        stratumObjects = selectObjects(objectList, max(minSize, MIN_ASSET_SIZE), maxSize, cliArguments.mime_type)
+        sampler = FreshObjectSampler(queryHistory, stratumObjects, DOWNLOAD_URL_TEMPLATE, MIN_OBJECT_URL_STALENESS)
+        numChecks = min(perStratum, sampler.freshCount())
+        if numChecks < perStratum:
+            logging.warning("Only %s fresh objects in stratum %s" % (numChecks, label))
+        logging.info("Downloading %s objects from stratum %s (%s objects)" % (numChecks, label, len(stratumObjects)))
+        for i in range(numChecks):
+            objectReport = checkFreshObject(sampler=sampler)
+            objectReport['stratum'] = label
+            objectReports.append(objectReport)
+    return objectReports
+
+scalingReports = []
+if cliArguments.strata:
+    objectReports = checkStrata(parseStrata(cliArguments.strata), cliArguments.per_stratum)
+elif rate and cliArguments.engine == 'async':
+    objectReports = AsyncProbeEngine().run(checkFreshObjectAsync, range(NUM_UNIQUE_CHECKS), rate, cliArguments.arrival)
+elif rate:
+    scheduler = OpenLoopScheduler(rate, cliArguments.arrival)
+    objectReports = scheduler.run(checkFreshObject, range(NUM_UNIQUE_CHECKS))
+elif cliArguments.max_parallel:
+    objectReports = []
+    for parallel in parallelLevels(cliArguments.max_parallel):
+        levelReports, scalingReport = checkParallelObjects(parallel)
+        objectReports.extend(levelReports)
+        scalingReports.append(scalingReport)
+elif cliArguments.parallel > 1:
+    objectReports, scalingReport = checkParallelObjects(cliArguments.parallel)
+    scalingReports.append(scalingReport)
+else:
+    objectReports = [checkFreshObject() for i in range(NUM_UNIQUE_CHECKS)]
+
+if not objectReports:
+    logging.error("No objects were downloaded. Check that there are fresh objects for the --strata and --mime-type given.")
+    exit(1)
+
+for objectReport in objectReports:
     transferRates.append(objectReport['transferMBytesPerS'])
     responseTimes.append(objectReport['responseTime'])
 
@@ -270,3 +620,44 @@ logging.debug(transferRates)
 logging.debug(responseTimes)
 logging.info("Mean response time: %s seconds" % statistics.mean(responseTimes))
 logging.info("Mean transfer rate: %s MB/s" % statistics.mean(transferRates))
+logging.info("Mean time to first byte: %s seconds" % statistics.mean([objectReport['timeToFirstByte'] for objectReport in objectReports]))
+chunkRates = [objectReport['chunkMBytesPerS']['median'] for objectReport in objectReports if objectReport['chunkMBytesPerS']]
+# Empty if every download had an empty body
+if chunkRates:
+    logging.info("Median per-chunk transfer rate: %s MB/s" % statistics.median(chunkRates))
+logging.info("Mean connection setup (connect + TLS) time: %s seconds" % statistics.mean([objectReport['connectTime'] + objectReport['tlsTime'] for objectReport in objectReports]))
+if rate:
+    latencies = [objectReport['latency'] for objectReport in objectReports]
+    logging.info("Mean latency from intended start: %s seconds" % statistics.mean(latencies))
+    logging.info("Max latency from intended start: %s seconds" % max(latencies))
+histograms = {}
+for objectReport in objectReports:
+    for field in ['responseTime', 'timeToFirstByte', 'transferElapsedTime', 'latency']:
+        if field in objectReport:
+            histograms.setdefault(field, LatencyHistogram()).record(objectReport[field])
+            if 'stratum' in objectReport:
+                histograms.setdefault(field + ' ' + objectReport['stratum'], LatencyHistogram()).record(objectReport[field])
+for name, histogram in sorted(histograms.items()):
+    logging.info("%s percentiles (seconds): %s" % (name, histogram.summary()))
+if cliArguments.histogram_file:
+    with open(cliArguments.histogram_file, 'w') as fp:
+        json.dump(histogramsToDict(histograms), fp, indent=4, sort_keys=True)
+    logging.info("Histograms written to %s" % cliArguments.histogram_file)
+
+if cliArguments.strata:
+    logging.info("Throughput by object size:")
+    logging.info("%16s %8s %16s %16s %16s %16s" % ('stratum', 'objects', 'mean MB/s', 'median MB/s', 'p50 TTFB s', 'p90 TTFB s'))
+    for label, minSize, maxSize in parseStrata(cliArguments.strata):
+        stratumReports = [objectReport for objectReport in objectReports if objectReport['stratum'] == label]
+        if not stratumReports:
+            logging.info("%16s %8s" % (label, 0))
+            continue
+        stratumRates = [objectReport['transferMBytesPerS'] for objectReport in stratumReports]
+        timeToFirstByteHistogram = histograms['timeToFirstByte ' + label]
+        logging.info("%16s %8s %16.2f %16.2f %16.3f %16.3f" % (label, len(stratumReports), statistics.mean(stratumRates), statistics.median(stratumRates), timeToFirstByteHistogram.percentile(50), timeToFirstByteHistogram.percentile(90)))
+
+if scalingReports:
+    logging.info("Throughput scaling:")
+    logging.info("%10s %12s %22s %22s" % ('parallel', 'objects', 'aggregate MB/s', 'per stream MB/s'))
+    for scalingReport in scalingReports:
+        logging.info("%10s %12s %22.2f %22.2f" % (scalingReport['parallel'], scalingReport['objects'], scalingReport['aggregateMBytesPerS'], scalingReport['perStreamMBytesPerS']))
@@ -19,37 +19,72 @@ if not (sys.version_info > (3, 0)):
     logging.error("This script requires Python 3")
     exit(1)
 
-import random
 from datasets import commonEnglishWordS
 import urllib
-import requests
+import http_client
 import datetime
 import json
 import time
+import math
+import statistics
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from open_loop import OpenLoopScheduler, parseRate, MAX_IN_FLIGHT
+from latency_histogram import LatencyHistogram, histogramsToDict
+from results_store import ResultsStore, RESULTS_DB, runIdFromFilename
+from query_workload import loadWorkload
+from term_sampler import TermSampler, makeTermSampler, DISTRIBUTIONS
+from server_config import loadServerConfig, solrEndPoint
+from async_probe import AsyncProbeEngine, requireAiohttp
 
 import argparse
-import configparser
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 
 import pprint
 
-CONFIGFILE = "islandora.cfg"
-
 NUM_UNIQUE_CHECKS = 30
 NUM_REPEAT_CHECKS = 4
 
+# Warm-up ends when the QTimes of the last WARMUP_WINDOW unique queries show
+# no trend, or gives up after WARMUP_MAX_SAMPLES queries
+WARMUP_WINDOW = 30
+WARMUP_MAX_SAMPLES = 2000
+
 PLACES = 5
 
+# Cache characterization: repeat a query after this many other unique queries,
+# or after this many seconds, CACHE_PROBES times each
+CACHE_GAPS = [0, 16, 64, 256, 512, 1024, 2048, 4096]
+CACHE_DELAYS = [1, 30, 120]
+CACHE_PROBES = 5
+# A repeat counts as a cache hit if its QTime is at most this fraction of the
+# first one, or at most CACHE_HIT_MAX_QTIME milliseconds
+CACHE_HIT_FRACTION = 0.5
+CACHE_HIT_MAX_QTIME = 1
+SOLR_CACHES = ["queryResultCache", "filterCache", "documentCache"]
+
+# OCR full-text benchmark: every combination of phrase length and slop is
+# queried OCR_CHECKS times with highlighting on
+OCR_FIELDS = ["OCR_t"]
+OCR_PHRASE_LENGTHS = [2, 5, 10, 20]
+OCR_SLOPS = [0, 5, 20]
+OCR_CHECKS = 10
+OCR_HIGHLIGHT_SNIPPETS = 3
+OCR_HIGHLIGHT_FRAGSIZE = 100
+
+# How words are picked for random phrases
+TERM_SAMPLER = TermSampler(commonEnglishWordS)
+
+# Query mix model from query_workload.py, or None for random phrases
+QUERY_WORKLOAD = None
+
 def makeRandomeSolrQuery():
+    if QUERY_WORKLOAD is not None:
+        phrase, urlParameters = QUERY_WORKLOAD.sample()
+        return makeSolrRequest(phrase, urlParameters)
     solrRequest = {}
-    phrase = []
-    
-    lexiconSize = len(commonEnglishWordS)
-    for i in range(PLACES):
-        word = commonEnglishWordS[random.randint(0,lexiconSize - 1)]
-        phrase.append(word)
-    phrase = " ".join(phrase)
+    phrase = TERM_SAMPLER.phrase(PLACES)
     urlParameters = {
         'q': phrase
     }
@@ -60,9 +95,20 @@ def makeRandomeSolrQuery():
     return solrRequest
 
 def doCheck(solrRequest):
+    dateStamp = datetime.datetime.now()
+    response = http_client.get(solrRequest['requestUrl'])
+    return makeCheckReport(solrRequest, response, dateStamp)
+
+async def doAsyncCheck(engine, solrRequest):
+    """doCheck() for the async engine.
+    """
+    dateStamp = datetime.datetime.now()
+    response = await engine.get(solrRequest['requestUrl'])
+    return makeCheckReport(solrRequest, response, dateStamp)
+
+def makeCheckReport(solrRequest, response, dateStamp):
     reportData = {}
-    reportData["datesStamp"] = datetime.datetime.now()
-    response = requests.get(solrRequest['requestUrl'])
+    reportData["datesStamp"] = dateStamp
     logging.debug(solrRequest['phrase'])
     reportData["phrase"] = solrRequest['phrase']
     logging.debug(response.json()["responseHeader"]["QTime"])
@@ -71,9 +117,44 @@ def doCheck(solrRequest):
     reportData["realTime"] = response.elapsed.total_seconds()
     logging.debug(response.json()["response"]["numFound"])
     reportData["numFound"] = response.json()["response"]["numFound"]
+    # Connection setup vs server time
+    reportData["connectTime"] = response.timings['connect']
+    reportData["tlsTime"] = response.timings['tls']
+    reportData["timeToFirstByte"] = response.timings['timeToFirstByte']
+    reportData["reusedConnection"] = response.timings['reusedConnection']
     return reportData
 
-def checkSolr():
+def doRepeatChecks(solrRequest, concurrency=1):
+    """Run one phrase NUM_REPEAT_CHECKS times in a row so that the first
+    check is the unique (uncached) query and the rest are cached repeats.
+    Repeats of a phrase are always sequential, even when several phrases are
+    being checked at once.
+    """
+    repeatCheckReport = []
+    for i in range(NUM_REPEAT_CHECKS):
+        singleCheckReport = doCheck(solrRequest)
+        singleCheckReport["concurrency"] = concurrency
+        repeatCheckReport.append(singleCheckReport)
+    return repeatCheckReport
+
+async def doAsyncRepeatChecks(engine, solrRequest, concurrency=1):
+    """doRepeatChecks() for the async engine.
+    """
+    repeatCheckReport = []
+    for i in range(NUM_REPEAT_CHECKS):
+        singleCheckReport = await doAsyncCheck(engine, solrRequest)
+        singleCheckReport["concurrency"] = concurrency
+        repeatCheckReport.append(singleCheckReport)
+    return repeatCheckReport
+
+def checkSolr(concurrency=1, rate=None, arrival='fixed', engine='threads'):
+    """Run the query suite. By default it is closed-loop: each phrase waits for
+    the previous request before sending the next one. If a rate (requests per
+    second) is given, requests are instead fired on schedule whether or not
+    earlier ones have finished, and latency is measured from the intended send
+    time. With engine='async' concurrent and open-loop requests run as
+    coroutines on the async probe engine instead of one thread each.
+    """
     finalReport = {}
     finalReport["data"] = []
 
@@ -81,14 +162,36 @@ def checkSolr():
     finalReport["summary"]["test start time"] = datetime.datetime.now()
 
     # -- MAIN LOOP --
-    logging.info("Querying Solr with %s unique queries, each repeating %s times." % (NUM_UNIQUE_CHECKS, NUM_REPEAT_CHECKS) )
-    for i in range(NUM_UNIQUE_CHECKS):
-        solrRequest = makeRandomeSolrQuery()
-        repeatCheckReport = []
-        for i in range(NUM_REPEAT_CHECKS):
-            singleCheckReport = doCheck(solrRequest)
-            repeatCheckReport.append(singleCheckReport)
-        finalReport["data"].append(repeatCheckReport)
+    solrRequests = [makeRandomeSolrQuery() for i in range(NUM_UNIQUE_CHECKS)]
+    wallClockStart = time.perf_counter()
+    if rate:
+        logging.info("Querying Solr with %s unique queries, each repeating %s times, at %s requests/s." % (NUM_UNIQUE_CHECKS, NUM_REPEAT_CHECKS, rate) )
+        # Repeats are scheduled straight after their phrase, so at high rates
+        # a repeat may be sent before the original has come back.
+        workItems = [solrRequest for solrRequest in solrRequests for i in range(NUM_REPEAT_CHECKS)]
+        if engine == 'async':
+            reports = AsyncProbeEngine().run(doAsyncCheck, workItems, rate, arrival)
+        else:
+            scheduler = OpenLoopScheduler(rate, arrival)
+            reports = scheduler.run(doCheck, workItems)
+        for i in range(NUM_UNIQUE_CHECKS):
+            finalReport["data"].append(reports[i * NUM_REPEAT_CHECKS:(i + 1) * NUM_REPEAT_CHECKS])
+    elif concurrency > 1:
+        logging.info("Querying Solr with %s unique queries, each repeating %s times, %s at a time." % (NUM_UNIQUE_CHECKS, NUM_REPEAT_CHECKS, concurrency) )
+        if engine == 'async':
+            async def repeatChecks(probeEngine, solrRequest):
+                return await doAsyncRepeatChecks(probeEngine, solrRequest, concurrency)
+            finalReport["data"].extend(AsyncProbeEngine(maxInFlight=concurrency).run(repeatChecks, solrRequests))
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [executor.submit(doRepeatChecks, solrRequest, concurrency) for solrRequest in solrRequests]
+                for future in futures:
+                    finalReport["data"].append(future.result())
+    else:
+        logging.info("Querying Solr with %s unique queries, each repeating %s times." % (NUM_UNIQUE_CHECKS, NUM_REPEAT_CHECKS) )
+        for solrRequest in solrRequests:
+            finalReport["data"].append(doRepeatChecks(solrRequest))
+    wallClockElapsed = time.perf_counter() - wallClockStart
 
     finalReport["summary"]["test end time"] = datetime.datetime.now()
 
@@ -127,57 +230,478 @@ def checkSolr():
     finalReport["summary"]["first (unique) time avg"] = finalReport["averagesSolrQTime"][0]
     finalReport["summary"]["last (cached) time avg"] = finalReport["averagesSolrQTime"][-1]
     finalReport["summary"]["environment"] = CLI_ARGUMENTS.SERVERCFG
+    # Throughput achieved at this level of concurrency or arrival rate
+    if rate:
+        finalReport["summary"]["concurrency"] = None
+        finalReport["summary"]["target rate"] = rate
+        finalReport["summary"]["arrival"] = arrival
+        # Latency from intended send time, which includes any time spent
+        # waiting behind a stalled server
+        latencies = [check["latency"] for queryResponses in finalReport["data"] for check in queryResponses]
+        finalReport["summary"]["latency avg"] = sum(latencies) / len(latencies)
+        finalReport["summary"]["latency max"] = max(latencies)
+    else:
+        finalReport["summary"]["concurrency"] = concurrency
+    finalReport["summary"]["engine"] = engine
+    finalReport["summary"]["requests"] = NUM_UNIQUE_CHECKS * NUM_REPEAT_CHECKS
+    finalReport["summary"]["wall clock time"] = wallClockElapsed
+    finalReport["summary"]["achieved qps"] = finalReport["summary"]["requests"] / wallClockElapsed
     finalReport["summary"]["environment uri"] = solr_end_point
-    
+    if QUERY_WORKLOAD is not None:
+        finalReport["summary"]["workload"] = QUERY_WORKLOAD.summary()
+    else:
+        finalReport["summary"]["term distribution"] = TERM_SAMPLER.parameters()
+
+    # Latency percentiles of the unique (1st) and cached (repeat) queries.
+    # The histograms are kept in the report so that runs can be merged.
+    histograms = {}
+    for queryResponses in finalReport["data"]:
+        for i, check in enumerate(queryResponses):
+            checkType = 'unique' if i == 0 else 'cached'
+            for field in ['realTime', 'solrQTime', 'latency']:
+                if field in check:
+                    histograms.setdefault(checkType + ' ' + field, LatencyHistogram()).record(check[field])
+    finalReport["latencyHistograms"] = histogramsToDict(histograms)
+    for name, histogram in histograms.items():
+        finalReport["summary"][name + " percentiles"] = histogram.summary()
+
     return finalReport
 
-class SamenessObserver:
-    """An object for watching a series of values to see if they stay the same.
-    If a fuzy match is required maxDeviation may be set to some tolerance.
-    
-    >>> myobserver = SamenessObserver(10)
-    >>> myobserver.check(9)
-    False
-    >>> myobserver.check(9)
-    True
-    >>> myobserver.check(9)
+def getSolrIndexStats():
+    """Size of the index at test time from Solr's luke handler, so latency
+    can be compared with index growth across runs.
+    """
+    response = http_client.get(solr_end_point + "admin/luke?numTerms=0&wt=json")
+    index = response.json()["index"]
+    return {
+        "numDocs": index.get("numDocs"),
+        "maxDoc": index.get("maxDoc"),
+        "deletedDocs": index.get("deletedDocs"),
+        "segmentCount": index.get("segmentCount"),
+    }
+
+def makeSolrRequest(phrase, urlParameters):
+    """Build a request in the same form as makeRandomeSolrQuery() from any set
+    of Solr parameters.
+    """
+    solrRequest = {}
+    solrRequest["phrase"] = phrase
+    solrQuery = "select?%s&wt=json" % urllib.parse.urlencode(urlParameters, doseq=True)
+    solrRequest["requestUrl"] = solr_end_point + solrQuery
+    return solrRequest
+
+def makeQueryResultCacheProbe():
+    """The same query twice: the repeat should come from the queryResultCache.
+    """
+    solrRequest = makeRandomeSolrQuery()
+    return solrRequest, solrRequest
+
+def makeFilterCacheProbe():
+    """The same request twice with a new filter query. The main query stays
+    the same but is kept out of the queryResultCache with cache=false, so any
+    speed-up on the repeat comes from the filterCache.
+    """
+    phrase = TERM_SAMPLER.phrase(1)
+    filterPhrase = TERM_SAMPLER.phrase(2)
+    solrRequest = makeSolrRequest(phrase + " | fq: " + filterPhrase, {
+        'q': '{!dismax cache=false}' + phrase,
+        'fq': '{!dismax}' + filterPhrase,
+    })
+    return solrRequest, solrRequest
+
+def isCacheHit(firstReport, repeatReport):
+    """Whether the repeat was served from a cache, or None if the first
+    request was already too fast to tell: QTime is in whole milliseconds, so
+    a first QTime at or below CACHE_HIT_MAX_QTIME is no cold-miss baseline.
+
+    >>> isCacheHit({"solrQTime": 40}, {"solrQTime": 3})
     True
-    >>> myobserver.check(10)
+    >>> isCacheHit({"solrQTime": 40}, {"solrQTime": 35})
     False
-    >>> myobserver.check(10)
+    >>> isCacheHit({"solrQTime": 1}, {"solrQTime": 0}) is None
     True
-    >>> myobserver.check(11)
-    False
-    >>> myobserver = SamenessObserver(10, 1)
-    >>> myobserver.check(11)
+    """
+    if firstReport["solrQTime"] <= CACHE_HIT_MAX_QTIME:
+        return None
+    return repeatReport["solrQTime"] <= max(CACHE_HIT_MAX_QTIME, CACHE_HIT_FRACTION * firstReport["solrQTime"])
+
+def summarizeCacheProbes(probeResults):
+    """probeResults maps a gap or delay to a list of (first, repeat) reports.
+    Pairs whose first request was too fast to be a cache miss are counted but
+    left out of the hit rate, which is None if no pair had a baseline.
+    """
+    summary = []
+    for key in sorted(probeResults):
+        pairs = probeResults[key]
+        hits = [isCacheHit(first, repeat) for first, repeat in pairs]
+        baselineHits = [hit for hit in hits if hit is not None]
+        summary.append({
+            "gap": key,
+            "probes": len(pairs),
+            "probes without a cold miss": len(pairs) - len(baselineHits),
+            "hit rate": sum(baselineHits) / len(baselineHits) if baselineHits else None,
+            "first solrQTime avg": statistics.mean([first["solrQTime"] for first, repeat in pairs]),
+            "repeat solrQTime avg": statistics.mean([repeat["solrQTime"] for first, repeat in pairs]),
+        })
+    return summary
+
+def estimateEffectiveCacheSize(gapSummary):
+    """The cache holds roughly as many entries as the largest gap (in
+    intervening unique queries) after which repeats still mostly hit.
+    Returns (lower, upper) bounds; upper is None if the largest gap tried still
+    hit. Gaps with no hit rate (no cold-miss baseline) are skipped.
+
+    >>> estimateEffectiveCacheSize([{"gap": 0, "hit rate": 1.0}, {"gap": 16, "hit rate": None}, {"gap": 64, "hit rate": 0.8}, {"gap": 256, "hit rate": 0.2}])
+    (64, 256)
+    """
+    lower = None
+    for gapResult in gapSummary:
+        if gapResult["hit rate"] is None:
+            continue
+        if gapResult["hit rate"] >= 0.5:
+            lower = gapResult["gap"]
+        else:
+            return lower, gapResult["gap"]
+    return lower, None
+
+def probeCacheByGap(makeProbe, gaps, probesPerGap):
+    """Send the first half of each probe, then its repeat after the given
+    number of other unique queries have gone by. Probes for different gaps are
+    interleaved so the whole sweep only needs max(gaps) filler queries.
+    """
+    probes = [(gap, makeProbe()) for i in range(probesPerGap) for gap in gaps]
+    repeatsDue = {}
+    probeResults = {gap: [] for gap in gaps}
+    position = 0
+    while probes or repeatsDue:
+        if probes:
+            gap, (firstRequest, repeatRequest) = probes.pop(0)
+            repeatsDue.setdefault(position + gap, []).append((gap, doCheck(firstRequest), repeatRequest))
+        else:
+            doCheck(makeRandomeSolrQuery())
+        for gap, firstReport, repeatRequest in repeatsDue.pop(position, []):
+            probeResults[gap].append((firstReport, doCheck(repeatRequest)))
+        position = position + 1
+    return probeResults
+
+def probeCacheByDelay(makeProbe, delays, probesPerDelay):
+    """Send the first half of each probe, then its repeat after the given
+    number of seconds with no other queries in between.
+    """
+    repeatsDue = []
+    for i in range(probesPerDelay):
+        for delay in delays:
+            firstRequest, repeatRequest = makeProbe()
+            repeatsDue.append((time.perf_counter() + delay, delay, doCheck(firstRequest), repeatRequest))
+    repeatsDue.sort(key=lambda repeatDue: repeatDue[0])
+    probeResults = {delay: [] for delay in delays}
+    for dueTime, delay, firstReport, repeatRequest in repeatsDue:
+        wait = dueTime - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        probeResults[delay].append((firstReport, doCheck(repeatRequest)))
+    return probeResults
+
+def getSolrCacheStats():
+    """Solr's own statistics for its caches from the mbeans handler, e.g.
+    size, lookups, hits, inserts and evictions. Newer Solrs prefix the stat
+    names (CACHE.searcher.queryResultCache.size) so only the last part is kept.
+    """
+    response = http_client.get(solr_end_point + "admin/mbeans?cat=CACHE&stats=true&wt=json")
+    mbeans = response.json()["solr-mbeans"]
+    # The response is a flat list of category name, then its beans
+    caches = dict(zip(mbeans[::2], mbeans[1::2]))["CACHE"]
+    cacheStats = {}
+    for cacheName in SOLR_CACHES:
+        if cacheName not in caches:
+            continue
+        stats = caches[cacheName].get("stats", {})
+        cacheStats[cacheName] = {statName.split('.')[-1]: value for statName, value in stats.items()}
+        cacheStats[cacheName]["description"] = caches[cacheName].get("description")
+    return cacheStats
+
+def cacheStatsDelta(before, after):
+    """Change in the counters between two getSolrCacheStats() calls.
+    """
+    delta = {}
+    for cacheName in after:
+        delta[cacheName] = {}
+        for statName in ["lookups", "hits", "inserts", "evictions"]:
+            if statName in after[cacheName] and statName in before.get(cacheName, {}):
+                delta[cacheName][statName] = after[cacheName][statName] - before[cacheName][statName]
+        delta[cacheName]["size"] = after[cacheName].get("size")
+    return delta
+
+def characterizeSolrCaches(gaps, delays, probes):
+    """Estimate how many entries Solr's query result and filter caches really
+    hold, and how long entries survive, by repeating earlier queries after a
+    controlled number of other unique queries or a controlled delay.
+    Document cache behaviour is taken from Solr's own statistics as QTime
+    can't separate it from the other caches.
+    """
+    cacheReport = {}
+    cacheReport["summary"] = {}
+    cacheReport["summary"]["test start time"] = datetime.datetime.now()
+    try:
+        statsBefore = getSolrCacheStats()
+    except (KeyError, ValueError):
+        logging.warning("Unable to read cache statistics from Solr's mbeans handler")
+        statsBefore = None
+
+    for cacheName, makeProbe in [("queryResultCache", makeQueryResultCacheProbe), ("filterCache", makeFilterCacheProbe)]:
+        logging.info("Probing %s with gaps of %s unique queries" % (cacheName, gaps))
+        gapSummary = summarizeCacheProbes(probeCacheByGap(makeProbe, gaps, probes))
+        logging.info("Probing %s with delays of %s seconds" % (cacheName, delays))
+        delaySummary = summarizeCacheProbes(probeCacheByDelay(makeProbe, delays, probes))
+        for delayResult in delaySummary:
+            delayResult["delay"] = delayResult.pop("gap")
+        lower, upper = estimateEffectiveCacheSize(gapSummary)
+        cacheReport[cacheName] = {
+            "by gap": gapSummary,
+            "by delay": delaySummary,
+            "effective size lower bound": lower,
+            "effective size upper bound": upper,
+        }
+        cacheReport["summary"][cacheName + " effective size"] = "%s to %s" % (lower, upper if upper is not None else "more")
+
+    statsAfter = None
+    if statsBefore is not None:
+        try:
+            statsAfter = getSolrCacheStats()
+        except (KeyError, ValueError):
+            logging.warning("Unable to read cache statistics from Solr's mbeans handler after the probes")
+    if statsAfter is not None:
+        cacheReport["solr cache stats"] = statsAfter
+        cacheReport["solr cache stats delta"] = cacheStatsDelta(statsBefore, statsAfter)
+        for cacheName, delta in cacheReport["solr cache stats delta"].items():
+            cacheReport["summary"][cacheName + " evictions"] = delta.get("evictions")
+
+    cacheReport["summary"]["test end time"] = datetime.datetime.now()
+    cacheReport["summary"]["environment"] = CLI_ARGUMENTS.SERVERCFG
+    cacheReport["summary"]["environment uri"] = solr_end_point
+    cacheReport["summary"]["term distribution"] = TERM_SAMPLER.parameters()
+    return cacheReport
+
+def makeOcrQuery(places, slop, fields):
+    """A phrase query with slop over the OCR fields, highlighted, with
+    per-component timing so query and highlight cost can be told apart.
+    """
+    phrase = TERM_SAMPLER.phrase(places)
+    return makeSolrRequest(phrase, {
+        'q': '"%s"~%s' % (phrase, slop),
+        'defType': 'edismax',
+        'qf': " ".join(fields),
+        'fl': 'PID',
+        'hl': 'true',
+        'hl.fl': ",".join(fields),
+        'hl.snippets': OCR_HIGHLIGHT_SNIPPETS,
+        'hl.fragsize': OCR_HIGHLIGHT_FRAGSIZE,
+        'debug': 'timing',
+    })
+
+def doOcrCheck(solrRequest):
+    """Like doCheck() but also splits QTime into the query and highlight
+    components and records how big the response and its highlighting are.
+    """
+    reportData = {}
+    reportData["datesStamp"] = datetime.datetime.now()
+    response = http_client.get(solrRequest['requestUrl'])
+    responseJson = response.json()
+    reportData["phrase"] = solrRequest['phrase']
+    reportData["solrQTime"] = responseJson["responseHeader"]["QTime"]
+    reportData["realTime"] = response.elapsed.total_seconds()
+    reportData["numFound"] = responseJson["response"]["numFound"]
+    componentTimes = responseJson.get("debug", {}).get("timing", {}).get("process", {})
+    reportData["queryTime"] = componentTimes.get("query", {}).get("time")
+    reportData["highlightTime"] = componentTimes.get("highlight", {}).get("time")
+    reportData["responseBytes"] = len(response.content)
+    reportData["highlightBytes"] = len(json.dumps(responseJson.get("highlighting", {})))
+    logging.debug("%s: QTime %s, highlight %s, %s bytes" % (reportData["phrase"], reportData["solrQTime"], reportData["highlightTime"], reportData["responseBytes"]))
+    return reportData
+
+def countOcrDocuments(fields):
+    """Number of documents with any OCR text, to follow as the OCR grows.
+    """
+    solrRequest = makeSolrRequest("OCR documents", {
+        'q': " OR ".join(["%s:[* TO *]" % field for field in fields]),
+        'rows': 0,
+    })
+    return http_client.get(solrRequest['requestUrl']).json()["response"]["numFound"]
+
+def checkOcr(fields, phraseLengths, slops, checks):
+    """Full-text benchmark of the OCR fields for each phrase length and slop.
+    Every phrase is unique so none of the results come from Solr's caches.
+    """
+    ocrReport = {}
+    ocrReport["summary"] = {}
+    ocrReport["summary"]["test start time"] = datetime.datetime.now()
+    ocrReport["summary"]["ocr fields"] = fields
+    ocrReport["summary"]["ocr documents"] = countOcrDocuments(fields)
+    ocrReport["variants"] = []
+    ocrReport["data"] = []
+    for places in phraseLengths:
+        for slop in slops:
+            logging.info("OCR phrases of %s words with slop %s" % (places, slop))
+            variantChecks = [doOcrCheck(makeOcrQuery(places, slop, fields)) for i in range(checks)]
+            ocrReport["data"].append(variantChecks)
+            def average(field):
+                values = [check[field] for check in variantChecks if check[field] is not None]
+                return statistics.mean(values) if values else None
+            ocrReport["variants"].append({
+                "phrase length": places,
+                "slop": slop,
+                "checks": len(variantChecks),
+                "solrQTime avg": average("solrQTime"),
+                "solrQTime max": max([check["solrQTime"] for check in variantChecks]),
+                "query time avg": average("queryTime"),
+                "highlight time avg": average("highlightTime"),
+                "realTime avg": average("realTime"),
+                "response bytes avg": average("responseBytes"),
+                "highlight bytes avg": average("highlightBytes"),
+                "numFound avg": average("numFound"),
+            })
+    allChecks = [check for variantChecks in ocrReport["data"] for check in variantChecks]
+    ocrReport["summary"]["solrQTime avg"] = statistics.mean([check["solrQTime"] for check in allChecks])
+    highlightTimes = [check["highlightTime"] for check in allChecks if check["highlightTime"] is not None]
+    ocrReport["summary"]["highlight time avg"] = statistics.mean(highlightTimes) if highlightTimes else None
+    ocrReport["summary"]["response bytes avg"] = statistics.mean([check["responseBytes"] for check in allChecks])
+    ocrReport["summary"]["test end time"] = datetime.datetime.now()
+    ocrReport["summary"]["environment"] = CLI_ARGUMENTS.SERVERCFG
+    ocrReport["summary"]["environment uri"] = solr_end_point
+    ocrReport["summary"]["term distribution"] = TERM_SAMPLER.parameters()
+    return ocrReport
+
+def writeReport(prefix, report):
+    """Write a report to output/ named after its start time and environment
+    and return the filename (without the directory).
+    """
+    outputFilename = prefix + report["summary"]["test start time"].strftime("%Y-%m-%d_%H-%M-%S-%f") + '_' + CLI_ARGUMENTS.SERVERCFG.strip() + ".json"
+    if CLI_ARGUMENTS.debug:
+        outputFilename = "DEBUG-" + outputFilename
+    outputFilenamePath = 'output/' + outputFilename
+    with open(outputFilenamePath, 'w') as fp:
+        json.dump(report, fp, indent=4, sort_keys=True, default=str)
+    logging.info("Data logged to %s" % outputFilenamePath)
+    return outputFilename
+
+def mannKendallZ(values):
+    """Mann-Kendall trend test statistic for a series of values. |Z| above
+    about 1.96 means a significant upward (positive) or downward (negative)
+    trend at the 5% level.
+
+    >>> mannKendallZ([1, 2, 3, 4, 5, 6, 7, 8]) > 1.96
     True
-    >>> myobserver.check(11)
+    >>> mannKendallZ([8, 7, 6, 5, 4, 3, 2, 1]) < -1.96
     True
-    >>> myobserver.check(10)
+    >>> abs(mannKendallZ([3, 1, 3, 2, 1, 3, 2, 1])) < 1.96
     True
-    >>> myobserver.check(12)
+    """
+    n = len(values)
+    s = 0
+    for i in range(n - 1):
+        for j in range(i + 1, n):
+            if values[j] > values[i]:
+                s = s + 1
+            elif values[j] < values[i]:
+                s = s - 1
+    # Correct the variance for tied values (QTimes are whole milliseconds)
+    ties = {}
+    for value in values:
+        ties[value] = ties.get(value, 0) + 1
+    variance = (n * (n - 1) * (2 * n + 5) - sum([t * (t - 1) * (2 * t + 5) for t in ties.values()])) / 18
+    if variance <= 0 or s == 0:
+        return 0.0
+    if s > 0:
+        return (s - 1) / math.sqrt(variance)
+    return (s + 1) / math.sqrt(variance)
+
+class WarmupDetector:
+    """Watches latency samples as they arrive and decides when they have
+    settled down. Latency is stable when, over the last windowSize samples,
+    there is no significant trend (Mann-Kendall) and the means of the older and
+    newer halves of the window are within maxDeviation (or relativeDeviation
+    of the mean, whichever is larger).
+
+    >>> detector = WarmupDetector(windowSize=10)
+    >>> [detector.check(value) for value in [90, 80, 70, 60, 50, 40, 30, 20, 15, 10]][-1]
     False
-    >>> myobserver.check(11)
+    >>> any([detector.check(value) for value in [5, 6, 5, 4, 5, 6, 5, 5, 4, 6, 5, 5]])
     True
-    >>> 
-
+    >>> detector.warmupSamples
+    9
     """
 
-    def __init__(self, initialValue, maxDeviation=0):
-        self.current = 0
-        self.previous = initialValue
+    def __init__(self, windowSize=WARMUP_WINDOW, maxDeviation=1, relativeDeviation=0.1, zCritical=1.96):
+        self.windowSize = windowSize
         self.maxDeviation = maxDeviation
+        self.relativeDeviation = relativeDeviation
+        self.zCritical = zCritical
+        self.window = collections.deque(maxlen=windowSize)
+        self.samples = 0
+        self.stable = False
+        self.warmupSamples = None
 
     def check(self, value):
-        self.current = value
-        sameness = (self.previous - self.maxDeviation) <= self.current <= (self.previous + self.maxDeviation)
-        self.previous = self.current
-        return sameness
+        self.samples = self.samples + 1
+        self.window.append(value)
+        if len(self.window) < self.windowSize:
+            return False
+        values = list(self.window)
+        half = self.windowSize // 2
+        olderMean = statistics.mean(values[:half])
+        newerMean = statistics.mean(values[half:])
+        tolerance = max(self.maxDeviation, self.relativeDeviation * statistics.mean(values))
+        self.stable = abs(newerMean - olderMean) <= tolerance and abs(mannKendallZ(values)) < self.zCritical
+        if self.stable and self.warmupSamples is None:
+            # The window that turned out stable doesn't count as warm-up
+            self.warmupSamples = self.samples - self.windowSize
+        return self.stable
+
+def warmUpSolr(maxSamples=WARMUP_MAX_SAMPLES):
+    """Send unique queries one at a time until Solr's QTime settles down.
+    Returns a record of the warm-up curve, which is a result in its own right.
+    """
+    detector = WarmupDetector()
+    warmupReport = {
+        "start time": datetime.datetime.now(),
+        "solrQTime curve": [],
+        "converged": False,
+    }
+    warmupStart = time.perf_counter()
+    while detector.samples < maxSamples:
+        singleCheckReport = doCheck(makeRandomeSolrQuery())
+        warmupReport["solrQTime curve"].append(singleCheckReport["solrQTime"])
+        if detector.check(singleCheckReport["solrQTime"]):
+            warmupReport["converged"] = True
+            break
+        if detector.samples % detector.windowSize == 0:
+            logging.info("Solr QTime after %s queries: %s" % (detector.samples, statistics.mean(detector.window)))
+    warmupReport["seconds"] = time.perf_counter() - warmupStart
+    warmupReport["samples"] = detector.samples
+    warmupReport["warm-up samples"] = detector.warmupSamples if detector.stable else detector.samples
+    return warmupReport
 
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser(description=description)
     argparser.add_argument("--debug", action='store_true', help="Go into debug mode -- fewer unique queries, more verbosity, write to files labeled with 'DEBUG'")
     argparser.add_argument("--dry-run", action='store_true', help="Do not write out json report file")
+    argparser.add_argument("--concurrency", default=1, type=int, help="Number of unique queries to run against Solr at the same time. Default 1 (one after another).")
+    argparser.add_argument("--rate", help="Send requests open-loop at this rate, e.g. '50/s' or '300/m', whether or not earlier requests have finished. Overrides --concurrency.")
+    argparser.add_argument("--arrival", default="fixed", choices=["fixed", "poisson"], help="How to space requests when --rate is given. Default fixed intervals.")
+    argparser.add_argument("--engine", default="threads", choices=["threads", "async"], help="Run concurrent or open-loop (--rate) requests in a thread each, or as coroutines on the asyncio probe engine (needs aiohttp) to get thousands in flight from one process. Default threads.")
+    argparser.add_argument("--results-db", default=RESULTS_DB, help="SQLite database to append every sample to. Default %s" % RESULTS_DB)
+    argparser.add_argument("--pool-size", type=int, help="Number of keep-alive connections to keep open to Solr. Default is %s or the concurrency, whichever is larger, or %s with --rate." % (http_client.POOL_SIZE, MAX_IN_FLIGHT))
+    argparser.add_argument("--workload", help="Generate queries from a query mix model built from access logs by query_workload.py instead of random five word phrases")
+    argparser.add_argument("--term-distribution", default="uniform", choices=DISTRIBUTIONS, help="How to pick words for random phrases: uniformly, by Zipf's law over their rank in the common words list, or empirically from --term-frequencies. Default uniform.")
+    argparser.add_argument("--zipf-s", type=float, default=1.0, help="Exponent for --term-distribution zipf. Default 1.0")
+    argparser.add_argument("--term-frequencies", help="File of 'word count' lines for --term-distribution empirical")
+    argparser.add_argument("--cache-suite", action='store_true', help="Instead of the usual test, estimate the effective size and eviction behaviour of Solr's caches by repeating queries after controlled gaps and delays")
+    argparser.add_argument("--cache-gaps", default=",".join([str(gap) for gap in CACHE_GAPS]), help="Numbers of intervening unique queries for --cache-suite. Default %s" % ",".join([str(gap) for gap in CACHE_GAPS]))
+    argparser.add_argument("--cache-delays", default=",".join([str(delay) for delay in CACHE_DELAYS]), help="Delays in seconds for --cache-suite. Default %s" % ",".join([str(delay) for delay in CACHE_DELAYS]))
+    argparser.add_argument("--ocr", action='store_true', help="Instead of the usual test, benchmark full-text search of the OCR fields with highlighting, phrase slop and long phrases")
+    argparser.add_argument("--ocr-field", action='append', help="OCR field to search for --ocr. May be given more than once. Default %s" % ",".join(OCR_FIELDS))
+    argparser.add_argument("--ocr-phrase-lengths", default=",".join([str(places) for places in OCR_PHRASE_LENGTHS]), help="Phrase lengths in words for --ocr. Default %s" % ",".join([str(places) for places in OCR_PHRASE_LENGTHS]))
+    argparser.add_argument("--ocr-slops", default=",".join([str(slop) for slop in OCR_SLOPS]), help="Phrase slops for --ocr. Default %s" % ",".join([str(slop) for slop in OCR_SLOPS]))
     argparser.add_argument("SERVERCFG", default="PROD", help="Name of the server configuration section e.g. 'PROD' or 'STAGE'. Edit islandora.cfg to add a server configuration section.")
     CLI_ARGUMENTS = argparser.parse_args()
 
@@ -187,51 +711,89 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.INFO)
 
-    SECTION = CLI_ARGUMENTS.SERVERCFG
-    CONFIG_DATA = configparser.ConfigParser()
+    if CLI_ARGUMENTS.rate:
+        try:
+            RATE = parseRate(CLI_ARGUMENTS.rate)
+        except ValueError as e:
+            logging.error(e)
+            exit(1)
+    else:
+        RATE = None
 
     try:
-        CONFIG_DATA.read_file(open(CONFIGFILE), source=CONFIGFILE)
-    except FileNotFoundError:
-        logging.error('No configuration file found. Configuration file required. Please make a config file called %s.' % CONFIGFILE)
-        exit(1)
-        
-    try:
-        SERVER_CONFIG = CONFIG_DATA[SECTION]
-    except KeyError:
-        print("'%s' section not present in configuration file %s" % (SECTION, CONFIGFILE))
+        TERM_SAMPLER = makeTermSampler(commonEnglishWordS, CLI_ARGUMENTS.term_distribution, CLI_ARGUMENTS.zipf_s, CLI_ARGUMENTS.term_frequencies)
+    except (OSError, ValueError) as e:
+        logging.error(e)
         exit(1)
-    
-    #protocol_host_port = "http://compass-fedora-prod.fivecolleges.edu:8080"
-    protocol_host_port = SERVER_CONFIG['solr_protocol'] + "://" + SERVER_CONFIG['solr_hostname'] + ":" + SERVER_CONFIG['solr_port']
-    solr_core_path = SERVER_CONFIG['solr_core_path']
-    solr_end_point = protocol_host_port + solr_core_path
+
+    if CLI_ARGUMENTS.engine == 'async':
+        try:
+            requireAiohttp()
+        except RuntimeError as e:
+            logging.error(e)
+            exit(1)
+
+    if CLI_ARGUMENTS.workload:
+        QUERY_WORKLOAD = loadWorkload(CLI_ARGUMENTS.workload)
+        logging.info("Generating queries from %s (%s searches)" % (CLI_ARGUMENTS.workload, QUERY_WORKLOAD.queries))
+
+    # Open-loop runs can have up to MAX_IN_FLIGHT requests out at once; each
+    # one past the pool size would pay for a new handshake
+    http_client.configurePool(CLI_ARGUMENTS.pool_size or max(http_client.POOL_SIZE, CLI_ARGUMENTS.concurrency, MAX_IN_FLIGHT if CLI_ARGUMENTS.rate else 0))
+
+    SERVER_CONFIG = loadServerConfig(CLI_ARGUMENTS.SERVERCFG)
+    solr_end_point = solrEndPoint(SERVER_CONFIG)
     
     logging.info("Warming up Solr")
-    
-    previousQTime = 0
-    coldFinalReport = checkSolr()
-    firstQTime = coldFinalReport["summary"]['first (unique) time avg']
-    logging.info("Solr QTime: %s" % firstQTime)
-    isTheSame = SamenessObserver(firstQTime, 1)
-    solrQTime = 0
-    while not isTheSame.check(solrQTime):
-        time.sleep(60)
-        coldFinalReport = checkSolr()
-        solrQTime = coldFinalReport["summary"]['first (unique) time avg']
-        logging.info("Solr QTime: %s" % solrQTime)
-
-    logging.info("Solr warmed up. Recording results.")
-
-    finalReport = coldFinalReport
+
+    warmupReport = warmUpSolr()
+    if warmupReport["converged"]:
+        logging.info("Solr warmed up after %s queries (%.1f seconds). Recording results." % (warmupReport["warm-up samples"], warmupReport["seconds"]))
+    else:
+        logging.warning("Solr QTime still not stable after %s queries. Recording results anyway." % warmupReport["samples"])
+
+    if CLI_ARGUMENTS.cache_suite:
+        cacheGaps = [int(gap) for gap in CLI_ARGUMENTS.cache_gaps.split(',')]
+        cacheDelays = [float(delay) for delay in CLI_ARGUMENTS.cache_delays.split(',')]
+        cacheReport = characterizeSolrCaches(cacheGaps, cacheDelays, 1 if CLI_ARGUMENTS.debug else CACHE_PROBES)
+        pprint.pprint(cacheReport["summary"])
+        if not CLI_ARGUMENTS.dry_run:
+            # Not named solr* so make-solr-report.py doesn't pick it up
+            writeReport('caches-solr-', cacheReport)
+        exit(0)
+
+    if CLI_ARGUMENTS.ocr:
+        ocrFields = CLI_ARGUMENTS.ocr_field or OCR_FIELDS
+        ocrPhraseLengths = [int(places) for places in CLI_ARGUMENTS.ocr_phrase_lengths.split(',')]
+        ocrSlops = [int(slop) for slop in CLI_ARGUMENTS.ocr_slops.split(',')]
+        ocrReport = checkOcr(ocrFields, ocrPhraseLengths, ocrSlops, 2 if CLI_ARGUMENTS.debug else OCR_CHECKS)
+        pprint.pprint(ocrReport["summary"])
+        for variant in ocrReport["variants"]:
+            logging.info("%(phrase length)3s words, slop %(slop)3s: QTime %(solrQTime avg)8.1f ms, highlight %(highlight time avg)s ms, %(response bytes avg)9.0f bytes" % variant)
+        if not CLI_ARGUMENTS.dry_run:
+            writeReport('ocr-solr-', ocrReport)
+        exit(0)
+
+    finalReport = checkSolr(CLI_ARGUMENTS.concurrency, RATE, CLI_ARGUMENTS.arrival, CLI_ARGUMENTS.engine)
+    try:
+        indexStats = getSolrIndexStats()
+        finalReport["summary"]["index numDocs"] = indexStats["numDocs"]
+        finalReport["summary"]["index segment count"] = indexStats["segmentCount"]
+        finalReport["index"] = indexStats
+    except (KeyError, ValueError):
+        logging.warning("Unable to read index size from Solr's luke handler")
+    finalReport["warmup"] = warmupReport
+    finalReport["summary"]["warm-up converged"] = warmupReport["converged"]
+    finalReport["summary"]["warm-up samples"] = warmupReport["warm-up samples"]
+    finalReport["summary"]["warm-up seconds"] = warmupReport["seconds"]
     pprint.pprint(finalReport["summary"])
 
     if not CLI_ARGUMENTS.dry_run:
-        outputFilename = 'solr-' + finalReport["summary"]["test start time"].strftime("%Y-%m-%d_%H-%M-%S-%f") + '_' + CLI_ARGUMENTS.SERVERCFG.strip() + ".json"
-        if CLI_ARGUMENTS.debug:
-            outputFilename = "DEBUG-" + outputFilename
-        outputFilenamePath = 'output/' + outputFilename
-        with open(outputFilenamePath, 'w') as fp:
-            json.dump(finalReport, fp, indent=4, sort_keys=True, default=str)
-
-        logging.info("Data logged to %s" % outputFilenamePath)
+        outputFilename = writeReport('solr-', finalReport)
+
+        # Debug runs stay out of the results database so they can't skew reports
+        if not CLI_ARGUMENTS.debug:
+            resultsStore = ResultsStore(CLI_ARGUMENTS.results_db)
+            resultsStore.addRun(runIdFromFilename(outputFilename), finalReport)
+            resultsStore.close()
+            logging.info("Samples added to %s" % CLI_ARGUMENTS.results_db)
@@ -1,18 +1,37 @@
-description = """Compare object page query times between STAGE and PROD.
+description = """Compare object page query times between environments, STAGE and PROD by
+default.
 
 $ curl "http://compass-fedora-stage.fivecolleges.edu:8080/solr/collection1/select?q=RELS_EXT_hasModel_uri_s%3A+%22info%3Afedora%2Fislandora%3AbookCModel%22&rows=3000&fl=PID&wt=json&indent=true" > stagebooks-`date +%s`.json
 
 $ python3 compare_prodVstage_object_page_query_times.py stagebooks-1572891400.json --historyfile book-history.json --multiple 300 --report-file output.csv
 
+Any sections of islandora.cfg can be compared in one run, e.g. a candidate
+server against PROD and STAGE before a cutover:
+
+$ python3 compare_prodVstage_object_page_query_times.py stagebooks-1572891400.json --environments DEV,STAGE,PROD --multiple 300 --matrix-file matrix.json
+
+Each object's page is requested from every environment at the same moment
+(--order sequential requests them one after another in the order given, which
+lets the first warm caches the others then benefit from; --order random
+shuffles that order for each object) and --parallel runs several objects at
+once. The run ends with a matrix of per-environment latency percentiles and,
+for each environment against the baseline (the last one listed), a bootstrap
+confidence interval of the duration ratio and a Wilcoxon signed-rank test.
 """
-from get_fresh_pid import QueryHistory, getFreshObjectUrl, loadPidList
+from get_fresh_pid import QueryHistory, FreshObjectSampler, ObjectsExhausted, loadPidList, pidsOf
 import argparse
-import configparser
 import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta
 from datetime import datetime
-import requests
+import http_client
 import csv
+import json
+from latency_histogram import LatencyHistogram, histogramsToDict, SUMMARY_PERCENTILES
+from paired_stats import pairedComparison, describeComparison, BOOTSTRAP_RESAMPLES, CONFIDENCE
+from server_config import loadServerConfig, configuredSections, drupalEndPoint
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 
@@ -20,100 +39,205 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 # c.f. https://docs.python.org/3/library/datetime.html#timedelta-objects
 MIN_OBJECT_URL_STALENESS = timedelta(hours=24)
 
-argparser = argparse.ArgumentParser(description=description)
+ORDERS = ['simultaneous', 'sequential', 'random']
+
+DEFAULT_ENVIRONMENTS = "STAGE,PROD"
+
+# Columns recorded for each environment, prefixed with its lower-cased name
+# (stageUrl, prodSeconds, ...)
+ENVIRONMENT_COLUMNS = [
+    'Url',
+    'Duration',
+    'Seconds',
+    'Ratio',
+    'ConnectTime',
+    'TlsTime',
+    'TimeToFirstByte',
+    'XDrupalCache',
+    'CacheControl',
+    'Headers',
+]
+
+argparser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
 argparser.add_argument("--dry-run", action='store_true', help="Don't do the query, just print the URLs and mark them as used")
 argparser.add_argument("PIDLISTFILE", help="List of PIDs to draw from. Standard Solr json output including PID field.")
 argparser.add_argument("--historyfile", default="queryhistory.json", help="Name of file to record what queries were made when.")
-argparser.add_argument("--multiple", default=1, type=int, help="Number of pairs of objects to run the test on")
+argparser.add_argument("--environments", default=DEFAULT_ENVIRONMENTS, help="Comma separated islandora.cfg sections to compare. The last is the baseline the others are compared to. Default %s." % DEFAULT_ENVIRONMENTS)
+argparser.add_argument("--multiple", default=1, type=int, help="Number of objects to run the test on")
 argparser.add_argument("--report-file", help="file to write report to")
+argparser.add_argument("--histogram-file", help="Write latency histograms to this json file so they can be merged with other runs using latency_histogram.py")
+argparser.add_argument("--matrix-file", help="Write the per-environment percentiles and comparisons with the baseline to this json file")
+argparser.add_argument("--pool-size", default=http_client.POOL_SIZE, type=int, help="Number of keep-alive connections to keep open to each server. Default %s." % http_client.POOL_SIZE)
+argparser.add_argument("--order", default="simultaneous", choices=ORDERS, help="How to send the requests for one object: to every environment at the same moment (simultaneous, the default), one after another in the order given (sequential), or one after another in random order")
+argparser.add_argument("--parallel", default=1, type=int, help="Number of objects to run at once. Default 1.")
+argparser.add_argument("--confidence", default=CONFIDENCE, type=float, help="Confidence level of the duration ratio intervals. Default %s." % CONFIDENCE)
+argparser.add_argument("--bootstrap-resamples", default=BOOTSTRAP_RESAMPLES, type=int, help="Bootstrap resamples for the ratio intervals. Default %s." % BOOTSTRAP_RESAMPLES)
 
 cliArguments = argparser.parse_args()
 
-configData = configparser.ConfigParser()
+class Environment:
+    """One islandora.cfg section to request object pages from.
+    """
+    def __init__(self, section):
+        self.section = section
+        self.name = section.lower()
+        self.objectEndPoint = drupalEndPoint(loadServerConfig(section))
+
+    def url(self, pid):
+        return self.objectEndPoint + pid
 
 class Report:
-    def __init__(self):
+    def __init__(self, environments):
+        self.environments = environments
+        self.baseline = environments[-1]
         self.data = []
+        self.histograms = {environment.name + 'Duration': LatencyHistogram() for environment in environments}
     def log(self, logEntry):
         self.data.append(logEntry)
+        for environment in self.environments:
+            self.histograms[environment.name + 'Duration'].record(logEntry[environment.name + 'Seconds'])
+    def comparisons(self):
+        """Paired comparison of each environment's durations with the
+        baseline's.
+        """
+        baselineSeconds = [logEntry[self.baseline.name + 'Seconds'] for logEntry in self.data]
+        return {
+            environment.section: pairedComparison(
+                [logEntry[environment.name + 'Seconds'] for logEntry in self.data],
+                baselineSeconds,
+                cliArguments.bootstrap_resamples,
+                cliArguments.confidence,
+            )
+            for environment in self.environments if environment is not self.baseline
+        }
+    def matrix(self):
+        """Percentiles of each environment's page durations, one row each.
+        """
+        return {environment.section: self.histograms[environment.name + 'Duration'].summary() for environment in self.environments}
+    def formatMatrix(self):
+        columns = ['count', 'mean'] + ['p%s' % percentile for percentile in SUMMARY_PERCENTILES] + ['max']
+        width = max([len(environment.section) for environment in self.environments] + [len('seconds')])
+        lines = [" ".join(["seconds".ljust(width)] + [column.rjust(9) for column in columns])]
+        for section, summary in self.matrix().items():
+            lines.append(" ".join([section.ljust(width)] + [("%d" % summary[column] if column == 'count' else "%.4f" % summary[column]).rjust(9) for column in columns]))
+        return "\n".join(lines)
+    def writeHistograms(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump(histogramsToDict(self.histograms), fp, indent=4, sort_keys=True)
+    def writeMatrix(self, filename, comparisons):
+        with open(filename, 'w') as fp:
+            json.dump({
+                'environments': [environment.section for environment in self.environments],
+                'baseline': self.baseline.section,
+                'objects': len(self.data),
+                'order': cliArguments.order,
+                'percentiles': self.matrix(),
+                'comparisons': comparisons,
+            }, fp, indent=4, sort_keys=True)
     def write(self, filename):
+        fieldnames = ['timeStamp', 'order']
+        if len(self.environments) == 2:
+            fieldnames.append('durationRatio')
+        fieldnames.extend([environment.name + column for environment in self.environments for column in ENVIRONMENT_COLUMNS])
         with open(filename, 'w') as fp:
-            csvWriter = csv.DictWriter(fp, [
-                'timeStamp',
-                'stageUrl',
-                'stageDuration',
-                'prodUrl',
-                'prodDuration',
-                'durationRatio',
-                'stageXDrupalCache',
-                'stageCacheControl',
-                'prodXDrupalCache',
-                'prodCacheControl',
-                'stageHeaders',
-                'prodHeaders',
-            ])
+            csvWriter = csv.DictWriter(fp, fieldnames)
             csvWriter.writeheader()
             csvWriter.writerows(self.data)
 
-def queryTimer(url):
-    queryHistory.recordQuery(url)
+def queryTimer(url, startTogether=None):
+    if startTogether is not None:
+        startTogether.wait()
     requestStart = datetime.now()
-    request = requests.get(url, allow_redirects=True)
+    request = http_client.get(url, allow_redirects=True)
     transferElapsedTime = datetime.now()-requestStart
-    return {'transferElapsedTime': transferElapsedTime, 'headers': request.headers}
+    return {'transferElapsedTime': transferElapsedTime, 'headers': request.headers, 'timings': request.timings}
 
-def runComparativeQueries(stageUrl, prodUrl):
+def runComparativeQueries(environments, pid, order='simultaneous'):
     logEntry = {}
     logEntry['timeStamp'] = datetime.now()
-    stageQueryTimerReport = queryTimer(stageUrl)
-    stageDuration = stageQueryTimerReport['transferElapsedTime']
-    prodQueryTimerReport = queryTimer(prodUrl)
-    prodDuration = prodQueryTimerReport['transferElapsedTime']
-    logEntry['durationRatio'] = str(stageDuration / prodDuration)
-
-    logEntry['stageUrl'] = stageUrl
-    logEntry['stageDuration'] = str(stageDuration)
-    try:
-        logEntry['stageXDrupalCache'] = stageQueryTimerReport['headers']['X-Drupal-Cache']
-    except:
-        logEntry['stageXDrupalCache'] = ''
-    try:
-        logEntry['stageCacheControl'] = stageQueryTimerReport['headers']['Cache-Control']
-    except:
-        logEntry['stageCacheControl'] = ''
-    logEntry['stageHeaders'] = str(stageQueryTimerReport['headers'])
-
-    logEntry['prodUrl'] = prodUrl
-    logEntry['prodDuration'] = str(prodDuration)
-    try:
-        logEntry['prodXDrupalCache'] = prodQueryTimerReport['headers']['X-Drupal-Cache']
-    except:
-        logEntry['prodXDrupalCache'] = ''
-    try:
-        logEntry['prodCacheControl'] = prodQueryTimerReport['headers']['Cache-Control']
-    except:
-        logEntry['prodCacheControl'] = ''
-    logEntry['prodHeaders'] = str(prodQueryTimerReport['headers'])
+    reports = {}
+    if order == 'simultaneous':
+        # All the threads wait at the barrier so the requests go out together
+        startTogether = threading.Barrier(len(environments))
+        futures = {environment.name: queryExecutor.submit(queryTimer, environment.url(pid), startTogether) for environment in environments}
+        reports = {name: future.result() for name, future in futures.items()}
+        logEntry['order'] = 'simultaneous'
+    else:
+        requestOrder = list(environments)
+        if order == 'random':
+            random.shuffle(requestOrder)
+        for environment in requestOrder:
+            reports[environment.name] = queryTimer(environment.url(pid))
+        logEntry['order'] = " ".join([environment.section for environment in requestOrder])
+
+    baselineDuration = reports[environments[-1].name]['transferElapsedTime']
+    if len(environments) == 2:
+        logEntry['durationRatio'] = str(reports[environments[0].name]['transferElapsedTime'] / baselineDuration)
+    for environment in environments:
+        queryTimerReport = reports[environment.name]
+        duration = queryTimerReport['transferElapsedTime']
+        logEntry[environment.name + 'Url'] = environment.url(pid)
+        logEntry[environment.name + 'Duration'] = str(duration)
+        logEntry[environment.name + 'Seconds'] = duration.total_seconds()
+        logEntry[environment.name + 'Ratio'] = duration / baselineDuration
+        logEntry[environment.name + 'ConnectTime'] = queryTimerReport['timings']['connect']
+        logEntry[environment.name + 'TlsTime'] = queryTimerReport['timings']['tls']
+        logEntry[environment.name + 'TimeToFirstByte'] = queryTimerReport['timings']['timeToFirstByte']
+        logEntry[environment.name + 'XDrupalCache'] = queryTimerReport['headers'].get('X-Drupal-Cache', '')
+        logEntry[environment.name + 'CacheControl'] = queryTimerReport['headers'].get('Cache-Control', '')
+        logEntry[environment.name + 'Headers'] = str(queryTimerReport['headers'])
 
     return logEntry
 
 if __name__ == "__main__":
-    report = Report()
+    sections = [section.strip() for section in cliArguments.environments.split(',') if section.strip()]
+    if len(sections) < 2 or len(set(sections)) != len(sections):
+        argparser.error("--environments needs at least two different sections of islandora.cfg, e.g. %s. Configured: %s" % (DEFAULT_ENVIRONMENTS, ",".join(configuredSections())))
+    environments = [Environment(section) for section in sections]
+
+    http_client.configurePool(max(cliArguments.pool_size, cliArguments.parallel))
+    report = Report(environments)
     mylist = loadPidList(cliArguments.PIDLISTFILE)
     queryHistory = QueryHistory(cliArguments.historyfile)
-
-    for i in range(0, cliArguments.multiple):
-        path = getFreshObjectUrl(queryHistory, mylist, '/object/', MIN_OBJECT_URL_STALENESS)
-        stageUrl = "https://compass-stage.fivecolleges.edu" + path
-        prodUrl = "https://compass.fivecolleges.edu" + path
-
-        if not cliArguments.dry_run:
-            logEntry = runComparativeQueries(stageUrl, prodUrl)
-            report.log(logEntry)
-            report.write(cliArguments.report_file)
-        else:
-            if cliArguments.multiple > 1:
-                print(stageUrl + ',' + prodUrl)
+    sampler = FreshObjectSampler(queryHistory, pidsOf(mylist), '%s', MIN_OBJECT_URL_STALENESS)
+    # Runs the requests of simultaneous objects, one thread per environment
+    queryExecutor = ThreadPoolExecutor(max_workers=len(environments) * cliArguments.parallel)
+
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=cliArguments.parallel) as objectExecutor:
+        objects = []
+        for i in range(0, cliArguments.multiple):
+            try:
+                pid = sampler.pick()
+            except ObjectsExhausted as e:
+                logging.error("FAIL %s" % e)
+                exhausted = True
+                break
+
+            if not cliArguments.dry_run:
+                objects.append(objectExecutor.submit(runComparativeQueries, environments, pid, cliArguments.order))
             else:
-                print(stageUrl)
-                print(prodUrl)
+                urls = [environment.url(pid) for environment in environments]
+                if cliArguments.multiple > 1:
+                    print(','.join(urls))
+                else:
+                    print('\n'.join(urls))
+
+        # Objects already picked are still run and reported if the objects ran out
+        for future in as_completed(objects):
+            report.log(future.result())
+            if cliArguments.report_file:
+                report.write(cliArguments.report_file)
+    queryExecutor.shutdown()
+
+    if report.data:
+        print(report.formatMatrix())
+        comparisons = report.comparisons()
+        for section, comparison in comparisons.items():
+            print(describeComparison(comparison, section, report.baseline.section))
+        if cliArguments.histogram_file:
+            report.writeHistograms(cliArguments.histogram_file)
+        if cliArguments.matrix_file:
+            report.writeMatrix(cliArguments.matrix_file, comparisons)
+    if exhausted:
+        exit(1)
@@ -7,72 +7,313 @@ $ python3 get_fresh_pid.py devbooks-1572882275.json DEV
 https://compass-dev.fivecolleges.edu/islandora/object/islandora:7381
 """
 
+import os
 import json
 import random
+import heapq
+import array
+import sqlite3
+import threading
 from datetime import datetime
 from datetime import timedelta
 import logging
 import argparse
-import configparser
+from pid_index import PidIndex, PID_INDEX_EXTENSION
+from server_config import loadServerConfig, drupalEndPoint
 
 # in format timedelta(days=0, seconds=0, microseconds=0, milliseconds=0, minutes=0, hours=0, weeks=0)
 # c.f. https://docs.python.org/3/library/datetime.html#timedelta-objects
 MIN_OBJECT_URL_STALENESS = timedelta(hours=24)
 
-CONFIGFILE = "islandora.cfg"
+DATESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+QUERY_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    url TEXT PRIMARY KEY,
+    lastUsed TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS historyByLastUsed ON history (lastUsed);
+CREATE TABLE IF NOT EXISTS imports (
+    filename TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+"""
+
+def _formatDateStamp(dateStamp):
+    # Always include microseconds so stored datestamps sort as text
+    return dateStamp.strftime(DATESTAMP_FORMAT)
+
+def _parseDateStamp(dateStamp):
+    try:
+        return datetime.strptime(dateStamp, DATESTAMP_FORMAT)
+    except ValueError:
+        # str(datetime) leaves off the microseconds when there aren't any
+        return datetime.strptime(dateStamp, '%Y-%m-%d %H:%M:%S')
+
+class ObjectsExhausted(Exception):
+    """Every object has been used too recently. nextEligible is when the
+    first one becomes fresh again (None if there are no objects at all).
+    """
+    def __init__(self, nextEligible):
+        self.nextEligible = nextEligible
+        super().__init__("Exhausted available list of objects. Next object is fresh at %s" % nextEligible)
+
+class FreshObjectSampler:
+    """Picks objects at random from those that haven't been used in max_age.
+
+    Fresh objects are kept at the front of an array of positions (random pick
+    and removal in O(1)) and the rest in a heap ordered by when they were last
+    used, so that they can be moved back to the fresh part in O(log n) once
+    they are old enough. Picking an object records it in the query history.
+
+    pids is a sequence of PID strings, e.g. a list or PidIndex.pids. Only the
+    recently used part of the history is read when starting up, and with a
+    PidIndex the PIDs themselves are only read when picked.
+
+    urlTemplate is the URL with '%s' in place of the PID.
+
+    >>> import tempfile
+    >>> queryHistory = QueryHistory(os.path.join(tempfile.mkdtemp(), 'history.sqlite'))
+    >>> sampler = FreshObjectSampler(queryHistory, ['yc:1', 'yc:2', 'yc:1'], 'https://compass/%s/view', timedelta(hours=1))
+    >>> sampler.freshCount()
+    2
+    >>> sorted([sampler.pick(), sampler.pick()])
+    ['https://compass/yc:1/view', 'https://compass/yc:2/view']
+    >>> 'https://compass/yc:1/view' in queryHistory
+    True
+    >>> try:
+    ...     sampler.pick()
+    ... except ObjectsExhausted as e:
+    ...     e.nextEligible > datetime.now()
+    True
+
+    A new sampler leaves out what the history says was used within max_age:
+
+    >>> queryHistory.recordQuery('https://compass/yc:3/view', datetime.now() - timedelta(hours=2))
+    >>> FreshObjectSampler(queryHistory, ['yc:1', 'yc:2', 'yc:3'], 'https://compass/%s/view', timedelta(hours=1)).pick()
+    'https://compass/yc:3/view'
+
+    and a used object becomes fresh again once max_age has gone by:
+
+    >>> import time
+    >>> sampler = FreshObjectSampler(queryHistory, ['yc:4'], 'https://compass/%s/view', timedelta(milliseconds=50))
+    >>> sampler.pick()
+    'https://compass/yc:4/view'
+    >>> sampler.freshCount()
+    0
+    >>> time.sleep(0.1)
+    >>> sampler.freshCount(), sampler.pick()
+    (1, 'https://compass/yc:4/view')
+    >>> queryHistory.close()
+    """
+    def __init__(self, queryHistory, pids, urlTemplate, max_age):
+        indexOf = getattr(pids, 'indexOf', None)
+        if indexOf is None:
+            pids = list(dict.fromkeys(pids))
+            indexOf = {pid: i for i, pid in enumerate(pids)}.get
+        self.queryHistory = queryHistory
+        self.pids = pids
+        self.urlTemplate = urlTemplate
+        self.max_age = max_age
+        # self.fresh[:self.freshSize] are the fresh objects, and
+        # self.position says where each object is in self.fresh
+        self.fresh = array.array('q', range(len(pids)))
+        self.position = array.array('q', range(len(pids)))
+        self.freshSize = len(pids)
+        self.waiting = []
+        urlPrefix, urlSuffix = urlTemplate.split('%s')
+        for url, dateStamp in queryHistory.usedSince(datetime.now() - max_age):
+            if not (url.startswith(urlPrefix) and url.endswith(urlSuffix)):
+                continue
+            i = indexOf(url[len(urlPrefix):len(url) - len(urlSuffix)])
+            if i is not None:
+                self._removeFresh(i)
+                self.waiting.append((dateStamp, i))
+        heapq.heapify(self.waiting)
+        logging.debug("%s fresh objects, %s used within %s" % (self.freshSize, len(self.waiting), max_age))
+
+    def _removeFresh(self, i):
+        # Swap with the last fresh object and shrink the fresh part
+        self._swap(self.position[i], self.freshSize - 1)
+        self.freshSize = self.freshSize - 1
+
+    def _addFresh(self, i):
+        self._swap(self.position[i], self.freshSize)
+        self.freshSize = self.freshSize + 1
+
+    def _swap(self, a, b):
+        self.fresh[a], self.fresh[b] = self.fresh[b], self.fresh[a]
+        self.position[self.fresh[a]] = a
+        self.position[self.fresh[b]] = b
+
+    def _promote(self):
+        cutoff = datetime.now() - self.max_age
+        while self.waiting and self.waiting[0][0] < cutoff:
+            dateStamp, i = heapq.heappop(self.waiting)
+            self._addFresh(i)
+
+    def freshCount(self):
+        self._promote()
+        return self.freshSize
+
+    def nextEligible(self):
+        """When the next used object becomes fresh again.
+        """
+        if not self.waiting:
+            return None
+        return self.waiting[0][0] + self.max_age
+
+    def pick(self):
+        """Return the URL of a fresh object and mark it used. Raises
+        ObjectsExhausted if there aren't any.
+        """
+        self._promote()
+        if self.freshSize == 0:
+            raise ObjectsExhausted(self.nextEligible())
+        i = self.fresh[random.randrange(self.freshSize)]
+        self._removeFresh(i)
+        downloadUrl = self.urlTemplate % self.pids[i]
+        dateStamp = datetime.now()
+        self.queryHistory.recordQuery(downloadUrl, dateStamp)
+        heapq.heappush(self.waiting, (dateStamp, i))
+        return downloadUrl
+
+def pidsOf(pidList):
+    """Just the PIDs of a list of Solr docs, without copying them out of a
+    PidIndex."""
+    if isinstance(pidList, PidIndex):
+        return pidList.pids
+    return [pidDoc['PID'] for pidDoc in pidList]
 
 def getFreshObjectUrl(queryHistory, pidList, drupal_end_point, max_age):
     """pidList is list of dictionaries containing fields called 'PID'"""
-    objectPid = pidList[random.randint(0,len(pidList) - 1)]['PID']
-    downloadUrl = drupal_end_point + "%s" % objectPid
+    sampler = FreshObjectSampler(queryHistory, pidsOf(pidList), drupal_end_point + "%s", max_age)
     try:
-        dateStamp = queryHistory.state[downloadUrl]
-        logging.debug("URL found in history with datestamp: %s" % dateStamp)
-        objectUrlAge = datetime.now() - dateStamp
-        if objectUrlAge > max_age:
-            logging.debug("Object URL age %s is older than max_age %s" % (objectUrlAge, max_age))
-            return downloadUrl
-        else:
-            logging.debug("Object URL age %s is younger than max_age %s" % (objectUrlAge, max_age))
-            logging.debug("Try again! rerunning getFreshUrl()")
-            try:
-                return getFreshObjectUrl(queryHistory, pidList, drupal_end_point, max_age)
-            except RecursionError:
-                logging.error("FAIL Exhausted available list of objects")
-                exit(1)
-    except KeyError:
-        # That URL is not even on the list so it's definitely fresh
-        logging.debug("URL not even in history")
-        queryHistory.recordQuery(downloadUrl)
-        return downloadUrl
+        return sampler.pick()
+    except ObjectsExhausted as e:
+        logging.error("FAIL %s" % e)
+        exit(1)
 
 class QueryHistory:
+    """Record of when each URL was last queried, kept in an SQLite database
+    indexed by URL and by last-used time so that looking up or recording a
+    query doesn't depend on the size of the history.
+
+    If historyfile is an old-style json history (e.g. queryhistory.json) the
+    database is kept next to it (queryhistory.sqlite) and the json is
+    imported the first time it is seen.
+
+    >>> import tempfile
+    >>> historyfile = os.path.join(tempfile.mkdtemp(), 'queryhistory.json')
+    >>> with open(historyfile, 'w') as fp:
+    ...     json.dump({'https://compass/yc:1/view': '2019-11-04 13:00:00', 'https://compass/yc:2/view': '2019-11-04 12:00:00.250000'}, fp)
+    >>> queryHistory = QueryHistory(historyfile)
+    >>> os.path.basename(queryHistory.databasefile), len(queryHistory)
+    ('queryhistory.sqlite', 2)
+    >>> queryHistory['https://compass/yc:2/view']
+    datetime.datetime(2019, 11, 4, 12, 0, 0, 250000)
+    >>> queryHistory.recordQuery('https://compass/yc:2/view', datetime(2019, 11, 5))
+    >>> sorted([url for url, lastUsed in queryHistory.usedSince(datetime(2019, 11, 4, 12, 30))])
+    ['https://compass/yc:1/view', 'https://compass/yc:2/view']
+    >>> 'https://compass/yc:3/view' in queryHistory
+    False
+    >>> queryHistory.close()
+
+    Importing the json again keeps the more recent of the two times:
+
+    >>> modified = os.stat(historyfile).st_mtime + 60
+    >>> os.utime(historyfile, (modified, modified))
+    >>> queryHistory = QueryHistory(historyfile)
+    >>> queryHistory['https://compass/yc:2/view']
+    datetime.datetime(2019, 11, 5, 0, 0)
+    >>> queryHistory.close()
+    """
     def __init__(self, historyfile):
         self.historyfile = historyfile
-        self.state = self._loadQueryHistory(historyfile)
+        root, extension = os.path.splitext(historyfile)
+        if extension == '.json':
+            self.databasefile = root + '.sqlite'
+        else:
+            self.databasefile = historyfile
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.databasefile, check_same_thread=False)
+        self._connection.executescript(QUERY_HISTORY_SCHEMA)
+        if extension == '.json':
+            self._importJsonHistory(historyfile)
 
-    def _loadQueryHistory(self, queryHistoryFile):
+    def _importJsonHistory(self, queryHistoryFile):
         try:
-            with open(queryHistoryFile, 'r') as fp:
-                queryHistoryJson = json.load(fp)
-            # Convert all the date strings into real dates... D:
-            queryHistory = {}
-            for key,value in queryHistoryJson.items():
-                value = datetime.strptime(value,'%Y-%m-%d %H:%M:%S.%f')
-                queryHistory[key] = value
+            mtime = os.stat(queryHistoryFile).st_mtime
         except FileNotFoundError:
-            logging.info("No query history file, starting a fresh dictionary")
-            queryHistory = {}
-        return queryHistory
+            logging.info("No query history file, starting a fresh history")
+            return
+        cursor = self._connection.execute("SELECT mtime FROM imports WHERE filename = ?", (queryHistoryFile,))
+        imported = cursor.fetchone()
+        if imported is not None and imported[0] >= mtime:
+            return
+        logging.info("Importing query history from %s into %s" % (queryHistoryFile, self.databasefile))
+        with open(queryHistoryFile, 'r') as fp:
+            queryHistoryJson = json.load(fp)
+        with self._lock, self._connection:
+            # Keep whichever is most recent if a URL is in both
+            self._connection.executemany(
+                "INSERT INTO history (url, lastUsed) VALUES (?, ?) ON CONFLICT (url) DO UPDATE SET lastUsed = max(lastUsed, excluded.lastUsed)",
+                ((url, _formatDateStamp(_parseDateStamp(dateStamp))) for url, dateStamp in queryHistoryJson.items())
+            )
+            self._connection.execute("INSERT OR REPLACE INTO imports (filename, mtime) VALUES (?, ?)", (queryHistoryFile, mtime))
+
+    def lastUsed(self, url):
+        """Return when url was last queried, or None if it never has been.
+        """
+        with self._lock:
+            cursor = self._connection.execute("SELECT lastUsed FROM history WHERE url = ?", (url,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return _parseDateStamp(row[0])
+
+    def __getitem__(self, url):
+        dateStamp = self.lastUsed(url)
+        if dateStamp is None:
+            raise KeyError(url)
+        return dateStamp
 
-    def recordQuery(self, downloadUrl):
-        self.state[downloadUrl] = datetime.now()
-        with open(self.historyfile, 'w') as fp:
-            json.dump(self.state, fp, indent=4, sort_keys=True, default=str)
+    def __contains__(self, url):
+        return self.lastUsed(url) is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT count(*) FROM history").fetchone()[0]
+
+    def items(self):
+        """All (url, last used) pairs, least recently used first.
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT url, lastUsed FROM history ORDER BY lastUsed").fetchall()
+        return [(url, _parseDateStamp(dateStamp)) for url, dateStamp in rows]
+
+    def usedSince(self, dateStamp):
+        """(url, last used) pairs for URLs queried more recently than dateStamp.
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT url, lastUsed FROM history WHERE lastUsed > ?", (_formatDateStamp(dateStamp),)).fetchall()
+        return [(url, _parseDateStamp(lastUsed)) for url, lastUsed in rows]
+
+    def recordQuery(self, downloadUrl, dateStamp=None):
+        if dateStamp is None:
+            dateStamp = datetime.now()
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO history (url, lastUsed) VALUES (?, ?)", (downloadUrl, _formatDateStamp(dateStamp)))
+
+    def close(self):
+        self._connection.close()
 
 def loadPidList(pidListFile):
     """Take json output from Solr and return just the 'docs' section, which is a
-     list of dictionaries containing fields"""
+     list of dictionaries containing fields. A PID index file (.pidx, see
+     pid_index.py) is memory-mapped instead and behaves the same way."""
+    if pidListFile.endswith(PID_INDEX_EXTENSION):
+        return PidIndex(pidListFile)
     with open(pidListFile, 'r') as fp:
         pidListData = json.load(fp)
     return pidListData['response']['docs']
@@ -84,25 +325,8 @@ if __name__ == '__main__':
     argparser.add_argument("--historyfile", default="queryhistory.json", help="Name of file to record what queries were made when.")
     cliArguments = argparser.parse_args()
 
-    section = cliArguments.SERVERCFG
-    configData = configparser.ConfigParser()
-    largeobjectslistFilename = 'largeobjectslist-%s.cache' % cliArguments.SERVERCFG
-
-    try:
-        configData.read_file(open(CONFIGFILE), source=CONFIGFILE)
-    except FileNotFoundError:
-        logging.error('No configuration file found. Configuration file required. Please make a config file called %s.' % CONFIGFILE)
-        exit(1)
-        
-    try:
-        serverConfig = configData[section]
-    except KeyError:
-        print("'%s' section not present in configuration file %s" % (section, CONFIGFILE))
-        exit(1)
-
-    drupal_protocol_host_port = serverConfig['drupal_protocol'] + "://" + serverConfig['drupal_hostname']
-    drupal_object_path = serverConfig['drupal_object_path']
-    drupal_end_point = drupal_protocol_host_port + drupal_object_path
+    serverConfig = loadServerConfig(cliArguments.SERVERCFG)
+    drupal_end_point = drupalEndPoint(serverConfig)
 
     mylist = loadPidList(cliArguments.PIDLISTFILE)
     queryHistory = QueryHistory(cliArguments.historyfile)
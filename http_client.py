@@ -0,0 +1,130 @@
+description = """Shared HTTP client for the probes.
+
+Keeps one pooled keep-alive requests Session per host so that repeated
+requests don't pay for a new TCP (and TLS) handshake every time. Every
+response gets a 'timings' dictionary which splits out connection setup from
+server time:
+
+connect -- seconds spent opening TCP connections (0 if a pooled one was reused)
+tls -- seconds spent on TLS handshakes
+timeToFirstByte -- seconds from sending the request to receiving the headers,
+    including any connect and TLS time
+serverTime -- timeToFirstByte minus connect and TLS time
+total -- seconds until the whole body was read (unless streaming)
+reusedConnection -- True if no new connection had to be opened
+"""
+import threading
+import time
+import logging
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Maximum number of keep-alive connections kept open to each host
+POOL_SIZE = 10
+
+_connectionTimings = threading.local()
+_sessions = {}
+_sessionsLock = threading.Lock()
+_poolSize = POOL_SIZE
+
+def _resetConnectionTimings():
+    _connectionTimings.connect = 0.0
+    _connectionTimings.tls = 0.0
+    _connectionTimings.newConnections = 0
+
+class _TimedConnectionMixin:
+    """Record how long opening the socket and the whole connect took on the
+    calling thread. For HTTPS the difference is the TLS handshake.
+    """
+    def _new_conn(self):
+        start = time.perf_counter()
+        sock = super()._new_conn()
+        self._tcpConnectTime = time.perf_counter() - start
+        return sock
+
+    def connect(self):
+        self._tcpConnectTime = 0.0
+        start = time.perf_counter()
+        super().connect()
+        connectTotal = time.perf_counter() - start
+        if not hasattr(_connectionTimings, 'connect'):
+            _resetConnectionTimings()
+        if isinstance(self, HTTPSConnection):
+            _connectionTimings.connect += self._tcpConnectTime
+            _connectionTimings.tls += connectTotal - self._tcpConnectTime
+        else:
+            _connectionTimings.connect += connectTotal
+        _connectionTimings.newConnections += 1
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+def configurePool(poolSize):
+    """Set the number of keep-alive connections kept per host. Only affects
+    sessions created after the call.
+    """
+    global _poolSize
+    _poolSize = poolSize
+
+def getSession(url):
+    """Return the shared Session for the host of url, creating it if needed.
+    """
+    parts = urlsplit(url)
+    host = parts.scheme + "://" + parts.netloc
+    with _sessionsLock:
+        try:
+            return _sessions[host]
+        except KeyError:
+            logging.debug("Opening connection pool of %s for %s" % (_poolSize, host))
+            session = requests.Session()
+            adapter = TimedHTTPAdapter(pool_connections=1, pool_maxsize=_poolSize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[host] = session
+            return session
+
+def get(url, **kwargs):
+    """Drop-in replacement for requests.get() that uses the pooled session for
+    the host and attaches a 'timings' dictionary to the response.
+    """
+    _resetConnectionTimings()
+    start = time.perf_counter()
+    response = getSession(url).get(url, **kwargs)
+    end = time.perf_counter()
+    timeToFirstByte = response.elapsed.total_seconds()
+    response.timings = {
+        'connect': _connectionTimings.connect,
+        'tls': _connectionTimings.tls,
+        'timeToFirstByte': timeToFirstByte,
+        'serverTime': max(timeToFirstByte - _connectionTimings.connect - _connectionTimings.tls, 0.0),
+        'total': end - start,
+        'reusedConnection': _connectionTimings.newConnections == 0,
+    }
+    return response
+
+def closeAll():
+    with _sessionsLock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,206 @@
+description = """Compact latency histograms.
+
+Folds any number of samples into logarithmically sized buckets (in the spirit
+of HdrHistogram) so memory stays constant, while percentiles stay within a
+fixed relative error. Histograms with the same settings can be merged, e.g.
+to combine the results of several runs:
+
+$ python3 latency_histogram.py fedora-histograms-1.json fedora-histograms-2.json
+"""
+import math
+import json
+import argparse
+
+# Values below this are counted in a single "zero" bucket. Latencies are
+# recorded in the units of the caller (seconds for realTime, milliseconds for
+# Solr QTime) so this is small enough for either.
+LOWEST_TRACKABLE_VALUE = 0.000001
+
+# Percentiles are accurate to within this fraction of the true value
+RELATIVE_ERROR = 0.01
+
+SUMMARY_PERCENTILES = [50, 90, 99, 99.9]
+
+class LatencyHistogram:
+    """Log-bucketed histogram of non-negative values.
+
+    >>> histogram = LatencyHistogram()
+    >>> for value in range(1, 1001):
+    ...     histogram.record(value)
+    >>> histogram.count
+    1000
+    >>> abs(histogram.percentile(50) - 500) <= 500 * RELATIVE_ERROR
+    True
+    >>> abs(histogram.percentile(99) - 990) <= 990 * RELATIVE_ERROR
+    True
+    >>> histogram.percentile(100)
+    1000
+    >>> other = LatencyHistogram()
+    >>> other.record(0)
+    >>> histogram.merge(other)
+    >>> histogram.count, histogram.min
+    (1001, 0)
+    >>> LatencyHistogram.fromDict(histogram.toDict()).percentile(90) == histogram.percentile(90)
+    True
+    """
+
+    def __init__(self, lowestTrackableValue=LOWEST_TRACKABLE_VALUE, relativeError=RELATIVE_ERROR):
+        self.lowestTrackableValue = lowestTrackableValue
+        self.relativeError = relativeError
+        # Each bucket covers [lowest * base**i, lowest * base**(i+1)). Using
+        # the geometric middle of the bucket as its value keeps the error
+        # within relativeError either side.
+        self._base = ((1 + relativeError) / (1 - relativeError))
+        self._logBase = math.log(self._base)
+        self.buckets = {}
+        self.zeroCount = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _bucketIndex(self, value):
+        return int(math.floor(math.log(value / self.lowestTrackableValue) / self._logBase))
+
+    def _bucketValue(self, index):
+        return self.lowestTrackableValue * self._base ** (index + 0.5)
+
+    def record(self, value, count=1):
+        if value < 0:
+            raise ValueError("Can't record negative value %s" % value)
+        if value < self.lowestTrackableValue:
+            self.zeroCount = self.zeroCount + count
+        else:
+            index = self._bucketIndex(value)
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count = self.count + count
+        self.total = self.total + value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """Return the value below which the given percentage of samples fall.
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(percentile / 100 * self.count))
+        seen = self.zeroCount
+        if seen >= rank:
+            return self.min
+        for index in sorted(self.buckets):
+            seen = seen + self.buckets[index]
+            if seen >= rank:
+                # Never report outside the range actually seen
+                return min(max(self._bucketValue(index), self.min), self.max)
+        return self.max
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def merge(self, other):
+        """Add the samples of another histogram into this one.
+        """
+        if (other.lowestTrackableValue, other.relativeError) != (self.lowestTrackableValue, self.relativeError):
+            raise ValueError("Can't merge histograms with different settings")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeroCount = self.zeroCount + other.zeroCount
+        self.count = self.count + other.count
+        self.total = self.total + other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def summary(self):
+        """Return count, mean, min, max and the SUMMARY_PERCENTILES.
+        """
+        summary = {
+            'count': self.count,
+            'mean': self.mean(),
+            'min': self.min,
+        }
+        for percentile in SUMMARY_PERCENTILES:
+            summary['p%s' % percentile] = self.percentile(percentile)
+        summary['max'] = self.max
+        return summary
+
+    def toDict(self):
+        """Serializable form for writing to the json reports.
+        """
+        return {
+            'lowestTrackableValue': self.lowestTrackableValue,
+            'relativeError': self.relativeError,
+            'buckets': {str(index): count for index, count in sorted(self.buckets.items())},
+            'zeroCount': self.zeroCount,
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def fromDict(cls, data):
+        histogram = cls(data['lowestTrackableValue'], data['relativeError'])
+        histogram.buckets = {int(index): count for index, count in data['buckets'].items()}
+        histogram.zeroCount = data['zeroCount']
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
+
+def histogramsFromDict(data):
+    return {name: LatencyHistogram.fromDict(histogramData) for name, histogramData in data.items()}
+
+def histogramsToDict(histograms):
+    return {name: histogram.toDict() for name, histogram in histograms.items()}
+
+def mergeHistogramFiles(filenames):
+    """Merge json files of named histograms, as written by the probes, into one
+    dictionary of histograms. Reports that keep their histograms under a
+    "latencyHistograms" key (check-solr.py, load_driver.py, page_profile.py)
+    can be given as they are.
+
+    >>> import os, tempfile
+    >>> histogram = LatencyHistogram()
+    >>> histogram.record(2)
+    >>> directory = tempfile.mkdtemp()
+    >>> with open(os.path.join(directory, 'histograms.json'), 'w') as fp:
+    ...     json.dump(histogramsToDict({'realTime': histogram}), fp)
+    >>> with open(os.path.join(directory, 'report.json'), 'w') as fp:
+    ...     json.dump({'summary': {}, 'latencyHistograms': histogramsToDict({'realTime': histogram})}, fp)
+    >>> merged = mergeHistogramFiles([os.path.join(directory, 'histograms.json'), os.path.join(directory, 'report.json')])
+    >>> merged['realTime'].count
+    2
+    """
+    merged = {}
+    for filename in filenames:
+        with open(filename, 'r') as fp:
+            data = json.load(fp)
+        histograms = histogramsFromDict(data.get('latencyHistograms', data))
+        for name, histogram in histograms.items():
+            if name in merged:
+                merged[name].merge(histogram)
+            else:
+                merged[name] = histogram
+    return merged
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument("HISTOGRAMFILE", nargs='+', help="Json file of named histograms written by one of the probes, or a report with a latencyHistograms section")
+    argparser.add_argument("--output", help="Also write the merged histograms to this file")
+    cliArguments = argparser.parse_args()
+
+    merged = mergeHistogramFiles(cliArguments.HISTOGRAMFILE)
+    for name, histogram in sorted(merged.items()):
+        print(name)
+        for key, value in histogram.summary().items():
+            print("    %-6s %s" % (key, value))
+    if cliArguments.output:
+        with open(cliArguments.output, 'w') as fp:
+            json.dump(histogramsToDict(merged), fp, indent=4, sort_keys=True)
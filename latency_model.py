@@ -0,0 +1,88 @@
+description = """Latency versus index size.
+
+Fits a straight line of Solr query time against the number of documents in
+the index across runs, flags runs that are far off the line, and projects the
+query time for a bigger index, e.g. before the next ingest batch.
+"""
+import math
+import statistics
+
+# Runs whose residual is more than this many robust standard deviations from
+# the fit are flagged
+OUTLIER_THRESHOLD = 3.5
+
+# Scales the median absolute deviation to a standard deviation for normally
+# distributed residuals
+MAD_SCALE = 1.4826
+
+class LinearFit:
+    """Ordinary least squares fit of y = intercept + slope * x.
+
+    >>> fit = LinearFit([1, 2, 3, 4], [3, 5, 7, 9])
+    >>> fit.intercept, fit.slope
+    (1.0, 2.0)
+    >>> fit.predict(10)
+    21.0
+    """
+    def __init__(self, xs, ys):
+        if len(xs) != len(ys):
+            raise ValueError("Need the same number of x and y values")
+        if len(xs) < 2:
+            raise ValueError("Need at least two runs to fit")
+        self.count = len(xs)
+        xMean = statistics.mean(xs)
+        yMean = statistics.mean(ys)
+        sxx = sum([(x - xMean) ** 2 for x in xs])
+        if sxx == 0:
+            raise ValueError("All runs have the same index size")
+        sxy = sum([(x - xMean) * (y - yMean) for x, y in zip(xs, ys)])
+        self.slope = sxy / sxx
+        self.intercept = yMean - self.slope * xMean
+        self.xMean = xMean
+        self.sxx = sxx
+        self.residuals = [y - self.predict(x) for x, y in zip(xs, ys)]
+        # Residual standard error, with two degrees of freedom used by the fit
+        if self.count > 2:
+            self.residualStdev = math.sqrt(sum([residual ** 2 for residual in self.residuals]) / (self.count - 2))
+        else:
+            self.residualStdev = 0.0
+        totalSquares = sum([(y - yMean) ** 2 for y in ys])
+        self.rSquared = 1 - sum([residual ** 2 for residual in self.residuals]) / totalSquares if totalSquares else 1.0
+
+    def predict(self, x):
+        return self.intercept + self.slope * x
+
+    def predictionInterval(self, x, z=1.96):
+        """Approximate range a single new run at x should fall in.
+        """
+        if self.count <= 2:
+            return None
+        spread = z * self.residualStdev * math.sqrt(1 + 1 / self.count + (x - self.xMean) ** 2 / self.sxx)
+        prediction = self.predict(x)
+        return prediction - spread, prediction + spread
+
+    def summary(self):
+        return {
+            'runs': self.count,
+            'intercept': self.intercept,
+            'slope': self.slope,
+            'slope per million docs': self.slope * 1000000,
+            'r squared': self.rSquared,
+            'residual stdev': self.residualStdev,
+        }
+
+def outlierFlags(residuals, threshold=OUTLIER_THRESHOLD):
+    """True for residuals more than threshold robust standard deviations (from
+    the median absolute deviation) away from the median residual, so that the
+    outliers themselves don't hide each other.
+
+    >>> outlierFlags([0.1, -0.2, 0.0, 0.2, -0.1, 5.0])
+    [False, False, False, False, False, True]
+    """
+    median = statistics.median(residuals)
+    mad = statistics.median([abs(residual - median) for residual in residuals])
+    scale = MAD_SCALE * mad
+    if scale == 0:
+        # At least half the runs sit exactly on the line; nothing to compare to
+        return [False] * len(residuals)
+    return [abs(residual - median) / scale > threshold for residual in residuals]
@@ -0,0 +1,545 @@
+description = """Distributed load driver for Solr and Fedora.
+
+One process can run out of CPU or network before a Solr or Fedora cluster
+does. This splits a run between worker processes, on this machine or on
+others, so client limits can be told apart from server limits.
+
+The coordinator makes the workload (random Solr phrases, or fresh Fedora
+object URLs from a PID list), cuts it into shards and hands them out over a
+plain HTTP control channel. Workers fetch a shard, run it, and post back
+latency histograms and throughput counters, which the coordinator merges into
+one report in output/.
+
+Four workers on this machine:
+$ python3 load_driver.py coordinator --target solr --requests 20000 --local-workers 4 PROD
+
+Or start the coordinator, then workers on other hosts:
+$ python3 load_driver.py coordinator --target fedora --requests 500 --port 8700 PROD
+$ python3 load_driver.py worker --coordinator http://coordinator-host:8700 --concurrency 8
+"""
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import datetime
+import threading
+import subprocess
+import collections
+import urllib.parse
+import http.server
+from concurrent.futures import ThreadPoolExecutor
+
+import http_client
+from datasets import commonEnglishWordS
+from open_loop import OpenLoopScheduler, parseRate, MAX_IN_FLIGHT
+from term_sampler import makeTermSampler, DISTRIBUTIONS
+from latency_histogram import LatencyHistogram, histogramsToDict, histogramsFromDict
+from get_fresh_pid import QueryHistory, FreshObjectSampler, ObjectsExhausted, loadPidList, pidsOf, MIN_OBJECT_URL_STALENESS
+from server_config import loadServerConfig, solrEndPoint, drupalEndPoint
+
+CONTROL_PORT = 8700
+
+# Work items per shard
+SHARD_SIZE = 100
+
+# A shard that hasn't been reported back this many seconds after it was
+# handed out is given to another worker
+SHARD_LEASE = 600
+
+# Seconds a worker waits before asking again when every shard is out
+WORKER_POLL_INTERVAL = 1
+
+# Times a worker retries reaching the coordinator before giving up
+WORKER_CONNECT_RETRIES = 10
+
+# Seconds between the coordinator's checks that its local workers are still
+# running
+WORKER_CHECK_INTERVAL = 5
+
+# Seconds the coordinator keeps answering after the last result, so polling
+# workers hear that the run is over
+COORDINATOR_LINGER = 5
+
+PLACES = 5
+CHUNK_SIZE = 1024 * 1024
+
+# Same history as check-fedora.py so the two don't reuse each other's objects
+QUERY_HISTORY_FILE = 'fedora-queryhistory.json'
+
+TARGETS = ['solr', 'fedora']
+
+# Histograms each target's probe records, in the units the single process
+# scripts use (seconds, or milliseconds for Solr QTime)
+TARGET_METRICS = {
+    'solr': ['solrQTime', 'realTime', 'timeToFirstByte', 'latency'],
+    'fedora': ['responseTime', 'timeToFirstByte', 'transferElapsedTime', 'latency'],
+}
+
+def solrProbe(url):
+    try:
+        response = http_client.get(url)
+        responseJson = response.json()
+        return {
+            'solrQTime': responseJson["responseHeader"]["QTime"],
+            'realTime': response.elapsed.total_seconds(),
+            'timeToFirstByte': response.timings['timeToFirstByte'],
+            'bytes': len(response.content),
+        }
+    except Exception as e:
+        return {'error': repr(e)}
+
+def fedoraProbe(url):
+    try:
+        start = time.perf_counter()
+        response = http_client.get(url, allow_redirects=True, stream=True)
+        if response.status_code != 200:
+            response.close()
+            return {'error': "%s %s" % (response.status_code, url)}
+        size = 0
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            size = size + len(chunk)
+        response.close()
+        return {
+            'responseTime': response.elapsed.total_seconds(),
+            'timeToFirstByte': response.timings['timeToFirstByte'],
+            'transferElapsedTime': time.perf_counter() - start,
+            'bytes': size,
+        }
+    except Exception as e:
+        return {'error': repr(e)}
+
+PROBES = {
+    'solr': solrProbe,
+    'fedora': fedoraProbe,
+}
+
+def summarizeShard(shard, reports, elapsed):
+    """Fold a shard's probe reports into histograms and counters.
+    """
+    histograms = {}
+    counters = {'requests': 0, 'errors': 0, 'bytes': 0, 'seconds': elapsed}
+    for report in reports:
+        counters['requests'] = counters['requests'] + 1
+        if 'error' in report:
+            counters['errors'] = counters['errors'] + 1
+            logging.debug(report['error'])
+            continue
+        counters['bytes'] = counters['bytes'] + report['bytes']
+        for metric in TARGET_METRICS[shard['target']]:
+            if metric in report:
+                histograms.setdefault(metric, LatencyHistogram()).record(report[metric])
+    return {
+        'shardId': shard['shardId'],
+        'histograms': histogramsToDict(histograms),
+        'counters': counters,
+    }
+
+def runShard(shard, concurrency):
+    """Run every URL in a shard, concurrency at a time.
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        reports = list(executor.map(PROBES[shard['target']], shard['urls']))
+    return summarizeShard(shard, reports, time.perf_counter() - start)
+
+def fetchShard(session, coordinatorUrl, workerId, stopping):
+    """The next shard from the coordinator and whether the worker had to wait
+    for it, or (None, False) once the run is over, the coordinator can't be
+    reached or the stopping event is set.
+    """
+    failures = 0
+    waited = False
+    while not stopping.is_set():
+        try:
+            response = session.get(coordinatorUrl + '/shard', params={'worker': workerId})
+        except http_client.requests.ConnectionError:
+            failures = failures + 1
+            if failures > WORKER_CONNECT_RETRIES:
+                logging.warning("Can't reach the coordinator at %s, stopping" % coordinatorUrl)
+                return None, False
+            time.sleep(WORKER_POLL_INTERVAL)
+            continue
+        failures = 0
+        if response.status_code == 204:
+            return None, False
+        if response.status_code == 503:
+            waited = True
+            time.sleep(WORKER_POLL_INTERVAL)
+            continue
+        response.raise_for_status()
+        return response.json(), waited
+    return None, False
+
+def postResult(session, coordinatorUrl, workerId, result):
+    result['workerId'] = workerId
+    session.post(coordinatorUrl + '/result', json=result).raise_for_status()
+
+def runWorker(coordinatorUrl, concurrency, workerId):
+    """Ask the coordinator for shards until it says the run is over.
+
+    Shards with a rate are sent on one open-loop schedule that carries on from
+    shard to shard. The next shard is fetched while one is being sent, and a
+    shard's results are posted once its slowest request is back, without
+    holding up the shards after it. Otherwise a backlog built up by an
+    overloaded server would be dropped at every shard boundary.
+    """
+    session = http_client.getSession(coordinatorUrl)
+
+    def finishShard(shard, futures, sendTime):
+        reports = [future.result() for future in futures]
+        postResult(session, coordinatorUrl, workerId, summarizeShard(shard, reports, sendTime))
+
+    shardsRun = 0
+    schedulers = []
+    posts = []
+    # Stops a fetch still polling for work if the worker gives up
+    stopping = threading.Event()
+    fetcher = ThreadPoolExecutor(max_workers=1)
+    poster = ThreadPoolExecutor(max_workers=1)
+    try:
+        nextShard = fetcher.submit(fetchShard, session, coordinatorUrl, workerId, stopping)
+        while True:
+            shard, waited = nextShard.result()
+            # A failed post stops the worker
+            for post in posts:
+                if post.done():
+                    post.result()
+            if shard is None:
+                break
+            nextShard = fetcher.submit(fetchShard, session, coordinatorUrl, workerId, stopping)
+            logging.info("%s running shard %s (%s %s requests)" % (workerId, shard['shardId'], len(shard['urls']), shard['target']))
+            if shard.get('rate'):
+                if not schedulers or waited:
+                    # Time spent waiting for work isn't a backlog, so start a
+                    # new schedule
+                    schedulers.append(OpenLoopScheduler(shard['rate'], shard['arrival']))
+                sendStart = time.perf_counter()
+                futures = schedulers[-1].submit(PROBES[shard['target']], shard['urls'])
+                # Busy time is how long the shard took to send, as its requests
+                # overlap with the next shard's
+                sendTime = time.perf_counter() - sendStart
+                posts.append(poster.submit(finishShard, shard, futures, sendTime))
+            else:
+                postResult(session, coordinatorUrl, workerId, runShard(shard, concurrency))
+            shardsRun = shardsRun + 1
+        for post in posts:
+            post.result()
+    finally:
+        stopping.set()
+        fetcher.shutdown()
+        poster.shutdown()
+        for scheduler in schedulers:
+            scheduler.close()
+    logging.info("%s finished after %s shards" % (workerId, shardsRun))
+
+class Coordinator:
+    """Hands out shards, takes leases back from workers that went quiet, and
+    merges the results.
+
+    >>> coordinator = Coordinator(makeShards('solr', ['a', 'b', 'c'], 2))
+    >>> first, second = coordinator.nextShard('w1'), coordinator.nextShard('w2')
+    >>> first['urls'], second['urls'], coordinator.nextShard('w3')
+    (['a', 'b'], ['c'], 'wait')
+    >>> histogram = LatencyHistogram()
+    >>> histogram.record(0.5)
+    >>> def result(shardId, workerId, requests):
+    ...     counters = {'requests': requests, 'errors': 0, 'bytes': 10, 'seconds': 1.0}
+    ...     return {'shardId': shardId, 'workerId': workerId, 'histograms': histogramsToDict({'latency': histogram}), 'counters': counters}
+    >>> coordinator.addResult(result(0, 'w1', 2))
+
+    A shard whose lease has run out goes to the next worker to ask, and a late
+    result for it from the first worker is dropped:
+
+    >>> coordinator.leaseSeconds = 0
+    >>> coordinator.nextShard('w3')['shardId']
+    1
+    >>> coordinator.addResult(result(1, 'w3', 1))
+    >>> coordinator.addResult(result(1, 'w2', 1))
+    >>> coordinator.done.is_set(), coordinator.nextShard('w1')
+    (True, None)
+    >>> histograms, totals, workers = coordinator.merged()
+    >>> histograms['latency'].count, totals['requests'], totals['bytes'], sorted(workers), workers['w3']['shards']
+    (2, 3, 20, ['w1', 'w3'], 1)
+    """
+    def __init__(self, shards, leaseSeconds=SHARD_LEASE):
+        self.shardCount = len(shards)
+        self.pending = collections.deque(shards)
+        self.leased = {}
+        self.results = {}
+        self.leaseSeconds = leaseSeconds
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.startTime = None
+        self.endTime = None
+
+    def nextShard(self, workerId):
+        """A shard, 'wait' if all are out but not back yet, or None once
+        every shard has been reported.
+        """
+        with self.lock:
+            now = time.perf_counter()
+            for shardId, (shard, leasedAt, leasedTo) in list(self.leased.items()):
+                if now - leasedAt > self.leaseSeconds:
+                    logging.warning("Shard %s leased to %s timed out, handing it out again" % (shardId, leasedTo))
+                    del self.leased[shardId]
+                    self.pending.append(shard)
+            if self.pending:
+                shard = self.pending.popleft()
+                self.leased[shard['shardId']] = (shard, now, workerId)
+                if self.startTime is None:
+                    self.startTime = now
+                return shard
+            if self.leased:
+                return 'wait'
+            return None
+
+    def addResult(self, result):
+        with self.lock:
+            # A shard that was handed out twice only counts once
+            if result['shardId'] in self.results:
+                return
+            self.leased.pop(result['shardId'], None)
+            self.pending = collections.deque([shard for shard in self.pending if shard['shardId'] != result['shardId']])
+            self.results[result['shardId']] = result
+            logging.info("Shard %s done by %s (%s of %s)" % (result['shardId'], result['workerId'], len(self.results), self.shardCount))
+            if len(self.results) == self.shardCount:
+                self.endTime = time.perf_counter()
+                self.done.set()
+
+    def merged(self):
+        """Merged histograms, total counters and per-worker counters.
+        """
+        histograms = {}
+        totals = collections.Counter()
+        workers = {}
+        for result in self.results.values():
+            for name, histogram in histogramsFromDict(result['histograms']).items():
+                if name in histograms:
+                    histograms[name].merge(histogram)
+                else:
+                    histograms[name] = histogram
+            totals.update(result['counters'])
+            workerTotals = workers.setdefault(result['workerId'], collections.Counter())
+            workerTotals.update(result['counters'])
+            workerTotals['shards'] += 1
+        return histograms, totals, workers
+
+def makeControlHandler(coordinator):
+    class ControlHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logging.debug("%s %s" % (self.address_string(), format % args))
+
+        def sendJson(self, status, body=None):
+            data = json.dumps(body).encode('utf-8') if body is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path != '/shard':
+                return self.sendJson(404)
+            workerId = urllib.parse.parse_qs(url.query).get('worker', ['unknown'])[0]
+            shard = coordinator.nextShard(workerId)
+            if shard is None:
+                self.sendJson(204)
+            elif shard == 'wait':
+                self.sendJson(503)
+            else:
+                self.sendJson(200, shard)
+
+        def do_POST(self):
+            if self.path != '/result':
+                return self.sendJson(404)
+            length = int(self.headers.get('Content-Length', 0))
+            coordinator.addResult(json.loads(self.rfile.read(length)))
+            self.sendJson(200, {})
+
+    return ControlHandler
+
+def makeSolrUrls(solrEndPointUrl, count, termSampler):
+    """Unique dismax phrase queries, as check-solr.py sends.
+    """
+    urls = []
+    for i in range(count):
+        urlParameters = urllib.parse.urlencode({'q': termSampler.phrase(PLACES)})
+        urls.append(solrEndPointUrl + "select?%s&wt=json&indent=true&defType=dismax" % urlParameters)
+    return urls
+
+def makeFedoraUrls(drupalEndPointUrl, count, pidListFile):
+    """Fresh object download URLs, as check-fedora.py picks them.
+    """
+    queryHistory = QueryHistory(QUERY_HISTORY_FILE)
+    sampler = FreshObjectSampler(queryHistory, pidsOf(loadPidList(pidListFile)), drupalEndPointUrl + "%s/datastream/OBJ/download", MIN_OBJECT_URL_STALENESS)
+    urls = []
+    try:
+        for i in range(count):
+            urls.append(sampler.pick())
+    except ObjectsExhausted as e:
+        logging.warning("Only %s fresh objects: %s" % (len(urls), e))
+    queryHistory.close()
+    return urls
+
+def makeShards(target, urls, shardSize, rate=None, arrival='fixed'):
+    return [
+        {
+            'shardId': shardId,
+            'target': target,
+            'urls': urls[start:start + shardSize],
+            'rate': rate,
+            'arrival': arrival,
+        }
+        for shardId, start in enumerate(range(0, len(urls), shardSize))
+    ]
+
+def coordinatorReport(coordinator, target, environment, environmentUri, startTime, rate=None):
+    histograms, totals, workers = coordinator.merged()
+    wallClockElapsed = coordinator.endTime - coordinator.startTime
+    report = {}
+    report["summary"] = {}
+    report["summary"]["test start time"] = startTime
+    report["summary"]["test end time"] = datetime.datetime.now()
+    report["summary"]["environment"] = environment
+    report["summary"]["environment uri"] = environmentUri
+    report["summary"]["target"] = target
+    report["summary"]["workers"] = len(workers)
+    report["summary"]["shards"] = coordinator.shardCount
+    report["summary"]["requests"] = totals['requests']
+    report["summary"]["errors"] = totals['errors']
+    report["summary"]["wall clock time"] = wallClockElapsed
+    report["summary"]["requested qps"] = rate
+    report["summary"]["achieved qps"] = totals['requests'] / wallClockElapsed
+    report["summary"]["aggregate MBytes per s"] = totals['bytes'] / 1000000 / wallClockElapsed
+    for name, histogram in histograms.items():
+        report["summary"][name + " percentiles"] = histogram.summary()
+    report["workers"] = {
+        workerId: {
+            'shards': workerTotals['shards'],
+            'requests': workerTotals['requests'],
+            'errors': workerTotals['errors'],
+            'busy seconds': workerTotals['seconds'],
+            'qps while busy': workerTotals['requests'] / workerTotals['seconds'] if workerTotals['seconds'] else None,
+        }
+        for workerId, workerTotals in workers.items()
+    }
+    report["latencyHistograms"] = histogramsToDict(histograms)
+    return report
+
+def startLocalWorkers(count, coordinatorUrl, concurrency, debug):
+    workers = []
+    for i in range(count):
+        command = [sys.executable, os.path.abspath(__file__), 'worker', '--coordinator', coordinatorUrl, '--concurrency', str(concurrency), '--worker-id', '%s-%s' % (socket.gethostname(), i)]
+        if debug:
+            command.append('--debug')
+        workers.append(subprocess.Popen(command))
+    return workers
+
+def runCoordinator(cliArguments):
+    serverConfig = loadServerConfig(cliArguments.SERVERCFG)
+    startTime = datetime.datetime.now()
+    if cliArguments.target == 'solr':
+        environmentUri = solrEndPoint(serverConfig)
+        termSampler = makeTermSampler(commonEnglishWordS, cliArguments.term_distribution, cliArguments.zipf_s, cliArguments.term_frequencies)
+        urls = makeSolrUrls(environmentUri, cliArguments.requests, termSampler)
+    else:
+        environmentUri = drupalEndPoint(serverConfig)
+        pidListFile = cliArguments.pid_list or 'largeobjectslist-%s.pidx' % cliArguments.SERVERCFG
+        urls = makeFedoraUrls(environmentUri, cliArguments.requests, pidListFile)
+    if not urls:
+        # With no shards to hand out the run would never be done
+        logging.error("No %s requests to send, check --requests and the PID list" % cliArguments.target)
+        exit(1)
+    rate = None
+    workerRate = None
+    if cliArguments.rate:
+        rate = parseRate(cliArguments.rate)
+        # Each worker runs its shards at its share of the total rate
+        workerRate = rate / max(cliArguments.local_workers, cliArguments.expected_workers, 1)
+    coordinator = Coordinator(makeShards(cliArguments.target, urls, cliArguments.shard_size, workerRate, cliArguments.arrival))
+
+    server = http.server.ThreadingHTTPServer(('', cliArguments.port), makeControlHandler(coordinator))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    coordinatorUrl = 'http://%s:%s' % (socket.gethostname() if not cliArguments.local_workers else '127.0.0.1', cliArguments.port)
+    logging.info("Coordinator listening at %s with %s shards of up to %s %s requests" % (coordinatorUrl, coordinator.shardCount, cliArguments.shard_size, cliArguments.target))
+
+    localWorkers = startLocalWorkers(cliArguments.local_workers, coordinatorUrl, cliArguments.concurrency, cliArguments.debug)
+    try:
+        while not coordinator.done.wait(WORKER_CHECK_INTERVAL):
+            # With no remote workers to take over, shards leased to local
+            # workers that have exited would never be reported
+            if localWorkers and not cliArguments.expected_workers and all([worker.poll() is not None for worker in localWorkers]):
+                logging.error("Every local worker has exited with %s of %s shards still to do" % (coordinator.shardCount - len(coordinator.results), coordinator.shardCount))
+                exit(1)
+        time.sleep(COORDINATOR_LINGER)
+    finally:
+        for worker in localWorkers:
+            worker.wait()
+        server.shutdown()
+
+    report = coordinatorReport(coordinator, cliArguments.target, cliArguments.SERVERCFG, environmentUri, startTime, rate)
+    logging.info("%(requests)s requests (%(errors)s errors) from %(workers)s workers in %(wall clock time).1f seconds: %(achieved qps).1f requests/s, %(aggregate MBytes per s).2f MB/s" % report["summary"])
+    if rate:
+        logging.info("Requested %.1f requests/s" % rate)
+    for name in sorted(report["latencyHistograms"]):
+        logging.info("%s percentiles: %s" % (name, report["summary"][name + " percentiles"]))
+    if not cliArguments.dry_run:
+        # Not named solr* so make-solr-report.py doesn't pick it up
+        outputFilename = 'distributed-%s-' % cliArguments.target + startTime.strftime("%Y-%m-%d_%H-%M-%S-%f") + '_' + cliArguments.SERVERCFG.strip() + ".json"
+        if cliArguments.debug:
+            outputFilename = "DEBUG-" + outputFilename
+        outputFilenamePath = 'output/' + outputFilename
+        with open(outputFilenamePath, 'w') as fp:
+            json.dump(report, fp, indent=4, sort_keys=True, default=str)
+        logging.info("Data logged to %s" % outputFilenamePath)
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument("ROLE", choices=["coordinator", "worker"])
+    argparser.add_argument("SERVERCFG", nargs='?', help="Coordinator only: name of the server configuration section e.g. 'PROD' or 'STAGE'.")
+    argparser.add_argument("--debug", action='store_true', help="More verbosity, write to files labeled with 'DEBUG'")
+    argparser.add_argument("--dry-run", action='store_true', help="Do not write out json report file")
+    argparser.add_argument("--target", default="solr", choices=TARGETS, help="Query Solr or download Fedora datastreams. Default solr.")
+    argparser.add_argument("--requests", default=1000, type=int, help="Total number of requests across all workers. Default 1000.")
+    argparser.add_argument("--shard-size", default=SHARD_SIZE, type=int, help="Requests per shard handed to a worker. Default %s." % SHARD_SIZE)
+    argparser.add_argument("--rate", help="Total open-loop rate across all workers, e.g. '500/s'. Split evenly between --local-workers or --expected-workers.")
+    argparser.add_argument("--arrival", default="fixed", choices=["fixed", "poisson"], help="How to space requests when --rate is given. Default fixed intervals.")
+    argparser.add_argument("--expected-workers", default=0, type=int, help="Number of remote workers to split --rate between")
+    argparser.add_argument("--local-workers", default=0, type=int, help="Start this many worker processes on this machine")
+    argparser.add_argument("--port", default=CONTROL_PORT, type=int, help="Port for the control channel. Default %s." % CONTROL_PORT)
+    argparser.add_argument("--pid-list", help="With --target fedora, PID list to draw objects from (Solr json or .pidx). Default check-fedora.py's largeobjectslist-SERVERCFG.pidx.")
+    argparser.add_argument("--term-distribution", default="uniform", choices=DISTRIBUTIONS, help="How to pick words for Solr phrases. Default uniform.")
+    argparser.add_argument("--zipf-s", type=float, default=1.0, help="Exponent for --term-distribution zipf. Default 1.0")
+    argparser.add_argument("--term-frequencies", help="File of 'word count' lines for --term-distribution empirical")
+    argparser.add_argument("--coordinator", help="Worker only: URL of the coordinator, e.g. http://coordinator-host:%s" % CONTROL_PORT)
+    argparser.add_argument("--concurrency", default=4, type=int, help="Worker only: requests each worker runs at once. Default 4.")
+    argparser.add_argument("--worker-id", default="%s-%s" % (socket.gethostname(), os.getpid()), help="Worker only: name to report results under")
+    cliArguments = argparser.parse_intermixed_args()
+
+    logging.basicConfig(level=logging.DEBUG if cliArguments.debug else logging.INFO)
+    logging.getLogger("requests").setLevel(logging.WARNING)
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+    if cliArguments.ROLE == 'worker':
+        if not cliArguments.coordinator:
+            argparser.error("Workers need --coordinator")
+        # Shards handed out with a rate can have up to MAX_IN_FLIGHT requests
+        # out at once; each one past the pool size would pay for a new handshake
+        http_client.configurePool(max(http_client.POOL_SIZE, cliArguments.concurrency, MAX_IN_FLIGHT))
+        runWorker(cliArguments.coordinator.rstrip('/'), cliArguments.concurrency, cliArguments.worker_id)
+    else:
+        if not cliArguments.SERVERCFG:
+            argparser.error("The coordinator needs a SERVERCFG")
+        if cliArguments.rate:
+            try:
+                parseRate(cliArguments.rate)
+            except ValueError as e:
+                logging.error(e)
+                exit(1)
+        runCoordinator(cliArguments)
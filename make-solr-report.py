@@ -7,6 +7,15 @@ import glob
 import logging
 import argparse
 import pprint
+import os
+from results_store import ResultsStore
+from latency_model import LinearFit, outlierFlags
+
+REPORT_CACHE = "output/.solr-report-cache.json"
+
+# Bump when summarizeReportFile() pulls out new fields so cached runs are
+# summarized again
+REPORT_CACHE_VERSION = 2
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -15,24 +24,18 @@ logging.basicConfig(level=logging.DEBUG)
 argparser = argparse.ArgumentParser(description=dsc)
 argparser.add_argument("ENVIRONMENT", default="PROD", help="Name of the system environment e.g. 'PROD' or 'STAGE'.")
 argparser.add_argument("OUTPUT", help="File to write to e.g. report.json.")
+argparser.add_argument("--results-db", help="Read run summaries from this SQLite results database (see results_store.py) instead of the json files in output/")
+argparser.add_argument("--analysis", help="Fit query time against index size (numDocs recorded by check-solr.py) across all runs, flag runs that don't fit, and write the analysis to this file")
+argparser.add_argument("--project", action='append', type=int, default=[], help="With --analysis, project query time for an index of this many documents. May be given more than once.")
+argparser.add_argument("--cache", default=REPORT_CACHE, help="File to cache already summarized runs in so only new runs are parsed. Default %s. Use '' to disable." % REPORT_CACHE)
 cliArguments = argparser.parse_args()
 environment = cliArguments.ENVIRONMENT
 
-reportsData_S = []
-
-fileList = glob.glob(r'output/solr*.json')
-fileList.sort() # Keep records in cronological order -- based on filenames which include date
-
-for individualReportFilename in fileList:
-    logging.debug(individualReportFilename)
+def summarizeReportFile(individualReportFilename):
+    """Read one check-solr.py report and pull out the fields for the report.
+    """
     with open(individualReportFilename) as infp:
-         individualReportData = json.load(infp)
-         if individualReportData['summary']['environment'] == environment:
-             reportsData_S.append(individualReportData)
-
-reportOutputData = []
-
-for individualReportData in reportsData_S:
+        individualReportData = json.load(infp)
     reportOutputDataRecord = {}
     logging.debug(individualReportData['summary']['test start time'])
     reportOutputDataRecord['datestamp'] = individualReportData['summary']['test start time']
@@ -40,9 +43,127 @@ for individualReportData in reportsData_S:
     reportOutputDataRecord['avgqtime'] = individualReportData['summary']['first (unique) time avg']
     logging.debug(individualReportData['summary']['numFound ave'])
     reportOutputDataRecord['avgnumfound'] = individualReportData['summary']['numFound ave']
-    reportOutputData.append(reportOutputDataRecord)
+    # Index size is only recorded by newer runs
+    reportOutputDataRecord['numdocs'] = individualReportData['summary'].get('index numDocs')
+    reportOutputDataRecord['segmentcount'] = individualReportData['summary'].get('index segment count')
+    return {
+        'environment': individualReportData['summary']['environment'],
+        'record': reportOutputDataRecord,
+    }
+
+def loadReportCache(cacheFilename):
+    """The cache maps report filenames to their mtime, size and summary so that
+    only new runs need to be parsed.
+    """
+    if not cacheFilename:
+        return {}
+    try:
+        with open(cacheFilename) as infp:
+            return json.load(infp)
+    except FileNotFoundError:
+        logging.info("No report cache file, parsing every report")
+        return {}
+    except json.JSONDecodeError:
+        logging.warning("Report cache %s is corrupt, parsing every report" % cacheFilename)
+        return {}
+
+def saveReportCache(cacheFilename, reportCache):
+    if not cacheFilename:
+        return
+    with open(cacheFilename, 'w') as outfp:
+        json.dump(reportCache, outfp, sort_keys=True)
+
+def analyzeIndexGrowth(reportOutputData, projectedSizes):
+    """Fit average unique query time against index size for the runs that
+    recorded it, flag runs far off the fit and project query times for the
+    given index sizes.
+    """
+    sizedRuns = [record for record in reportOutputData if record.get('numdocs') is not None]
+    analysis = {
+        'environment': environment,
+        'runs': len(reportOutputData),
+        'runs with index size': len(sizedRuns),
+    }
+    try:
+        fit = LinearFit([record['numdocs'] for record in sizedRuns], [record['avgqtime'] for record in sizedRuns])
+    except ValueError as e:
+        logging.warning("Can't fit query time against index size: %s" % e)
+        analysis['error'] = str(e)
+        return analysis
+    analysis['fit'] = fit.summary()
+    analysis['outliers'] = []
+    for record, residual, isOutlier in zip(sizedRuns, fit.residuals, outlierFlags(fit.residuals)):
+        if isOutlier:
+            analysis['outliers'].append({
+                'datestamp': record['datestamp'],
+                'avgqtime': record['avgqtime'],
+                'predictedqtime': fit.predict(record['numdocs']),
+                'residual': residual,
+                'numdocs': record['numdocs'],
+                'segmentcount': record.get('segmentcount'),
+            })
+    analysis['projections'] = []
+    for size in projectedSizes:
+        analysis['projections'].append({
+            'numdocs': size,
+            'predictedqtime': fit.predict(size),
+            'prediction interval': fit.predictionInterval(size),
+        })
+    return analysis
+
+def writeReport(reportOutputData):
+    outfilename = cliArguments.OUTPUT.strip()
+    logging.debug(outfilename)
+    with open(outfilename, 'w') as outfp:
+        json.dump(reportOutputData, outfp, indent=4, sort_keys=True, default=str)
+
+if cliArguments.results_db:
+    resultsStore = ResultsStore(cliArguments.results_db)
+    reportOutputData = []
+    for runSummary in resultsStore.runSummaries(environment):
+        reportOutputData.append({
+            'datestamp': runSummary['datestamp'],
+            'avgqtime': runSummary['avgqtime'],
+            'avgnumfound': runSummary['avgnumfound'],
+            'numdocs': runSummary['numdocs'],
+            'segmentcount': runSummary['segmentcount'],
+        })
+    resultsStore.close()
+else:
+    reportCache = loadReportCache(cliArguments.cache)
+    fileList = glob.glob(r'output/solr*.json')
+    fileList.sort() # Keep records in cronological order -- based on filenames which include date
+
+    reportOutputData = []
+    cachedRuns = {}
+    for individualReportFilename in fileList:
+        fileStat = os.stat(individualReportFilename)
+        cacheEntry = reportCache.get(individualReportFilename)
+        # Only parse runs that are new or have changed since they were cached
+        if cacheEntry is None or cacheEntry.get('version') != REPORT_CACHE_VERSION or cacheEntry['mtime'] != fileStat.st_mtime or cacheEntry['size'] != fileStat.st_size:
+            logging.debug(individualReportFilename)
+            cacheEntry = {
+                'version': REPORT_CACHE_VERSION,
+                'mtime': fileStat.st_mtime,
+                'size': fileStat.st_size,
+                'summary': summarizeReportFile(individualReportFilename),
+            }
+        cachedRuns[individualReportFilename] = cacheEntry
+        if cacheEntry['summary']['environment'] == environment:
+            reportOutputData.append(cacheEntry['summary']['record'])
+
+    # Files that have gone away are dropped from the cache
+    saveReportCache(cliArguments.cache, cachedRuns)
+
+writeReport(reportOutputData)
 
-outfilename = cliArguments.OUTPUT.strip()
-logging.debug(outfilename)
-with open(outfilename, 'w') as outfp:
-    json.dump(reportOutputData, outfp, indent=4, sort_keys=True, default=str)
+if cliArguments.analysis:
+    analysis = analyzeIndexGrowth(reportOutputData, cliArguments.project)
+    with open(cliArguments.analysis, 'w') as outfp:
+        json.dump(analysis, outfp, indent=4, sort_keys=True, default=str)
+    if 'fit' in analysis:
+        logging.info("%s runs: %.3f ms per million documents, r squared %.2f" % (analysis['fit']['runs'], analysis['fit']['slope per million docs'], analysis['fit']['r squared']))
+        for outlier in analysis['outliers']:
+            logging.info("Outlier run %(datestamp)s: %(avgqtime).1f ms, expected %(predictedqtime).1f ms" % outlier)
+        for projection in analysis['projections']:
+            logging.info("Projected query time at %(numdocs)s documents: %(predictedqtime).1f ms" % projection)
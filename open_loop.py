@@ -0,0 +1,144 @@
+description = """Open-loop request scheduling.
+
+Fires requests at a target arrival rate whether or not earlier requests have
+finished, so a stalled server can't slow the test down and hide its own worst
+latency (a.k.a. coordinated omission). Latency is measured from each
+request's intended send time rather than from when it actually went out.
+"""
+import random
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Upper limit on requests in flight at once. Requests beyond this wait in the
+# queue and the wait is counted as part of their latency.
+MAX_IN_FLIGHT = 200
+
+RATE_UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 3600,
+}
+
+def parseRate(rateString):
+    """Turn a rate like '50/s', '300/m' or '2.5' into requests per second.
+
+    >>> parseRate('50/s')
+    50.0
+    >>> parseRate('300/m')
+    5.0
+    >>> parseRate('2.5')
+    2.5
+    """
+    rate, _, unit = rateString.strip().partition('/')
+    unit = unit or 's'
+    try:
+        perSecond = float(rate) / RATE_UNITS[unit]
+    except (KeyError, ValueError):
+        raise ValueError("Can't understand rate '%s'. Use e.g. '50/s' or '300/m'." % rateString)
+    if perSecond <= 0:
+        raise ValueError("Rate must be greater than zero: '%s'" % rateString)
+    return perSecond
+
+def arrivalOffsets(rate, count, arrival='fixed', after=None):
+    """Return the intended send time of each request in seconds from the
+    start of the run. 'fixed' spaces requests evenly, 'poisson' draws
+    exponentially distributed gaps with the same mean. To carry on an earlier
+    schedule give the offset of its last request as after.
+
+    >>> arrivalOffsets(4, 3)
+    [0.0, 0.25, 0.5]
+    >>> arrivalOffsets(4, 2, after=0.5)
+    [0.75, 1.0]
+    """
+    offsets = []
+    offset = 0.0 if after is None else after
+    for i in range(count):
+        if arrival == 'fixed':
+            offset = i / rate if after is None else after + (i + 1) / rate
+        elif arrival == 'poisson':
+            offset = offset + random.expovariate(rate)
+        else:
+            raise ValueError("Unknown arrival process '%s'" % arrival)
+        offsets.append(offset)
+    return offsets
+
+class OpenLoopScheduler:
+    """Run task(item) for each work item at the given arrival rate. The task
+    must return a report dictionary; the scheduler adds to it:
+
+    intendedStartTime -- seconds from the start of the run the request was due
+    sendLag -- how late the request actually started
+    latency -- seconds from intended send time to completion
+
+    run() sends one batch of work items and waits for them. Batches given to
+    submit() instead carry on one schedule until close(), so a caller that
+    gets its work in pieces can keep up the rate without stopping to wait for
+    each piece's slowest request.
+
+    >>> scheduler = OpenLoopScheduler(100)
+    >>> first = scheduler.submit(lambda item: {'item': item}, ['a', 'b'])
+    >>> second = scheduler.submit(lambda item: {'item': item}, ['c'])
+    >>> scheduler.close()
+    >>> [(future.result()['item'], future.result()['intendedStartTime']) for future in first + second]
+    [('a', 0.0), ('b', 0.01), ('c', 0.02)]
+    """
+
+    def __init__(self, rate, arrival='fixed', maxInFlight=MAX_IN_FLIGHT):
+        self.rate = rate
+        self.arrival = arrival
+        self.maxInFlight = maxInFlight
+        self.elapsed = 0
+        self._executor = None
+        self._runStart = None
+        self._lastOffset = None
+
+    def run(self, task, workItems):
+        workItems = list(workItems)
+        logging.info("Sending %s requests open-loop at %.2f/s (%s arrivals)" % (len(workItems), self.rate, self.arrival))
+        try:
+            futures = self.submit(task, workItems)
+            return [future.result() for future in futures]
+        finally:
+            self.close()
+
+    def submit(self, task, workItems):
+        """Send task(item) for each work item on the schedule, after those of
+        earlier submit() calls, and return their futures once the last one
+        has been sent.
+        """
+        workItems = list(workItems)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.maxInFlight)
+            self._runStart = time.perf_counter()
+        offsets = arrivalOffsets(self.rate, len(workItems), self.arrival, self._lastOffset)
+        futures = []
+        for offset, item in zip(offsets, workItems):
+            delay = self._runStart + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(self._executor.submit(self._timedTask, task, item, self._runStart, offset))
+        if offsets:
+            self._lastOffset = offsets[-1]
+        return futures
+
+    def close(self):
+        """Wait for the requests in flight and end the schedule; the next
+        submit() starts a new one.
+        """
+        if self._executor is None:
+            return
+        self._executor.shutdown()
+        self.elapsed = time.perf_counter() - self._runStart
+        self._executor = None
+        self._lastOffset = None
+
+    def _timedTask(self, task, item, runStart, offset):
+        intendedStart = runStart + offset
+        actualStart = time.perf_counter()
+        report = task(item)
+        end = time.perf_counter()
+        report['intendedStartTime'] = offset
+        report['sendLag'] = actualStart - intendedStart
+        report['latency'] = end - intendedStart
+        return report
@@ -0,0 +1,379 @@
+description = """Break down what an Islandora object page costs to load.
+
+Fetches an object page, finds the sub-resources it references (thumbnails, TN,
+JPG and JP2 datastreams, viewer tile sources, scripts and stylesheets) and
+fetches them in parallel the way a browser would, at most six at a time per
+host. Each page gets a waterfall of when every request started, its time to
+first byte and when it finished, so a slow page can be put down to Drupal
+rendering (the page's own server time) or to the datastream fetches after it.
+
+Tiles that a viewer asks for from JavaScript once the page is running can't be
+seen without running the JavaScript; only datastream, djatoka and IIIF URLs
+that appear in the page (including its Drupal.settings) are fetched. Whole
+datastreams named in inline scripts, such as the JP2 in Drupal.settings'
+resourceUri, are handed to a viewer that asks the tile server for the parts it
+shows, so they are reported as viewer sources, fetched only once everything
+else is done and left out of page complete.
+
+$ python3 page_profile.py --pid-list stagebooks-1572891400.json --multiple 20 STAGE
+$ python3 page_profile.py --pid yc:1234 PROD
+"""
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import threading
+import collections
+import html.parser
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import http_client
+from latency_histogram import LatencyHistogram, histogramsToDict
+from get_fresh_pid import QueryHistory, FreshObjectSampler, ObjectsExhausted, loadPidList, pidsOf
+from server_config import loadServerConfig, drupalEndPoint
+
+# Browsers open about this many connections to each host
+CONNECTIONS_PER_HOST = 6
+
+# Same as the comparer, whose history file is the default here too
+MIN_OBJECT_URL_STALENESS = datetime.timedelta(hours=24)
+
+# Width of the waterfall bars in characters
+WATERFALL_WIDTH = 40
+
+# Datastream, djatoka and IIIF URLs in inline scripts, once the json escaping of
+# Drupal.settings is undone, e.g. "https:\/\/compass.fivecolleges.edu\/islandora\/object\/yc%3A1\/datastream\/JP2\/view"
+INLINE_URL_PATTERN = re.compile(r'''(?:https?:)?/[^"'\s<>()]*(?:/datastream/|djatoka|/iiif/)[^"'\s<>()]*''')
+
+# Kinds of sub-resource, in the order they are listed in the breakdown
+KINDS = ['page', 'stylesheet', 'script', 'thumbnail', 'datastream', 'tile', 'image', 'frame', 'other', 'viewerSource']
+
+# Kinds a browser doesn't wait for before the page is shown, fetched and
+# reported but not counted in page complete
+NON_BLOCKING_KINDS = ['viewerSource']
+
+# Bodies are read in pieces of this size so large datastreams aren't held in
+# memory; only the page's own HTML is kept
+CHUNK_SIZE = 1024 * 1024
+
+def classify(url, tagKind):
+    """Kind of sub-resource, from its URL where that says more than the tag.
+    tagKind 'inline' is a URL found in an inline script.
+
+    >>> classify('https://compass.fivecolleges.edu/islandora/object/yc%3A1/datastream/TN/view', 'image')
+    'thumbnail'
+    >>> classify('https://compass.fivecolleges.edu/islandora/object/yc%3A1/datastream/JP2/view', 'other')
+    'datastream'
+    >>> classify('https://compass.fivecolleges.edu/islandora/object/yc%3A1/datastream/JP2/view', 'inline')
+    'viewerSource'
+    >>> classify('https://compass.fivecolleges.edu/adore-djatoka/resolver?url_ver=Z39.88-2004&svc_id=info:lanl-repo/svc/getRegion', 'other')
+    'tile'
+    >>> classify('https://compass.fivecolleges.edu/misc/jquery.js?v=1.4.4', 'script')
+    'script'
+    """
+    path = urllib.parse.urlsplit(url).path
+    if '/datastream/TN' in path:
+        return 'thumbnail'
+    if '/datastream/' in path:
+        return 'viewerSource' if tagKind == 'inline' else 'datastream'
+    if 'djatoka' in url or '/iiif/' in path:
+        return 'tile'
+    return 'other' if tagKind == 'inline' else tagKind
+
+class SubResourceParser(html.parser.HTMLParser):
+    """Collect the URLs a browser would fetch to show a page, as (url, kind)
+    pairs in the order they appear, without duplicates.
+
+    >>> parser = SubResourceParser('https://compass.fivecolleges.edu/islandora/object/yc:1')
+    >>> parser.feed('<link rel="stylesheet" href="/misc/style.css"><img src="/islandora/object/yc%3A2/datastream/TN/view">'
+    ...     '<script>jQuery.extend(Drupal.settings, {"resourceUri":"https:\\\\/\\\\/compass.fivecolleges.edu\\\\/islandora\\\\/object\\\\/yc%3A1\\\\/datastream\\\\/JP2\\\\/view"});</script>'
+    ...     '<img src="data:image/gif;base64,R0lGOD"><script src="/misc/drupal.js"></script><img src="/misc/style.css">')
+    >>> for url, kind in parser.resources:
+    ...     print(kind, url)
+    stylesheet https://compass.fivecolleges.edu/misc/style.css
+    thumbnail https://compass.fivecolleges.edu/islandora/object/yc%3A2/datastream/TN/view
+    viewerSource https://compass.fivecolleges.edu/islandora/object/yc%3A1/datastream/JP2/view
+    script https://compass.fivecolleges.edu/misc/drupal.js
+    """
+    def __init__(self, pageUrl):
+        super().__init__(convert_charrefs=True)
+        self.pageUrl = pageUrl
+        self.resources = []
+        self._seen = set()
+        self._inScript = False
+
+    def _add(self, url, tagKind):
+        url = url.strip()
+        if not url or url.startswith(('data:', 'javascript:', '#')):
+            return
+        url = urllib.parse.urljoin(self.pageUrl, url)
+        url = urllib.parse.urldefrag(url)[0]
+        if url in self._seen or url == self.pageUrl:
+            return
+        self._seen.add(url)
+        self.resources.append((url, classify(url, tagKind)))
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'img':
+            for name in ('src', 'data-src'):
+                if attrs.get(name):
+                    self._add(attrs[name], 'image')
+            if attrs.get('srcset'):
+                for candidate in attrs['srcset'].split(','):
+                    if candidate.strip():
+                        self._add(candidate.split()[0], 'image')
+        elif tag == 'link':
+            rel = (attrs.get('rel') or '').lower().split()
+            if attrs.get('href') and ('stylesheet' in rel or 'icon' in rel or 'preload' in rel):
+                self._add(attrs['href'], 'stylesheet' if 'stylesheet' in rel else 'other')
+        elif tag == 'script':
+            if attrs.get('src'):
+                self._add(attrs['src'], 'script')
+            else:
+                self._inScript = True
+        elif tag in ('iframe', 'frame'):
+            if attrs.get('src'):
+                self._add(attrs['src'], 'frame')
+        elif tag in ('source', 'video', 'audio', 'embed'):
+            if attrs.get('src'):
+                self._add(attrs['src'], 'other')
+        elif tag == 'object':
+            if attrs.get('data'):
+                self._add(attrs['data'], 'other')
+
+    def handle_endtag(self, tag):
+        if tag == 'script':
+            self._inScript = False
+
+    def handle_data(self, data):
+        if self._inScript:
+            data = data.replace('\\/', '/').replace('\\u0026', '&')
+            for match in INLINE_URL_PATTERN.finditer(data):
+                self._add(match.group(0), 'inline')
+
+def _fetch(url, kind, profileStart):
+    """One request of the waterfall, with offsets in seconds from the start
+    of the page request. The body is read in CHUNK_SIZE pieces and only kept
+    (as entry['content']) for the page itself.
+    """
+    entry = {'url': url, 'kind': kind, 'start': time.perf_counter() - profileStart}
+    try:
+        with http_client.get(url, allow_redirects=True, stream=True) as response:
+            entry['status'] = response.status_code
+            entry['serverTime'] = response.timings['serverTime']
+            entry['connect'] = response.timings['connect'] + response.timings['tls']
+            entry['timeToFirstByte'] = response.timings['timeToFirstByte']
+            entry['contentType'] = response.headers.get('Content-Type', '')
+            entry['xDrupalCache'] = response.headers.get('X-Drupal-Cache', '')
+            entry['bytes'] = 0
+            chunks = []
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                entry['bytes'] += len(chunk)
+                if kind == 'page':
+                    chunks.append(chunk)
+        if kind == 'page':
+            entry['content'] = b''.join(chunks)
+    except Exception as e:
+        entry['error'] = repr(e)
+        logging.warning("%s: %s" % (url, repr(e)))
+    entry['end'] = time.perf_counter() - profileStart
+    entry['total'] = entry['end'] - entry['start']
+    return entry
+
+def profilePage(url, connectionsPerHost=CONNECTIONS_PER_HOST):
+    """Fetch a page, then every sub-resource it references, at most
+    connectionsPerHost at a time to each host. The NON_BLOCKING_KINDS are
+    only fetched once everything else is done, so they don't take connections
+    or bandwidth from what the page waits for. Returns the page's waterfall
+    (the page first, then its sub-resources in the order they were found, the
+    non-blocking ones last) and a breakdown of where the time went.
+    """
+    profileStart = time.perf_counter()
+    page = _fetch(url, 'page', profileStart)
+    resources = []
+    if 'error' not in page and 'html' in page['contentType']:
+        parser = SubResourceParser(url)
+        parser.feed(page['content'].decode('utf-8', errors='replace'))
+        parser.close()
+        resources = parser.resources
+    page.pop('content', None)
+    # A browser would start on them while the page is still arriving; here
+    # they are all queued once it has been read and parsed
+    discovered = time.perf_counter() - profileStart
+
+    hostSlots = collections.defaultdict(lambda: threading.Semaphore(connectionsPerHost))
+    for resourceUrl, kind in resources:
+        hostSlots[urllib.parse.urlsplit(resourceUrl).netloc]
+
+    def fetchWhenFree(resourceUrl, kind, queued):
+        with hostSlots[urllib.parse.urlsplit(resourceUrl).netloc]:
+            entry = _fetch(resourceUrl, kind, profileStart)
+        entry['blocked'] = entry['start'] - queued
+        return entry
+
+    def fetchAll(batch, queued):
+        if not batch:
+            return []
+        with ThreadPoolExecutor(max_workers=connectionsPerHost * len(hostSlots)) as executor:
+            return list(executor.map(lambda resource: fetchWhenFree(resource[0], resource[1], queued), batch))
+
+    subResources = fetchAll([resource for resource in resources if resource[1] not in NON_BLOCKING_KINDS], discovered)
+    pageComplete = max([entry['end'] for entry in [page] + subResources])
+    subResources = subResources + fetchAll([resource for resource in resources if resource[1] in NON_BLOCKING_KINDS], time.perf_counter() - profileStart)
+    return {
+        'url': url,
+        'waterfall': [page] + subResources,
+        'breakdown': breakdown(page, subResources, pageComplete),
+    }
+
+def breakdown(page, subResources, pageComplete):
+    """Where a page's time went: the page itself (Drupal rendering is its
+    server time), then the sub-resources after it, by kind. The
+    NON_BLOCKING_KINDS are listed by kind but left out of the sub-resource
+    time and the slowest sub-resource.
+    """
+    blocking = [entry for entry in subResources if entry['kind'] not in NON_BLOCKING_KINDS]
+    result = {
+        'page server time': page.get('serverTime'),
+        'page time to first byte': page.get('timeToFirstByte'),
+        'page html done': page['end'],
+        'sub-resource time': pageComplete - page['end'],
+        'page complete': pageComplete,
+        'sub-resources': len(subResources),
+        'sub-resource errors': len([entry for entry in subResources if 'error' in entry or entry['status'] >= 400]),
+        'bytes': sum([entry.get('bytes', 0) for entry in [page] + subResources]),
+        'kinds': {},
+    }
+    for kind in KINDS[1:]:
+        entries = [entry for entry in subResources if entry['kind'] == kind]
+        if not entries:
+            continue
+        result['kinds'][kind] = {
+            'count': len(entries),
+            'bytes': sum([entry.get('bytes', 0) for entry in entries]),
+            'server time': sum([entry.get('serverTime', 0) for entry in entries]),
+            'slowest': max([entry['total'] for entry in entries]),
+            'done': max([entry['end'] for entry in entries]),
+        }
+    if blocking:
+        slowest = max(blocking, key=lambda entry: entry['total'])
+        result['slowest sub-resource'] = {'url': slowest['url'], 'kind': slowest['kind'], 'total': slowest['total']}
+    return result
+
+def formatWaterfall(profile, width=WATERFALL_WIDTH):
+    """Text waterfall: '.' waiting for a connection, '-' waiting for the first
+    byte, '=' downloading.
+    """
+    # Scaled to the last request to finish, which may be a non-blocking one
+    # after page complete
+    scale = width / (max([entry['end'] for entry in profile['waterfall']]) or 1)
+    lines = ["%8s %8s %8s %6s %9s  %-10s %-*s  %s" % ('start', 'ttfb', 'total', 'status', 'bytes', 'kind', width, 'waterfall', 'url')]
+    for entry in profile['waterfall']:
+        blockedStart = entry['start'] - entry.get('blocked', 0)
+        firstByte = entry['start'] + entry.get('timeToFirstByte', entry['total'])
+        bar = ' ' * int(blockedStart * scale)
+        bar = bar + '.' * (int(entry['start'] * scale) - len(bar))
+        bar = bar + '-' * (int(firstByte * scale) - len(bar))
+        bar = bar + '=' * max(int(entry['end'] * scale) - len(bar), 1)
+        lines.append("%8.3f %8s %8.3f %6s %9s  %-10s %-*s  %s" % (
+            entry['start'],
+            "%.3f" % entry['timeToFirstByte'] if 'timeToFirstByte' in entry else 'error',
+            entry['total'],
+            entry.get('status', ''),
+            entry.get('bytes', ''),
+            entry['kind'],
+            width,
+            bar[:width],
+            entry['url'],
+        ))
+    summary = profile['breakdown']
+    lines.append("page server time %.3f s, page html done %.3f s, sub-resources (%s, %s failed) %.3f s more, page complete %.3f s" % (
+        summary['page server time'] or 0, summary['page html done'], summary['sub-resources'], summary['sub-resource errors'], summary['sub-resource time'], summary['page complete']))
+    for kind in NON_BLOCKING_KINDS:
+        if kind in summary['kinds']:
+            lines.append("%s (%s, not waited for) done %.3f s" % (kind, summary['kinds'][kind]['count'], summary['kinds'][kind]['done']))
+    return "\n".join(lines)
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument("SERVERCFG", help="Name of the server configuration section e.g. 'PROD' or 'STAGE'. Edit islandora.cfg to add a server configuration section.")
+    argparser.add_argument("--debug", action='store_true', help="More verbosity, write to files labeled with 'DEBUG'")
+    argparser.add_argument("--dry-run", action='store_true', help="Do not write out json report file")
+    argparser.add_argument("--pid", action='append', default=[], help="Profile this object's page. May be given more than once.")
+    argparser.add_argument("--pid-list", help="List of PIDs to draw fresh objects from (Solr json or .pidx)")
+    argparser.add_argument("--historyfile", default="queryhistory.json", help="Name of file to record what queries were made when, with --pid-list")
+    argparser.add_argument("--multiple", default=1, type=int, help="Number of objects to draw from --pid-list. Default 1.")
+    argparser.add_argument("--connections-per-host", default=CONNECTIONS_PER_HOST, type=int, help="Sub-resources fetched at once from each host. Default %s, like a browser." % CONNECTIONS_PER_HOST)
+    argparser.add_argument("--quiet", action='store_true', help="Don't print each page's waterfall")
+    cliArguments = argparser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if cliArguments.debug else logging.INFO)
+    logging.getLogger("requests").setLevel(logging.WARNING)
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+    if not (cliArguments.pid or cliArguments.pid_list):
+        argparser.error("Give --pid or --pid-list")
+
+    serverConfig = loadServerConfig(cliArguments.SERVERCFG)
+    objectEndPoint = drupalEndPoint(serverConfig)
+    http_client.configurePool(max(http_client.POOL_SIZE, cliArguments.connections_per_host))
+
+    pids = list(cliArguments.pid)
+    if cliArguments.pid_list:
+        queryHistory = QueryHistory(cliArguments.historyfile)
+        sampler = FreshObjectSampler(queryHistory, pidsOf(loadPidList(cliArguments.pid_list)), '%s', MIN_OBJECT_URL_STALENESS)
+        try:
+            for i in range(cliArguments.multiple):
+                pids.append(sampler.pick())
+        except ObjectsExhausted as e:
+            logging.error("FAIL %s" % e)
+            if not pids:
+                sys.exit(1)
+        queryHistory.close()
+
+    startTime = datetime.datetime.now()
+    histograms = collections.defaultdict(LatencyHistogram)
+    profiles = []
+    for pid in pids:
+        profile = profilePage(objectEndPoint + pid, cliArguments.connections_per_host)
+        profiles.append(profile)
+        summary = profile['breakdown']
+        if summary['page server time'] is not None:
+            histograms['pageServerTime'].record(summary['page server time'])
+            histograms['pageTimeToFirstByte'].record(summary['page time to first byte'])
+        histograms['pageHtmlDone'].record(summary['page html done'])
+        histograms['subResourceTime'].record(summary['sub-resource time'])
+        histograms['pageComplete'].record(summary['page complete'])
+        for kind, kindSummary in summary['kinds'].items():
+            histograms[kind + 'Done'].record(kindSummary['done'])
+        if not cliArguments.quiet:
+            print(formatWaterfall(profile))
+            print()
+
+    report = {}
+    report["summary"] = {}
+    report["summary"]["test start time"] = startTime
+    report["summary"]["test end time"] = datetime.datetime.now()
+    report["summary"]["environment"] = cliArguments.SERVERCFG
+    report["summary"]["environment uri"] = objectEndPoint
+    report["summary"]["pages"] = len(profiles)
+    report["summary"]["connections per host"] = cliArguments.connections_per_host
+    for name, histogram in sorted(histograms.items()):
+        report["summary"][name + " percentiles"] = histogram.summary()
+        logging.info("%s percentiles (seconds): %s" % (name, histogram.summary()))
+    report["pages"] = profiles
+    report["latencyHistograms"] = histogramsToDict(histograms)
+
+    if not cliArguments.dry_run:
+        outputFilename = 'page-profile-' + startTime.strftime("%Y-%m-%d_%H-%M-%S-%f") + '_' + cliArguments.SERVERCFG.strip() + ".json"
+        if cliArguments.debug:
+            outputFilename = "DEBUG-" + outputFilename
+        outputFilenamePath = 'output/' + outputFilename
+        with open(outputFilenamePath, 'w') as fp:
+            json.dump(report, fp, indent=4, sort_keys=True, default=str)
+        logging.info("Data logged to %s" % outputFilenamePath)
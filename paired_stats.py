@@ -0,0 +1,135 @@
+description = """Paired comparison of two environments.
+
+Each pair is the same object page timed on both environments at about the same
+moment, so the comparison is made on the per-pair differences rather than on
+the two latency distributions separately. This takes the object out of the
+noise: a big book is slow on both servers.
+"""
+import math
+import random
+import statistics
+
+BOOTSTRAP_RESAMPLES = 10000
+CONFIDENCE = 0.95
+
+# Below this many non-zero differences (and with no tied ranks) the Wilcoxon
+# p-value is computed exactly instead of from the normal approximation
+WILCOXON_EXACT_LIMIT = 25
+
+def geometricMeanRatio(xs, ys):
+    """Geometric mean of xs[i] / ys[i]: the typical factor by which x is
+    slower than y, not dragged about by a few very slow pairs.
+
+    >>> round(geometricMeanRatio([2, 8], [1, 2]), 6)
+    2.828427
+    """
+    return math.exp(statistics.mean([math.log(x / y) for x, y in zip(xs, ys)]))
+
+def bootstrapRatioInterval(xs, ys, resamples=BOOTSTRAP_RESAMPLES, confidence=CONFIDENCE, rng=random):
+    """Percentile bootstrap confidence interval of geometricMeanRatio(),
+    resampling whole pairs. Returns (ratio, low, high).
+
+    >>> ratio, low, high = bootstrapRatioInterval([1.2, 1.1, 1.3, 1.25, 1.15], [1.0] * 5, rng=random.Random(1))
+    >>> low < ratio < high, round(ratio, 3)
+    (True, 1.198)
+    """
+    logRatios = [math.log(x / y) for x, y in zip(xs, ys)]
+    count = len(logRatios)
+    means = sorted([sum(rng.choices(logRatios, k=count)) / count for resample in range(resamples)])
+    tail = (1 - confidence) / 2
+    low = means[int(math.floor(tail * (resamples - 1)))]
+    high = means[int(math.ceil((1 - tail) * (resamples - 1)))]
+    return math.exp(statistics.mean(logRatios)), math.exp(low), math.exp(high)
+
+def _ranks(values):
+    """Ranks starting at 1, ties given their average rank.
+
+    >>> _ranks([3, 1, 3, 2])
+    [3.5, 1.0, 3.5, 2.0]
+    """
+    order = sorted(range(len(values)), key=lambda i: values[i])
+    ranks = [0.0] * len(values)
+    i = 0
+    while i < len(order):
+        j = i
+        while j + 1 < len(order) and values[order[j + 1]] == values[order[i]]:
+            j = j + 1
+        for k in range(i, j + 1):
+            ranks[order[k]] = (i + j) / 2 + 1
+        i = j + 1
+    return ranks
+
+def _exactUpperTail(n, statistic):
+    """P(W+ >= statistic) when there are n untied, non-zero differences with
+    no real difference between x and y, by counting the ways each rank sum can
+    happen.
+    """
+    maxSum = n * (n + 1) // 2
+    ways = [1] + [0] * maxSum
+    for rank in range(1, n + 1):
+        for total in range(maxSum, rank - 1, -1):
+            ways[total] += ways[total - rank]
+    return sum(ways[int(math.ceil(statistic)):]) / 2 ** n
+
+def wilcoxonSignedRank(xs, ys):
+    """Wilcoxon signed-rank test of whether the pairs differ, without
+    assuming the differences are normally distributed. Zero differences are
+    dropped. Returns n (non-zero pairs), W+ (rank sum of the pairs where x is
+    bigger), z and a two-sided p-value.
+
+    >>> result = wilcoxonSignedRank([1.2, 1.1, 1.3, 1.25, 1.15, 1.05, 1.4, 1.35], [1.0] * 8)
+    >>> result['n'], result['statistic'], round(result['pValue'], 4)
+    (8, 36.0, 0.0078)
+    """
+    differences = [x - y for x, y in zip(xs, ys) if x != y]
+    n = len(differences)
+    if n == 0:
+        return {'n': 0, 'statistic': 0.0, 'z': 0.0, 'pValue': 1.0}
+    absoluteDifferences = [abs(difference) for difference in differences]
+    ranks = _ranks(absoluteDifferences)
+    statistic = sum([rank for rank, difference in zip(ranks, differences) if difference > 0])
+    mean = n * (n + 1) / 4
+    tieCounts = [absoluteDifferences.count(value) for value in set(absoluteDifferences)]
+    variance = n * (n + 1) * (2 * n + 1) / 24 - sum([t ** 3 - t for t in tieCounts]) / 48
+    if variance > 0:
+        # Continuity correction towards the mean
+        z = (statistic - mean - math.copysign(0.5, statistic - mean)) / math.sqrt(variance) if statistic != mean else 0.0
+    else:
+        z = 0.0
+    if n <= WILCOXON_EXACT_LIMIT and max(tieCounts) == 1:
+        pValue = min(1.0, 2 * _exactUpperTail(n, max(statistic, n * (n + 1) / 2 - statistic)))
+    else:
+        pValue = math.erfc(abs(z) / math.sqrt(2))
+    return {'n': n, 'statistic': statistic, 'z': z, 'pValue': pValue}
+
+def pairedComparison(xs, ys, resamples=BOOTSTRAP_RESAMPLES, confidence=CONFIDENCE, rng=random):
+    """Bootstrap interval of the x/y ratio and the Wilcoxon test together, as
+    written to the comparison reports.
+    """
+    ratio, low, high = bootstrapRatioInterval(xs, ys, resamples, confidence, rng)
+    return {
+        'pairs': len(xs),
+        'ratio': ratio,
+        'ratio low': low,
+        'ratio high': high,
+        'confidence': confidence,
+        'wilcoxon': wilcoxonSignedRank(xs, ys),
+    }
+
+def describeComparison(comparison, xName, yName):
+    """One line such as 'stage is 23.1% slower than prod (95% CI 10.2% to
+    37.0%, Wilcoxon p=0.0012, 300 pairs)'.
+
+    >>> describeComparison({'pairs': 8, 'ratio': 1.2, 'ratio low': 1.1, 'ratio high': 1.3, 'confidence': 0.95, 'wilcoxon': {'pValue': 0.0078}}, 'stage', 'prod')
+    'stage is 20.0% slower than prod (95% CI 10.0% to 30.0%, Wilcoxon p=0.0078, 8 pairs)'
+    """
+    def percent(ratio):
+        return (ratio - 1) * 100
+    if comparison['ratio'] >= 1:
+        direction = "slower"
+        change, low, high = percent(comparison['ratio']), percent(comparison['ratio low']), percent(comparison['ratio high'])
+    else:
+        direction = "faster"
+        change, low, high = -percent(comparison['ratio']), -percent(comparison['ratio high']), -percent(comparison['ratio low'])
+    return "%s is %.1f%% %s than %s (%g%% CI %.1f%% to %.1f%%, Wilcoxon p=%.4f, %s pairs)" % (
+        xName, change, direction, yName, comparison['confidence'] * 100, low, high, comparison['wilcoxon']['pValue'], comparison['pairs'])
@@ -0,0 +1,241 @@
+description = """Compact, memory-mapped index of candidate objects.
+
+Stores PIDs as one block of UTF-8 text with packed int64 offsets, datastream
+sizes, content models and MIME types alongside, instead of a pickled list of Solr doc
+dictionaries. The file is memory-mapped, so opening it is instant and only
+the pages actually touched are read, even with millions of objects.
+
+Convert a Solr json dump (e.g. for get_fresh_pid.py) with:
+$ python3 pid_index.py stagebooks-1572891400.json stagebooks.pidx
+"""
+import os
+import sys
+import mmap
+import json
+import array
+import bisect
+import struct
+import argparse
+from collections.abc import Sequence
+
+MAGIC = b'PIDINDX1'
+
+PID_INDEX_EXTENSION = '.pidx'
+
+SIZE_FIELD = 'fedora_datastream_latest_OBJ_SIZE_ms'
+
+# Solr fields with a small number of distinct values, stored as int64 codes
+# into a table of the values
+CATEGORY_FIELDS = [
+    'RELS_EXT_hasModel_uri_s',
+    'fedora_datastream_latest_OBJ_MIMETYPE_ms',
+]
+
+# Stored for objects with no size or category value
+MISSING = -1
+
+def _firstValue(value):
+    # Solr *_ms fields are lists
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+def writePidIndex(filename, docs, metadata=None):
+    """Write Solr docs (dictionaries with at least a 'PID') to an index file,
+    sorted by PID. metadata is any json-serializable dictionary to keep with
+    the index.
+    """
+    docs = sorted(docs, key=lambda doc: doc['PID'])
+    blob = bytearray()
+    offsets = array.array('q', [0])
+    sizes = array.array('q')
+    categoryTables = {field: [] for field in CATEGORY_FIELDS}
+    categoryCodes = {field: {} for field in CATEGORY_FIELDS}
+    categoryColumns = {field: array.array('q') for field in CATEGORY_FIELDS}
+    for doc in docs:
+        blob.extend(doc['PID'].encode('utf-8'))
+        offsets.append(len(blob))
+        size = _firstValue(doc.get(SIZE_FIELD))
+        sizes.append(int(size) if size is not None else MISSING)
+        for field in CATEGORY_FIELDS:
+            value = _firstValue(doc.get(field))
+            if value is None:
+                categoryColumns[field].append(MISSING)
+                continue
+            if value not in categoryCodes[field]:
+                categoryCodes[field][value] = len(categoryTables[field])
+                categoryTables[field].append(value)
+            categoryColumns[field].append(categoryCodes[field][value])
+    header = json.dumps({
+        'count': len(docs),
+        'byteorder': sys.byteorder,
+        'categoryFields': CATEGORY_FIELDS,
+        'categories': categoryTables,
+        'metadata': metadata or {},
+    }).encode('utf-8')
+    # Pad the header so the int64 arrays after it are 8-byte aligned
+    header = header + b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+    # Write to a temporary file and move it into place so that anyone with the
+    # old index memory-mapped keeps a consistent view of it
+    temporaryFilename = filename + '.tmp'
+    with open(temporaryFilename, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(struct.pack('<q', len(header)))
+        fp.write(header)
+        offsets.tofile(fp)
+        sizes.tofile(fp)
+        for field in CATEGORY_FIELDS:
+            categoryColumns[field].tofile(fp)
+        fp.write(blob)
+    os.replace(temporaryFilename, filename)
+
+class PidIndex(Sequence):
+    """Read-only view of an index file. Behaves like a list of Solr docs, so
+    index[i]['PID'] works as it does for the json or pickled lists, while
+    pid(i), size(i) and category(field, i) avoid building a dictionary.
+
+    >>> import tempfile, os
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'test.pidx')
+    >>> writePidIndex(filename, [
+    ...     {'PID': 'smith:2', SIZE_FIELD: ['20000000'], 'RELS_EXT_hasModel_uri_s': 'info:fedora/islandora:sp_videoCModel'},
+    ...     {'PID': 'smith:1', SIZE_FIELD: ['10000001']},
+    ... ], {'dateStamp': 'now'})
+    >>> index = PidIndex(filename)
+    >>> len(index), index.pid(0), index.size(1), index.metadata
+    (2, 'smith:1', 20000000, {'dateStamp': 'now'})
+    >>> index[1]['RELS_EXT_hasModel_uri_s'], index[0]['RELS_EXT_hasModel_uri_s']
+    ('info:fedora/islandora:sp_videoCModel', None)
+    >>> index.indexOf('smith:2'), index.indexOf('smith:3')
+    (1, None)
+    >>> bigOnes = index.subset([1])
+    >>> list(bigOnes), bigOnes.indexOf('smith:2'), bigOnes.indexOf('smith:1')
+    (['smith:2'], 0, None)
+    >>> index.close()
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._fp = open(filename, 'rb')
+        self._mmap = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a PID index file" % filename)
+        headerLength = struct.unpack_from('<q', self._mmap, len(MAGIC))[0]
+        headerStart = len(MAGIC) + 8
+        header = json.loads(self._mmap[headerStart:headerStart + headerLength].decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError("%s was written on a %s-endian machine" % (filename, header['byteorder']))
+        self.count = header['count']
+        self.metadata = header['metadata']
+        self.categories = header['categories']
+        # Read the category columns the file was written with, which may be
+        # fewer than CATEGORY_FIELDS for older files
+        self.categoryFields = header.get('categoryFields', ['RELS_EXT_hasModel_uri_s'])
+        view = memoryview(self._mmap)
+        position = headerStart + headerLength
+        def int64Column(length):
+            nonlocal position
+            column = view[position:position + length * 8].cast('q')
+            position = position + length * 8
+            return column
+        self._offsets = int64Column(self.count + 1)
+        self._sizes = int64Column(self.count)
+        self._categoryColumns = {}
+        for field in self.categoryFields:
+            self._categoryColumns[field] = int64Column(self.count)
+        self._blobStart = position
+        self.pids = _PidView(self)
+
+    def __len__(self):
+        return self.count
+
+    def pid(self, i):
+        start = self._blobStart + self._offsets[i]
+        end = self._blobStart + self._offsets[i + 1]
+        return self._mmap[start:end].decode('utf-8')
+
+    def size(self, i):
+        size = self._sizes[i]
+        return None if size == MISSING else size
+
+    def category(self, field, i):
+        if field not in self._categoryColumns:
+            return None
+        code = self._categoryColumns[field][i]
+        return None if code == MISSING else self.categories[field][code]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0:
+            i = i + self.count
+        if not 0 <= i < self.count:
+            raise IndexError("PID index out of range")
+        doc = {'PID': self.pid(i)}
+        size = self.size(i)
+        if size is not None:
+            doc[SIZE_FIELD] = [str(size)]
+        for field in CATEGORY_FIELDS:
+            doc[field] = self.category(field, i)
+        return doc
+
+    def indexOf(self, pid):
+        """Position of pid by binary search, or None if it isn't there.
+        """
+        i = bisect.bisect_left(self.pids, pid)
+        if i < self.count and self.pid(i) == pid:
+            return i
+        return None
+
+    def subset(self, positions):
+        """PIDs at the given positions (in ascending order), e.g. those in a
+        size range. Like pids it can be given to FreshObjectSampler.
+        """
+        return _PidView(self, array.array('q', positions))
+
+    def close(self):
+        self.pids = None
+        for field in self.categoryFields:
+            self._categoryColumns[field].release()
+        self._offsets.release()
+        self._sizes.release()
+        self._mmap.close()
+        self._fp.close()
+
+class _PidView(Sequence):
+    """Just the PID strings of an index, or of some positions in it, e.g. for
+    FreshObjectSampler.
+    """
+    def __init__(self, index, positions=None):
+        self._index = index
+        self._positions = positions
+
+    def __len__(self):
+        if self._positions is None:
+            return len(self._index)
+        return len(self._positions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if self._positions is None:
+            return self._index.pid(i)
+        return self._index.pid(self._positions[i])
+
+    def indexOf(self, pid):
+        if self._positions is None:
+            return self._index.indexOf(pid)
+        # PIDs are sorted in the index so they are sorted in any subset too
+        i = bisect.bisect_left(self, pid)
+        if i < len(self) and self[i] == pid:
+            return i
+        return None
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument("PIDLISTFILE", help="Standard Solr json output including PID field")
+    argparser.add_argument("INDEXFILE", help="PID index file to write e.g. stagebooks.pidx")
+    cliArguments = argparser.parse_args()
+
+    with open(cliArguments.PIDLISTFILE, 'r') as fp:
+        docs = json.load(fp)['response']['docs']
+    writePidIndex(cliArguments.INDEXFILE, docs, {'source': cliArguments.PIDLISTFILE})
+    print("Wrote %s objects to %s" % (len(docs), cliArguments.INDEXFILE))
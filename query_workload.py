@@ -0,0 +1,260 @@
+description = """Realistic Solr query mix from access logs.
+
+Reads Solr request logs and/or Drupal (Apache/nginx combined format) access
+logs, and builds a weighted model of the shapes of the searches patrons
+actually run: how many terms, quoted or not, query parser, fq filters, facet
+fields, sort and rows. Terms and filter values are weighted by how often they
+were seen. check-solr.py --workload then generates synthetic queries from the
+model instead of random five word phrases.
+
+Build a model with:
+$ python3 query_workload.py --solr-log solr.log --drupal-log access.log workload-PROD.json
+"""
+import re
+import json
+import random
+import logging
+import argparse
+import collections
+import urllib.parse
+
+from term_sampler import AliasTable
+
+# e.g. INFO  ... [collection1] webapp=/solr path=/select params={q=cats&rows=20&wt=json} hits=12 status=0 QTime=5
+SOLR_LOG_PATTERN = re.compile(r'path=/select params=\{(?P<params>.*?)\}(?: |$)')
+
+# e.g. 1.2.3.4 - - [07/Mar/2019:18:04:29 -0500] "GET /islandora/search/cats?type=dismax HTTP/1.1" 200 ...
+DRUPAL_LOG_PATTERN = re.compile(r'"GET (?P<path>/islandora/search/[^ ]*) HTTP')
+
+# Islandora Solr search doesn't put rows in the URL; this is its default
+DRUPAL_ROWS = 20
+
+# Solr syntax that isn't part of a search term
+TERM_PUNCTUATION = re.compile(r'[+\-!(){}\[\]^"~*?:\\/&|]')
+
+def _termsOf(query):
+    return [term for term in TERM_PUNCTUATION.sub(' ', query).lower().split() if term not in ('and', 'or', 'not')]
+
+def _filterField(filterQuery):
+    """Field name of a filter query like '-RELS_EXT_hasModel_uri_ms:"..."'.
+
+    >>> _filterField('{!tag=a}-RELS_EXT_hasModel_uri_ms:"info:fedora/islandora:pageCModel"')
+    'RELS_EXT_hasModel_uri_ms'
+    """
+    filterQuery = re.sub(r'^\{!.*?\}', '', filterQuery).lstrip('-+')
+    return filterQuery.split(':', 1)[0]
+
+def parseSolrLogLine(line):
+    """Solr parameters (a dictionary of lists) of a /select request in a
+    Solr log, or None for any other line.
+
+    >>> parseSolrLogLine('INFO  [collection1] webapp=/solr path=/select params={q=smith+college&fq=PID:smith*&rows=10&wt=json} hits=3 status=0 QTime=5')
+    {'q': ['smith college'], 'fq': ['PID:smith*'], 'rows': ['10'], 'wt': ['json']}
+    """
+    match = SOLR_LOG_PATTERN.search(line)
+    if match is None:
+        return None
+    return urllib.parse.parse_qs(match.group('params'), keep_blank_values=True)
+
+def parseDrupalLogLine(line):
+    """Equivalent Solr parameters of an Islandora search page request in a
+    Drupal access log, or None for any other line.
+
+    >>> parseDrupalLogLine('1.2.3.4 - - [07/Mar/2019:18:04:29 -0500] "GET /islandora/search/%22sophia%20smith%22?type=dismax&f%5B0%5D=mods_genre_ms%3A%22letters%22 HTTP/1.1" 200 1234')
+    {'q': ['"sophia smith"'], 'defType': ['dismax'], 'fq': ['mods_genre_ms:"letters"'], 'rows': ['20']}
+    """
+    match = DRUPAL_LOG_PATTERN.search(line)
+    if match is None:
+        return None
+    url = urllib.parse.urlsplit(match.group('path'))
+    query = urllib.parse.unquote(url.path[len('/islandora/search/'):])
+    drupalParameters = urllib.parse.parse_qs(url.query)
+    solrParameters = {'q': [query]}
+    if 'type' in drupalParameters:
+        solrParameters['defType'] = drupalParameters['type']
+    filterQueries = [value for name, values in drupalParameters.items() if name.startswith('f[') for value in values]
+    if filterQueries:
+        solrParameters['fq'] = filterQueries
+    if 'sort' in drupalParameters:
+        solrParameters['sort'] = drupalParameters['sort']
+    solrParameters['rows'] = [str(DRUPAL_ROWS)]
+    return solrParameters
+
+class WeightedChoice:
+    """Pick from values in proportion to their weights in O(1).
+
+    >>> WeightedChoice({'only': 3}).choose()
+    'only'
+    """
+    def __init__(self, weights):
+        self.values = list(weights.keys())
+        self._table = AliasTable(list(weights.values()))
+
+    def choose(self, rng=random):
+        return self.values[self._table.draw(rng)]
+
+class QueryWorkload:
+    """Weighted model of query shapes, terms and filter values.
+
+    >>> workload = QueryWorkload()
+    >>> workload.addRequest({'q': ['"sophia smith"'], 'fq': ['mods_genre_ms:"letters"'], 'rows': ['20']})
+    >>> workload.addRequest({'q': ['*:*'], 'facet.field': ['mods_genre_ms'], 'facet': ['true']})
+    >>> workload.queries, len(workload.shapes), dict(workload.terms)
+    (2, 2, {'sophia': 1, 'smith': 1})
+    >>> phrase, solrParameters = QueryWorkload.fromDict(workload.toDict()).sample(random.Random(1))
+    >>> solrParameters['q'] == [phrase]
+    True
+    """
+    def __init__(self):
+        self.queries = 0
+        self.sources = []
+        self.shapes = collections.Counter()
+        self.terms = collections.Counter()
+        self.filterValues = collections.defaultdict(collections.Counter)
+        self._choices = None
+
+    def addRequest(self, solrParameters):
+        def first(name, default=None):
+            return solrParameters.get(name, [default])[0]
+        query = first('q', '*:*')
+        terms = [] if query.strip() == '*:*' else _termsOf(query)
+        filterFields = []
+        for filterQuery in solrParameters.get('fq', []):
+            field = _filterField(filterQuery)
+            filterFields.append(field)
+            self.filterValues[field][filterQuery] += 1
+        shape = (
+            len(terms),
+            query.strip().startswith('"'),
+            first('defType', 'lucene'),
+            tuple(sorted(filterFields)),
+            tuple(sorted(solrParameters.get('facet.field', []))),
+            first('sort'),
+            first('rows', '10'),
+        )
+        self.shapes[shape] += 1
+        self.terms.update(terms)
+        self.queries = self.queries + 1
+        self._choices = None
+
+    def readLog(self, filename, parseLine):
+        logging.info("Reading %s" % filename)
+        added = 0
+        with open(filename, 'r', errors='replace') as fp:
+            for line in fp:
+                solrParameters = parseLine(line)
+                if solrParameters is None:
+                    continue
+                self.addRequest(solrParameters)
+                added = added + 1
+        self.sources.append(filename)
+        logging.info("%s searches in %s" % (added, filename))
+
+    def sample(self, rng=random):
+        """Return (phrase, Solr parameters) for a synthetic query with the
+        same shape and term mix as the logs.
+        """
+        if self._choices is None:
+            self._choices = {
+                'shapes': WeightedChoice(self.shapes),
+                'terms': WeightedChoice(self.terms) if self.terms else None,
+                'filterValues': {field: WeightedChoice(values) for field, values in self.filterValues.items()},
+            }
+        phraseLength, quoted, defType, filterFields, facetFields, sort, rows = self._choices['shapes'].choose(rng)
+        if phraseLength and self._choices['terms'] is not None:
+            phrase = " ".join([self._choices['terms'].choose(rng) for i in range(phraseLength)])
+            if quoted:
+                phrase = '"%s"' % phrase
+        else:
+            phrase = '*:*'
+        solrParameters = {'q': [phrase], 'rows': [rows]}
+        if defType != 'lucene':
+            solrParameters['defType'] = [defType]
+        if filterFields:
+            solrParameters['fq'] = [self._choices['filterValues'][field].choose(rng) for field in filterFields]
+        if facetFields:
+            solrParameters['facet'] = ['true']
+            solrParameters['facet.field'] = list(facetFields)
+        if sort:
+            solrParameters['sort'] = [sort]
+        return phrase, solrParameters
+
+    def summary(self):
+        return {
+            'sources': self.sources,
+            'queries': self.queries,
+            'shapes': len(self.shapes),
+            'terms': len(self.terms),
+        }
+
+    def toDict(self):
+        return {
+            'sources': self.sources,
+            'queries': self.queries,
+            'shapes': [
+                {
+                    'weight': weight,
+                    'phraseLength': phraseLength,
+                    'quoted': quoted,
+                    'defType': defType,
+                    'filterFields': list(filterFields),
+                    'facetFields': list(facetFields),
+                    'sort': sort,
+                    'rows': rows,
+                }
+                for (phraseLength, quoted, defType, filterFields, facetFields, sort, rows), weight in self.shapes.most_common()
+            ],
+            'terms': dict(self.terms.most_common()),
+            'filterValues': {field: dict(values.most_common()) for field, values in self.filterValues.items()},
+        }
+
+    @classmethod
+    def fromDict(cls, data):
+        workload = cls()
+        workload.sources = data['sources']
+        workload.queries = data['queries']
+        for shape in data['shapes']:
+            workload.shapes[(
+                shape['phraseLength'],
+                shape['quoted'],
+                shape['defType'],
+                tuple(shape['filterFields']),
+                tuple(shape['facetFields']),
+                shape['sort'],
+                shape['rows'],
+            )] = shape['weight']
+        workload.terms = collections.Counter(data['terms'])
+        for field, values in data['filterValues'].items():
+            workload.filterValues[field] = collections.Counter(values)
+        return workload
+
+def loadWorkload(filename):
+    with open(filename, 'r') as fp:
+        return QueryWorkload.fromDict(json.load(fp))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument("--solr-log", action='append', default=[], help="Solr request log to read. May be given more than once.")
+    argparser.add_argument("--drupal-log", action='append', default=[], help="Drupal/web server access log to read. May be given more than once.")
+    argparser.add_argument("--show", type=int, default=0, help="Print this many sample queries from the model")
+    argparser.add_argument("WORKLOADFILE", help="Json workload model to write, for check-solr.py --workload")
+    cliArguments = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if not (cliArguments.solr_log or cliArguments.drupal_log):
+        argparser.error("Give at least one --solr-log or --drupal-log")
+
+    workload = QueryWorkload()
+    for filename in cliArguments.solr_log:
+        workload.readLog(filename, parseSolrLogLine)
+    for filename in cliArguments.drupal_log:
+        workload.readLog(filename, parseDrupalLogLine)
+    if workload.queries == 0:
+        logging.error("No searches found in the logs")
+        exit(1)
+
+    with open(cliArguments.WORKLOADFILE, 'w') as fp:
+        json.dump(workload.toDict(), fp, indent=4)
+    logging.info("Wrote %s query shapes and %s terms from %s searches to %s" % (len(workload.shapes), len(workload.terms), workload.queries, cliArguments.WORKLOADFILE))
+    for i in range(cliArguments.show):
+        print(workload.sample()[1])
@@ -0,0 +1,175 @@
+description = """Append-only store of Solr test results.
+
+Every sample from every check-solr.py run is a row in an SQLite database,
+tagged with the run it came from, so reports can query just the columns they
+need instead of loading every run's json file.
+
+Import the old json reports once with:
+$ python3 results_store.py output/solr*.json
+"""
+import os
+import json
+import sqlite3
+import logging
+import argparse
+
+RESULTS_DB = "output/results.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    runId TEXT PRIMARY KEY,
+    environment TEXT NOT NULL,
+    environmentUri TEXT,
+    startTime TEXT NOT NULL,
+    endTime TEXT,
+    concurrency INTEGER,
+    firstQTimeAvg REAL,
+    lastQTimeAvg REAL,
+    numFoundAvg REAL,
+    summary TEXT,
+    numDocs INTEGER,
+    segmentCount INTEGER
+);
+CREATE INDEX IF NOT EXISTS runsByEnvironment ON runs (environment, startTime);
+CREATE TABLE IF NOT EXISTS samples (
+    runId TEXT NOT NULL REFERENCES runs (runId),
+    environment TEXT NOT NULL,
+    phrase TEXT,
+    repeatIndex INTEGER NOT NULL,
+    dateStamp TEXT,
+    qTime REAL,
+    realTime REAL,
+    numFound INTEGER,
+    concurrency INTEGER
+);
+CREATE INDEX IF NOT EXISTS samplesByRun ON samples (runId);
+"""
+
+# Columns added to the runs table since it was first created, added to older
+# databases when they are opened
+ADDED_RUN_COLUMNS = [
+    ("numDocs", "INTEGER"),
+    ("segmentCount", "INTEGER"),
+]
+
+def runIdFromFilename(filename):
+    """The run id is the report filename without directory or extension.
+
+    >>> runIdFromFilename('output/solr-2019-03-07_18-04-29-448357_PROD.json')
+    'solr-2019-03-07_18-04-29-448357_PROD'
+    """
+    return os.path.splitext(os.path.basename(filename))[0]
+
+class ResultsStore:
+    def __init__(self, filename=RESULTS_DB):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(SCHEMA)
+        existingColumns = [row[1] for row in self.connection.execute("PRAGMA table_info(runs)")]
+        for column, columnType in ADDED_RUN_COLUMNS:
+            if column not in existingColumns:
+                self.connection.execute("ALTER TABLE runs ADD COLUMN %s %s" % (column, columnType))
+
+    def hasRun(self, runId):
+        cursor = self.connection.execute("SELECT 1 FROM runs WHERE runId = ?", (runId,))
+        return cursor.fetchone() is not None
+
+    def addRun(self, runId, finalReport):
+        """Append a check-solr.py report. Runs that are already stored are
+        skipped so importing the same file twice is harmless.
+        """
+        if self.hasRun(runId):
+            logging.debug("%s already in %s" % (runId, self.filename))
+            return False
+        summary = finalReport["summary"]
+        environment = summary["environment"]
+        concurrency = summary.get("concurrency", 1)
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO runs (runId, environment, environmentUri, startTime, endTime, concurrency, firstQTimeAvg, lastQTimeAvg, numFoundAvg, summary, numDocs, segmentCount) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    runId,
+                    environment,
+                    summary.get("environment uri"),
+                    str(summary["test start time"]),
+                    str(summary.get("test end time")),
+                    concurrency,
+                    summary["first (unique) time avg"],
+                    summary["last (cached) time avg"],
+                    summary["numFound ave"],
+                    json.dumps(summary, sort_keys=True, default=str),
+                    summary.get("index numDocs"),
+                    summary.get("index segment count"),
+                )
+            )
+            self.connection.executemany(
+                "INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        runId,
+                        environment,
+                        check["phrase"],
+                        repeatIndex,
+                        str(check["datesStamp"]),
+                        check["solrQTime"],
+                        check["realTime"],
+                        check["numFound"],
+                        check.get("concurrency", concurrency),
+                    )
+                    for queryResponses in finalReport["data"]
+                    for repeatIndex, check in enumerate(queryResponses)
+                )
+            )
+        return True
+
+    def importReportFiles(self, filenames):
+        """Import json reports written by check-solr.py. Returns the number of
+        new runs added.
+        """
+        added = 0
+        for filename in sorted(filenames):
+            runId = runIdFromFilename(filename)
+            if self.hasRun(runId):
+                continue
+            logging.debug("Importing %s" % filename)
+            with open(filename, 'r') as fp:
+                finalReport = json.load(fp)
+            if self.addRun(runId, finalReport):
+                added = added + 1
+        return added
+
+    def runSummaries(self, environment):
+        """Return the per-run summary fields for an environment in
+        chronological order.
+        """
+        cursor = self.connection.execute(
+            "SELECT runId, startTime, firstQTimeAvg, lastQTimeAvg, numFoundAvg, numDocs, segmentCount FROM runs WHERE environment = ? ORDER BY startTime",
+            (environment,)
+        )
+        return [
+            {
+                'runId': runId,
+                'datestamp': startTime,
+                'avgqtime': firstQTimeAvg,
+                'avgcachedqtime': lastQTimeAvg,
+                'avgnumfound': numFoundAvg,
+                'numdocs': numDocs,
+                'segmentcount': segmentCount,
+            }
+            for runId, startTime, firstQTimeAvg, lastQTimeAvg, numFoundAvg, numDocs, segmentCount in cursor
+        ]
+
+    def close(self):
+        self.connection.close()
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument("REPORTFILE", nargs='+', help="json report written by check-solr.py")
+    argparser.add_argument("--results-db", default=RESULTS_DB, help="SQLite results database. Default %s" % RESULTS_DB)
+    cliArguments = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    store = ResultsStore(cliArguments.results_db)
+    added = store.importReportFiles(cliArguments.REPORTFILE)
+    store.close()
+    logging.info("Imported %s new runs into %s" % (added, cliArguments.results_db))
@@ -0,0 +1,57 @@
+description = """Server configurations from islandora.cfg.
+
+Each section (PROD, STAGE, DEV, ...) names the Solr and Drupal servers of one
+environment. The probes read their section here and build their end points
+with the helpers below rather than each doing it themselves.
+"""
+import logging
+import configparser
+
+CONFIGFILE = "islandora.cfg"
+
+def readConfigFile(configFile=CONFIGFILE):
+    """Parse the configuration file, exiting with a message if there isn't one.
+    """
+    configData = configparser.ConfigParser()
+    try:
+        configData.read_file(open(configFile), source=configFile)
+    except FileNotFoundError:
+        logging.error('No configuration file found. Configuration file required. Please make a config file called %s.' % configFile)
+        exit(1)
+    return configData
+
+def loadServerConfig(section, configFile=CONFIGFILE):
+    """Return one section of the configuration file, exiting with a message if
+    it isn't there.
+    """
+    configData = readConfigFile(configFile)
+    try:
+        return configData[section]
+    except KeyError:
+        print("'%s' section not present in configuration file %s" % (section, configFile))
+        exit(1)
+
+def configuredSections(configFile=CONFIGFILE):
+    return readConfigFile(configFile).sections()
+
+def solrEndPoint(serverConfig):
+    """e.g. http://compass-fedora-prod.fivecolleges.edu:8080/solr/collection1/
+
+    >>> solrEndPoint({'solr_protocol': 'http', 'solr_hostname': 'localhost', 'solr_port': '8080', 'solr_core_path': '/solr/collection1/'})
+    'http://localhost:8080/solr/collection1/'
+    """
+    return serverConfig['solr_protocol'] + "://" + serverConfig['solr_hostname'] + ":" + serverConfig['solr_port'] + serverConfig['solr_core_path']
+
+def drupalBaseUrl(serverConfig):
+    """e.g. https://compass.fivecolleges.edu
+    """
+    return serverConfig['drupal_protocol'] + "://" + serverConfig['drupal_hostname']
+
+def drupalEndPoint(serverConfig):
+    """Object pages are drupalEndPoint() + PID, e.g.
+    https://compass.fivecolleges.edu/islandora/object/
+
+    >>> drupalEndPoint({'drupal_protocol': 'https', 'drupal_hostname': 'compass.fivecolleges.edu', 'drupal_object_path': '/islandora/object/'})
+    'https://compass.fivecolleges.edu/islandora/object/'
+    """
+    return drupalBaseUrl(serverConfig) + serverConfig['drupal_object_path']
@@ -0,0 +1,155 @@
+description = """Term samplers for generating query phrases.
+
+Real term frequencies are heavy-tailed, which changes posting list lengths and
+how often Solr's caches hit, so picking words uniformly isn't realistic. A
+TermSampler picks words uniformly, by Zipf's law over their rank in the list,
+or by weights from a frequency file. Picks use an alias table, so each word
+costs O(1) however long the list is.
+
+Show the most likely words of a distribution with:
+$ python3 term_sampler.py --distribution zipf --zipf-s 1.1
+"""
+import random
+import argparse
+import collections
+
+DISTRIBUTIONS = ['uniform', 'zipf', 'empirical']
+
+class AliasTable:
+    """Vose's alias method: after O(n) setup, draw() returns index i with
+    probability weights[i] / sum(weights) using one random number.
+
+    >>> table = AliasTable([1, 0, 3])
+    >>> rng = random.Random(1)
+    >>> counts = collections.Counter(table.draw(rng) for i in range(10000))
+    >>> counts[1], round(counts[2] / counts[0])
+    (0, 3)
+    """
+    def __init__(self, weights):
+        count = len(weights)
+        if count == 0:
+            raise ValueError("Can't sample from no weights")
+        total = float(sum(weights))
+        if total <= 0:
+            raise ValueError("Weights must add up to more than zero")
+        scaled = [weight * count / total for weight in weights]
+        self.probability = [0.0] * count
+        self.alias = [0] * count
+        small = [i for i, weight in enumerate(scaled) if weight < 1]
+        large = [i for i, weight in enumerate(scaled) if weight >= 1]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left over is 1 give or take rounding
+        for i in small + large:
+            self.probability[i] = 1.0
+
+    def __len__(self):
+        return len(self.probability)
+
+    def draw(self, rng=random):
+        column = rng.random() * len(self.probability)
+        i = int(column)
+        if column - i < self.probability[i]:
+            return i
+        return self.alias[i]
+
+def readFrequencyFile(filename):
+    """Read 'word count' lines (e.g. from a corpus word count) into a
+    dictionary. Lines that don't parse are skipped.
+    """
+    frequencies = collections.OrderedDict()
+    with open(filename, 'r') as fp:
+        for line in fp:
+            parts = line.split()
+            if len(parts) != 2:
+                continue
+            try:
+                frequencies[parts[0]] = frequencies.get(parts[0], 0) + float(parts[1])
+            except ValueError:
+                continue
+    return frequencies
+
+class TermSampler:
+    """Picks words from a list, most common first.
+
+    >>> sampler = TermSampler(['the', 'and', 'you'], 'zipf', s=1.0)
+    >>> sampler.parameters()
+    {'distribution': 'zipf', 'terms': 3, 's': 1.0}
+    >>> [round(probability, 3) for probability in sampler.probabilities()]
+    [0.545, 0.273, 0.182]
+    >>> TermSampler(['the', 'and'], 'empirical', frequencies={'cat': 2}).phrase(2, random.Random(1))
+    'cat cat'
+    """
+    def __init__(self, words, distribution='uniform', s=1.0, frequencies=None, frequencySource=None):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError("Unknown term distribution '%s'" % distribution)
+        self.distribution = distribution
+        self.s = s
+        self.frequencySource = frequencySource
+        if distribution == 'empirical':
+            if not frequencies:
+                raise ValueError("The empirical distribution needs word frequencies")
+            self.words = list(frequencies.keys())
+            self.weights = list(frequencies.values())
+        elif distribution == 'zipf':
+            self.words = list(words)
+            self.weights = [1.0 / rank ** s for rank in range(1, len(self.words) + 1)]
+        else:
+            self.words = list(words)
+            self.weights = [1.0] * len(self.words)
+        self._table = AliasTable(self.weights)
+
+    def choose(self, rng=random):
+        return self.words[self._table.draw(rng)]
+
+    def phrase(self, places, rng=random):
+        return " ".join([self.choose(rng) for i in range(places)])
+
+    def probabilities(self):
+        total = sum(self.weights)
+        return [weight / total for weight in self.weights]
+
+    def parameters(self):
+        """Settings to record in reports.
+        """
+        parameters = {
+            'distribution': self.distribution,
+            'terms': len(self.words),
+        }
+        if self.distribution == 'zipf':
+            parameters['s'] = self.s
+        if self.distribution == 'empirical':
+            parameters['frequency file'] = self.frequencySource
+        return parameters
+
+def makeTermSampler(words, distribution='uniform', s=1.0, frequencyFile=None):
+    """Build a sampler from command line style settings.
+    """
+    frequencies = None
+    if frequencyFile:
+        frequencies = readFrequencyFile(frequencyFile)
+    return TermSampler(words, distribution, s, frequencies, frequencyFile)
+
+if __name__ == '__main__':
+    from datasets import commonEnglishWordS
+
+    argparser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument("--distribution", default="uniform", choices=DISTRIBUTIONS, help="Default uniform")
+    argparser.add_argument("--zipf-s", type=float, default=1.0, help="Zipf exponent. Default 1.0")
+    argparser.add_argument("--term-frequencies", help="File of 'word count' lines for the empirical distribution")
+    argparser.add_argument("--top", type=int, default=20, help="Number of words to show. Default 20")
+    cliArguments = argparser.parse_args()
+
+    sampler = makeTermSampler(commonEnglishWordS, cliArguments.distribution, cliArguments.zipf_s, cliArguments.term_frequencies)
+    print(sampler.parameters())
+    ranked = sorted(zip(sampler.probabilities(), sampler.words), reverse=True)
+    for probability, word in ranked[:cliArguments.top]:
+        print("%-15s %.5f" % (word, probability))